@@ -0,0 +1,135 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .archive import get_archived
+from .models import Achievement, AchievementStats, DailyTimeline
+
+
+# День считается днем с низким экранным временем, если суммарно меньше 2 часов
+LOW_SCREEN_TIME_THRESHOLD_SECONDS = 2 * 60 * 60
+
+# Дату активности присылает клиент: серия учитывает только сегодня и вчера
+# (поздняя синхронизация). Будущая дата навсегда остановила бы серию, а
+# цепочка прошлых дат накручивала бы ее
+ACTIVITY_MAX_AGE_DAYS = 1
+
+# Какой счетчик статистики проверяется для каждого типа достижения
+STAT_FIELD_BY_ACHIEVEMENT_TYPE = {
+    'daily_streak': 'consecutive_days',
+    'ai_chat_usage': 'ai_chat_usage_count',
+    'app_blocking': 'app_blocking_count',
+    'low_screen_time': 'low_screen_time_days',
+    'total_usage_months': 'total_usage_months',
+}
+
+
+class AchievementEngine:
+    """Инкрементальный расчет статистики и разблокировка достижений на сервере"""
+
+    def record_activity(self, user, activity_date=None):
+        """
+        Отмечает активность пользователя за день (запись timeline и т.п.).
+
+        Обновляет серию дней, счетчик дней с низким экранным временем
+        и количество месяцев использования, затем проверяет пороги.
+
+        Returns:
+            list[Achievement]: Достижения, разблокированные этим событием
+        """
+        today = timezone.localdate()
+        activity_date = activity_date or today
+        if not today - timedelta(days=ACTIVITY_MAX_AGE_DAYS) <= activity_date <= today:
+            return []
+        with transaction.atomic():
+            stats = self._get_locked_stats(user)
+            if stats.daily_usage_date is None or activity_date > stats.daily_usage_date:
+                previous_date = stats.daily_usage_date
+                if previous_date is not None and self._is_low_screen_time_day(user, previous_date):
+                    stats.low_screen_time_days += 1
+
+                if previous_date is not None and activity_date - previous_date == timedelta(days=1):
+                    stats.consecutive_days += 1
+                else:
+                    stats.consecutive_days = 1
+                stats.daily_usage_date = activity_date
+
+            now = timezone.now()
+            if stats.first_usage_date is None:
+                stats.first_usage_date = now
+            stats.total_usage_months = self.months_between(stats.first_usage_date, now)
+            stats.save()
+            return self.evaluate(user, stats)
+
+    def record_chat_message(self, user):
+        """Учитывает сообщение пользователя в ИИ чате"""
+        return self._increment(user, 'ai_chat_usage_count')
+
+    def record_app_blocking(self, user):
+        """Учитывает блокировку приложения пользователем"""
+        return self._increment(user, 'app_blocking_count')
+
+    def evaluate(self, user, stats, achievement_types=None):
+        """
+        Разблокирует достижения, пороги которых достигнуты текущей статистикой.
+
+        Args:
+            user: Пользователь
+            stats (AchievementStats): Актуальная статистика пользователя
+            achievement_types (list, optional): Проверять только эти типы
+
+        Returns:
+            list[Achievement]: Только что разблокированные достижения
+        """
+        achievement_types = achievement_types or list(STAT_FIELD_BY_ACHIEVEMENT_TYPE)
+        thresholds = Q()
+        for achievement_type in achievement_types:
+            value = getattr(stats, STAT_FIELD_BY_ACHIEVEMENT_TYPE[achievement_type])
+            thresholds |= Q(achievement_type=achievement_type, required_value__lte=value)
+        unlocked = list(Achievement.objects.filter(thresholds, user=user, is_unlocked=False))
+
+        if unlocked:
+            now = timezone.now()
+            Achievement.objects.filter(id__in=[a.id for a in unlocked]).update(
+                is_unlocked=True, unlocked_at=now, updated_at=now
+            )
+            for achievement in unlocked:
+                achievement.is_unlocked = True
+                achievement.unlocked_at = now
+                achievement.updated_at = now
+        return unlocked
+
+    def _increment(self, user, field_name):
+        achievement_type = next(
+            t for t, f in STAT_FIELD_BY_ACHIEVEMENT_TYPE.items() if f == field_name
+        )
+        with transaction.atomic():
+            stats = self._get_locked_stats(user)
+            AchievementStats.objects.filter(id=stats.id).update(**{field_name: F(field_name) + 1})
+            setattr(stats, field_name, getattr(stats, field_name) + 1)
+            return self.evaluate(user, stats, [achievement_type])
+
+    def _get_locked_stats(self, user):
+        stats, _ = AchievementStats.objects.select_for_update().get_or_create(user=user)
+        return stats
+
+    def _is_low_screen_time_day(self, user, day):
+        total = DailyTimeline.objects.filter(user=user, date=day).values_list('total_screen_time_seconds', flat=True).first()
+        if total is None:
+            # После долгого перерыва прошлый день мог уйти в архив
+            archived = get_archived(DailyTimeline, day, user=user)
+            total = archived.total_screen_time_seconds if archived is not None else None
+        return total is not None and total < LOW_SCREEN_TIME_THRESHOLD_SECONDS
+
+    @staticmethod
+    def months_between(start, end):
+        months = (end.year - start.year) * 12 + (end.month - start.month)
+        if end.day < start.day:
+            months -= 1
+        return max(months, 0)
+
+
+# Глобальный экземпляр движка
+achievement_engine = AchievementEngine()
@@ -1,11 +1,29 @@
+from django.db import transaction
+from django.utils.decorators import method_decorator
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from core.query_budget import query_budget
+from .achievement_engine import STAT_FIELD_BY_ACHIEVEMENT_TYPE, achievement_engine
+from .conditional import conditional_get, achievements_etag
 from .models import Achievement, AchievementStats
 from .serializers import AchievementSerializer, AchievementSyncSerializer, AchievementStatsSerializer
+from .throttling import AchievementEventThrottle
 
 
+# Поля, которые клиент может перезаписать при синхронизации: только оформление
+ACHIEVEMENT_SYNC_FIELDS = [
+    'title', 'description', 'icon_code_point', 'icon_font_family', 'icon_font_package',
+]
+# Условие достижения задается только при создании, а разблокирует его только
+# движок (accounts.achievement_engine): клиент не может открыть достижение
+# или снизить порог
+ACHIEVEMENT_CREATE_FIELDS = ACHIEVEMENT_SYNC_FIELDS + ['achievement_type', 'required_value']
+
+
+@method_decorator(query_budget(3), name='dispatch')
+@method_decorator(conditional_get(achievements_etag), name='get')
 class AchievementListView(generics.ListAPIView):
     """Получить все достижения пользователя"""
     serializer_class = AchievementSerializer
@@ -15,6 +33,8 @@ class AchievementListView(generics.ListAPIView):
         return Achievement.objects.filter(user=self.request.user)
 
 
+# Новые достижения: чтение статистики и проверка порогов движком (до 3 запросов)
+@method_decorator(query_budget(9), name='dispatch')
 class AchievementSyncView(APIView):
     """Синхронизация достижений с клиента"""
     permission_classes = [IsAuthenticated]
@@ -27,53 +47,77 @@ class AchievementSyncView(APIView):
         achievements_data = serializer.validated_data['achievements']
         user = request.user
         
-        # Синхронизируем каждое достижение
-        synced_achievements = []
+        # Преобразуем данные из Flutter формата в Django формат.
+        # При повторе одного id в запросе побеждает последнее значение.
+        incoming = {}
         for achievement_data in achievements_data:
-            # Преобразуем данные из Flutter формата в Django формат
-            django_achievement_data = {
-                'achievement_id': achievement_data['id'],
+            incoming[str(achievement_data['id'])] = {
                 'title': achievement_data['title'],
                 'description': achievement_data['description'],
                 'icon_code_point': achievement_data['icon_code_point'],
                 'icon_font_family': achievement_data.get('icon_font_family'),
                 'icon_font_package': achievement_data.get('icon_font_package'),
-                'achievement_type': achievement_data['type'],
+                'achievement_type': achievement_data.get('type', achievement_data['achievement_type']),
                 'required_value': achievement_data['required_value'],
-                'is_unlocked': achievement_data.get('is_unlocked', False),
-                'unlocked_at': achievement_data.get('unlocked_at'),
             }
-            
-            # Получаем или создаем достижение
-            achievement, created = Achievement.objects.get_or_create(
-                user=user,
-                achievement_id=achievement_data['id'],
-                defaults=django_achievement_data
+        
+        # Одним запросом получаем текущее состояние и отбрасываем неизмененные достижения
+        existing = {
+            row['achievement_id']: row
+            for row in Achievement.objects.filter(
+                user=user, achievement_id__in=list(incoming)
+            ).values('achievement_id', *ACHIEVEMENT_SYNC_FIELDS)
+        }
+        changed = [
+            Achievement(user=user, achievement_id=achievement_id, **fields)
+            for achievement_id, fields in incoming.items()
+            if achievement_id not in existing
+            or any(existing[achievement_id][key] != fields[key] for key in ACHIEVEMENT_SYNC_FIELDS)
+        ]
+        
+        if not changed:
+            return Response([])
+        
+        with transaction.atomic():
+            Achievement.objects.bulk_create(
+                changed,
+                update_conflicts=True,
+                unique_fields=['user', 'achievement_id'],
+                update_fields=ACHIEVEMENT_SYNC_FIELDS + ['updated_at'],
             )
-            
-            # Если достижение уже существует, обновляем его
-            if not created:
-                for key, value in django_achievement_data.items():
-                    setattr(achievement, key, value)
-                achievement.save()
-            
-            synced_achievements.append(achievement)
         
-        # Возвращаем обновленные достижения
+        # Новые достижения, пороги которых уже пройдены, открывает движок
+        created_types = {
+            achievement.achievement_type for achievement in changed
+            if achievement.achievement_id not in existing
+            and achievement.achievement_type in STAT_FIELD_BY_ACHIEVEMENT_TYPE
+        }
+        stats = AchievementStats.objects.filter(user=user).first() if created_types else None
+        if stats is not None:
+            achievement_engine.evaluate(user, stats, sorted(created_types))
+        
+        # Возвращаем только измененные достижения
+        synced_achievements = Achievement.objects.filter(
+            user=user, achievement_id__in=[achievement.achievement_id for achievement in changed]
+        )
         serializer = AchievementSerializer(synced_achievements, many=True, context={'request': request})
         return Response(serializer.data)
 
 
+# Первая запись создает статистику пользователя (get_or_create с точкой сохранения)
+@method_decorator(query_budget(get=3, post=9), name='dispatch')
 class AchievementStatsView(APIView):
     """Синхронизация статистики достижений"""
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
-        serializer = AchievementStatsSerializer(data=request.data)
+        serializer = AchievementStatsSerializer(data=request.data, context={'request': request})
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
         
-        stats = serializer.save()
+        with transaction.atomic():
+            stats = serializer.save()
+            achievement_engine.evaluate(request.user, stats)
         return Response(AchievementStatsSerializer(stats).data)
     
     def get(self, request):
@@ -87,3 +131,34 @@ class AchievementStatsView(APIView):
             stats = AchievementStats.objects.create(user=request.user)
             serializer = AchievementStatsSerializer(stats)
             return Response(serializer.data)
+
+
+@method_decorator(query_budget(9), name='dispatch')
+class AchievementEventView(APIView):
+    """
+    Событие от клиента, которое сервер сам не видит (блокировка приложения).
+
+    Каждое событие прибавляет к счетчику единицу, частота ограничена
+    AchievementEventThrottle. Сообщения в ИИ чат и дни использования
+    считаются на сервере (SendMessageView, запись timeline) и событиями
+    не принимаются.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [AchievementEventThrottle]
+    
+    EVENT_HANDLERS = {
+        'app_blocking': achievement_engine.record_app_blocking,
+    }
+    
+    def post(self, request):
+        event = request.data.get('event')
+        handler = self.EVENT_HANDLERS.get(event) if isinstance(event, str) else None
+        if handler is None:
+            return Response(
+                {'error': f"Неизвестное событие. Допустимые: {', '.join(self.EVENT_HANDLERS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        unlocked = handler(request.user)
+        serializer = AchievementSerializer(unlocked, many=True, context={'request': request})
+        return Response({'unlocked_achievements': serializer.data})
@@ -1,5 +1,6 @@
 import openai
 from django.conf import settings
+from core.metrics import external_call
 from typing import Dict, Any
 
 
@@ -35,39 +36,41 @@ class AppClassificationService:
             
             if self.openai_client:
                 # Новая версия API (openai >= 1.0.0)
-                response = self.openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Ты эксперт по анализу мобильных приложений для приложения контроля привычек и цифрового благополучия. Твоя задача - классифицировать приложения на три категории с точки зрения их влияния на продуктивность и формирование здоровых цифровых привычек: полезные, вредные, бесполезные."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=500,
-                    temperature=0.3
-                )
+                with external_call('openai'):
+                    response = self.openai_client.chat.completions.create(
+                        model="gpt-3.5-turbo",
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": "Ты эксперт по анализу мобильных приложений для приложения контроля привычек и цифрового благополучия. Твоя задача - классифицировать приложения на три категории с точки зрения их влияния на продуктивность и формирование здоровых цифровых привычек: полезные, вредные, бесполезные."
+                            },
+                            {
+                                "role": "user",
+                                "content": prompt
+                            }
+                        ],
+                        max_tokens=500,
+                        temperature=0.3
+                    )
                 gpt_response = response.choices[0].message.content.strip()
             else:
                 # Старая версия API (openai < 1.0.0)
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Ты эксперт по анализу мобильных приложений для приложения контроля привычек и цифрового благополучия. Твоя задача - классифицировать приложения на три категории с точки зрения их влияния на продуктивность и формирование здоровых цифровых привычек: полезные, вредные, бесполезные."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=500,
-                    temperature=0.3
-                )
+                with external_call('openai'):
+                    response = openai.ChatCompletion.create(
+                        model="gpt-3.5-turbo",
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": "Ты эксперт по анализу мобильных приложений для приложения контроля привычек и цифрового благополучия. Твоя задача - классифицировать приложения на три категории с точки зрения их влияния на продуктивность и формирование здоровых цифровых привычек: полезные, вредные, бесполезные."
+                            },
+                            {
+                                "role": "user",
+                                "content": prompt
+                            }
+                        ],
+                        max_tokens=500,
+                        temperature=0.3
+                    )
                 gpt_response = response.choices[0].message.content.strip()
             
             # Парсим ответ
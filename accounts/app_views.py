@@ -2,28 +2,36 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from django.db import transaction
 from django.utils import timezone
+from core.query_budget import query_budget
+from .archive import restore_archived
 from .models import App, AppUsageRecord
-from .serializers import AppSerializer, AppCategoryUpdateSerializer
+from .rollups import add_app_usage
+from .serializers import AppSerializer, AppCategoryUpdateSerializer, annotate_app_usage
 from .app_classification_service import app_classification_service
+from .conditional import conditional_get, apps_etag
 
 
 # API для работы с приложениями
+@query_budget(3)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@conditional_get(apps_etag)
 def get_user_apps(request):
     """Получить все приложения пользователя"""
-    apps = App.objects.filter(user=request.user)
+    apps = annotate_app_usage(App.objects.filter(user=request.user))
     serializer = AppSerializer(apps, many=True, context={'request': request})
     return Response(serializer.data)
 
 
+@query_budget(2)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_app_details(request, app_id):
     """Получить детальную информацию о приложении"""
     try:
-        app = App.objects.get(id=app_id, user=request.user)
+        app = annotate_app_usage(App.objects.filter(user=request.user)).get(id=app_id)
         serializer = AppSerializer(app, context={'request': request})
         return Response(serializer.data)
     except App.DoesNotExist:
@@ -33,6 +41,7 @@ def get_app_details(request, app_id):
         )
 
 
+@query_budget(5)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def create_or_update_app(request):
@@ -82,6 +91,7 @@ def create_or_update_app(request):
     return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
+@query_budget(4)
 @api_view(['PATCH', 'PUT'])
 @permission_classes([IsAuthenticated])
 def update_app_category(request, app_id):
@@ -106,35 +116,44 @@ def update_app_category(request, app_id):
         )
 
 
+# Запись за архивную дату добавляет 5 запросов на возврат строки из архива,
+# транзакция записи - SAVEPOINT и RELEASE внутри тестовой транзакции
+@query_budget(14)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def update_app_usage(request, app_id):
     """Обновить статистику использования приложения"""
     try:
-        app = App.objects.get(id=app_id, user=request.user)
         usage_date = request.data.get('date', timezone.now().date())
         usage_seconds = request.data.get('usage_seconds', 0)
         sessions_count = request.data.get('sessions_count', 1)
         
-        # Создаем или обновляем запись использования
-        usage_record, created = AppUsageRecord.objects.get_or_create(
-            app=app,
-            date=usage_date,
-            defaults={
-                'usage_seconds': usage_seconds,
-                'sessions_count': sessions_count
-            }
-        )
-        
-        if not created:
-            usage_record.usage_seconds += usage_seconds
-            usage_record.sessions_count += sessions_count
-            usage_record.save()
-        
-        # Обновляем общую статистику приложения
-        app.total_usage_seconds += usage_seconds
-        app.last_used = timezone.now()
-        app.save()
+        # Блокировка приложения сериализует обновления его использования:
+        # запись за день, итоги периодов и total_usage_seconds меняются вместе
+        with transaction.atomic():
+            app = App.objects.select_for_update().get(id=app_id, user=request.user)
+            
+            # Создаем или обновляем запись использования
+            restore_archived(AppUsageRecord, usage_date, app=app)
+            usage_record, created = AppUsageRecord.objects.get_or_create(
+                app=app,
+                date=usage_date,
+                defaults={
+                    'usage_seconds': usage_seconds,
+                    'sessions_count': sessions_count
+                }
+            )
+            
+            if not created:
+                usage_record.usage_seconds += usage_seconds
+                usage_record.sessions_count += sessions_count
+                usage_record.save()
+            add_app_usage(app.id, usage_date, usage_seconds, sessions_count)
+            
+            # Обновляем общую статистику приложения
+            app.total_usage_seconds += usage_seconds
+            app.last_used = timezone.now()
+            app.save()
         
         return Response({'status': 'success'})
         
@@ -0,0 +1,134 @@
+"""
+Горячее и архивное хранение дневной истории.
+
+AppUsageRecord и DailyTimeline держат только последние HISTORY_HOT_DAYS
+дней: более старые строки команда archive_history целыми месяцами переносит
+в AppUsageRecordArchive и DailyTimelineArchive. Экраны приложения читают
+окна последних дней, поэтому горячие таблицы, их индексы и стоимость VACUUM
+не растут вместе с историей.
+
+Архив только для чтения: запись за архивную дату сначала возвращает строку
+в горячую таблицу (restore_archived), и дельта-синхронизация видит
+изменение по updated_at.
+"""
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, Value, When
+
+from .models import AppUsageRecord, AppUsageRecordArchive, DailyTimeline, DailyTimelineArchive
+from .retention import raw_delete
+
+ARCHIVE_MODELS = {
+    AppUsageRecord: AppUsageRecordArchive,
+    DailyTimeline: DailyTimelineArchive,
+}
+
+# annotate_app_usage считает usage_month по горячей таблице за 30 дней
+MIN_HOT_DAYS = 31
+
+
+def hot_cutoff(today=None):
+    """Первая дата, которая гарантированно хранится в горячей таблице"""
+    days = max(settings.HISTORY_HOT_DAYS, MIN_HOT_DAYS)
+    return (today or date.today()) - timedelta(days=days)
+
+
+def archive_boundary(today=None):
+    """Начало месяца hot_cutoff: архивируются только целые месяцы до него"""
+    return hot_cutoff(today).replace(day=1)
+
+
+def _as_date(value):
+    return models.DateField().to_python(value)
+
+
+def _copy_values(instance, target_model):
+    """Значения общих полей instance для создания строки target_model"""
+    target_fields = {field.attname for field in target_model._meta.concrete_fields}
+    return {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if field.attname in target_fields
+    }
+
+
+def _keep_created_at(model, archived_rows):
+    """
+    Возвращает исходный created_at строкам, вставленным из архива.
+
+    auto_now_add перезаписывает его при вставке; updated_at остается новым,
+    чтобы синхронизация заново отдала возвращенные строки.
+    """
+    if not any(field.name == 'created_at' for field in model._meta.concrete_fields):
+        return
+    model.objects.filter(pk__in=[row.pk for row in archived_rows]).update(created_at=Case(
+        *[When(pk=row.pk, then=Value(row.created_at)) for row in archived_rows]
+    ))
+
+
+def get_archived(model, day, **lookup):
+    """
+    Архивная строка model за день или None.
+
+    Для дат горячего окна архив не запрашивается.
+    """
+    day = _as_date(day)
+    if day >= hot_cutoff():
+        return None
+    return ARCHIVE_MODELS[model].objects.filter(date=day, **lookup).first()
+
+
+def restore_archived(model, day, **lookup):
+    """Переносит архивную строку за день обратно в горячую таблицу перед записью"""
+    day = _as_date(day)
+    if day >= hot_cutoff():
+        return None
+    archive_model = ARCHIVE_MODELS[model]
+    with transaction.atomic():
+        archived = archive_model.objects.select_for_update().filter(date=day, **lookup).first()
+        if archived is None:
+            return None
+        restored = model.objects.create(**_copy_values(archived, model))
+        _keep_created_at(model, [archived])
+        raw_delete(archive_model.objects.filter(pk=archived.pk))
+    return restored
+
+
+def archive_rows(model, before, batch_size=1000):
+    """Переносит строки model с датой раньше before в архив, возвращает их число"""
+    archive_model = ARCHIVE_MODELS[model]
+    moved = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                model.objects.select_for_update().filter(date__lt=before).order_by('pk')[:batch_size]
+            )
+            if not batch:
+                break
+            archive_model.objects.bulk_create([
+                archive_model(**_copy_values(row, archive_model)) for row in batch
+            ])
+            raw_delete(model.objects.filter(pk__in=[row.pk for row in batch]))
+        moved += len(batch)
+    return moved
+
+
+def restore_rows(model, start, end, batch_size=1000):
+    """Возвращает архивные строки с датами [start, end) в горячую таблицу"""
+    archive_model = ARCHIVE_MODELS[model]
+    restored = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                archive_model.objects.select_for_update()
+                .filter(date__gte=start, date__lt=end).order_by('pk')[:batch_size]
+            )
+            if not batch:
+                break
+            model.objects.bulk_create([model(**_copy_values(row, model)) for row in batch])
+            _keep_created_at(model, batch)
+            archive_model.objects.filter(pk__in=[row.pk for row in batch]).delete()
+        restored += len(batch)
+    return restored
@@ -0,0 +1,68 @@
+import re
+
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import normalize_email, normalize_phone
+from .tokens import user_from_claims
+
+User = get_user_model()
+
+# Логин похож на телефон, только если в нем нет ничего, кроме цифр и разделителей
+PHONE_LOGIN_RE = re.compile(r'^\+?[\d\s()-]{10,}$')
+
+
+def authenticate_credentials(login, password):
+    """
+    Находит пользователя по username, email или телефону и проверяет пароль.
+
+    Все варианты логина ищутся одним запросом по индексированным полям,
+    пароль хешируется ровно один раз. При совпадении с несколькими аккаунтами
+    приоритет у username, затем email, затем телефона. Если пользователь не
+    найден, пароль все равно хешируется, чтобы время ответа не выдавало,
+    существует ли аккаунт.
+    """
+    lookups = [('username', login)]
+    if '@' in login:
+        lookups.append(('email_normalized', normalize_email(login)))
+    if PHONE_LOGIN_RE.match(login):
+        lookups.append(('phone_e164', normalize_phone(login)))
+
+    query = Q()
+    for field, value in lookups:
+        query |= Q(**{field: value})
+    candidates = list(User.objects.filter(query)[:len(lookups)])
+
+    user = None
+    for field, value in lookups:
+        user = next((candidate for candidate in candidates if getattr(candidate, field) == value), None)
+        if user is not None:
+            break
+
+    if user is None:
+        User().set_password(password)
+        return None
+    if not user.check_password(password) or not user.is_active:
+        return None
+    return user
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    JWT аутентификация без запроса пользователя к БД на каждый запрос.
+
+    request.user собирается из claims access токена (id и поля подписки),
+    остальные поля загружаются одним запросом только если view к ним
+    обратится. Проверки существования и is_active не выполняются: удаленный
+    или заблокированный пользователь теряет доступ по истечении access токена.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+        return user_from_claims(user_id, validated_token.payload)
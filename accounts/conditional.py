@@ -0,0 +1,83 @@
+import hashlib
+from datetime import date
+from functools import wraps
+
+from django.db.models import Count, Max
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from .models import Achievement, App, DailyNote, Habit, UserExperience
+
+
+def make_etag(*parts):
+    """Строит ETag из набора значений версии"""
+    raw = '|'.join(str(part) for part in parts)
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def collection_etag(queryset, timestamp_field='updated_at', *extra):
+    """
+    Дешевая версия коллекции: максимальная метка времени и количество строк.
+
+    Количество учитывает удаления, метка времени - изменения и добавления.
+    Выполняется одним агрегирующим запросом без сериализации данных.
+    """
+    stamp = queryset.aggregate(last=Max(timestamp_field), total=Count('pk'))
+    return make_etag(stamp['last'], stamp['total'], *extra)
+
+
+def conditional_get(etag_func):
+    """
+    Декоратор для GET эндпоинтов пользователя.
+
+    Отвечает 304 Not Modified на If-None-Match, если версия данных не изменилась,
+    не вызывая сам view и сериализаторы. Ответ помечается как приватный и
+    требующий перепроверки, чтобы клиент всегда присылал If-None-Match.
+    """
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_vary_headers(response, ['Authorization'])
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+def achievements_etag(request, *args, **kwargs):
+    return collection_etag(Achievement.objects.filter(user=request.user), 'updated_at', request.user.pk)
+
+
+def apps_etag(request, *args, **kwargs):
+    # usage_today/week/month зависят от текущей даты
+    return collection_etag(App.objects.filter(user=request.user), 'last_used', request.user.pk, date.today())
+
+
+def habits_etag(request, *args, **kwargs):
+    return collection_etag(
+        Habit.objects.filter(user=request.user), 'updated_at',
+        request.user.pk, request.query_params.get('type', '')
+    )
+
+
+def daily_notes_etag(request, *args, **kwargs):
+    # app_usage заметок берется из AppUsageRecord: запись использования
+    # обновляет last_used приложения
+    apps = App.objects.filter(user=request.user).aggregate(last=Max('last_used'))
+    return collection_etag(
+        DailyNote.objects.filter(user=request.user), 'updated_at', request.user.pk, apps['last']
+    )
+
+
+def user_profile_etag(request, *args, **kwargs):
+    user = request.user
+    experience = UserExperience.objects.filter(user=user).aggregate(last=Max('updated_at'), total=Count('pk'))
+    return make_etag(
+        user.pk, user.username, user.first_name, user.last_name, user.email, user.phone_number,
+        user.avatar.name if user.avatar else '', user.has_subscription, user.subscription_type,
+        user.subscription_start_date, user.subscription_end_date, user.subscription_auto_renew,
+        user.date_joined, experience['last'], experience['total'],
+    )
@@ -1,9 +1,12 @@
+from django.utils.decorators import method_decorator
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from core.query_budget import query_budget
 from .models import UserExperience
 
 
+@method_decorator(query_budget(5), name='dispatch')
 class ExperienceView(APIView):
     """API для работы с опытом пользователя"""
     permission_classes = [IsAuthenticated]
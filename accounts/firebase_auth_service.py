@@ -1,18 +1,274 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
 import firebase_admin
+import jwt
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
 from firebase_admin import credentials, auth as firebase_auth
 from django.conf import settings
+from django.core.cache import cache
+from core.metrics import external_call
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Сертификаты, которыми Google подписывает Firebase ID токены
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+
+class FirebaseTokenError(ValueError):
+    """Firebase ID токен недействителен или истек"""
+
+
+class FirebaseTokenVerifier:
+    """
+    Локальная проверка Firebase ID токенов.
+
+    Публичные ключи Google хранятся в памяти процесса столько, сколько
+    разрешает Cache-Control max-age. Незадолго до истечения они обновляются
+    в фоновом потоке, поэтому запросы блокируются на загрузке сертификатов
+    только при самом первом обращении и при неизвестном kid (Google сменил
+    ключи раньше max-age). Синхронно загружает один поток, остальные ждут
+    его результата; после неудачной загрузки следующая попытка откладывается
+    с экспоненциальной задержкой, а повторная загрузка из-за неизвестного kid
+    возможна не чаще MIN_REFRESH_INTERVAL_SECONDS. Для тестов набор ключей
+    можно передать напрямую через key_set / set_key_set().
+    """
+
+    REFRESH_MARGIN_SECONDS = 300  # Начинаем обновление за 5 минут до истечения
+    DEFAULT_MAX_AGE_SECONDS = 3600
+    FETCH_TIMEOUT_SECONDS = 5
+    CLOCK_SKEW_SECONDS = 60
+    MIN_REFRESH_INTERVAL_SECONDS = 60
+    MAX_RETRY_DELAY_SECONDS = 300
+
+    def __init__(self, project_id=None, certs_url=GOOGLE_CERTS_URL, key_set=None):
+        self._project_id = project_id
+        self._certs_url = certs_url
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._keys = {}
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._auto_refresh = True
+        self._last_fetch = float('-inf')
+        self._failures = 0
+        self._retry_at = 0.0
+        self._session = requests.Session()
+        if key_set is not None:
+            self.set_key_set(key_set)
+
+    def set_key_set(self, key_set, max_age=None):
+        """
+        Устанавливает набор ключей вручную (например, локальные ключи в тестах).
+
+        Args:
+            key_set (dict): kid -> PEM сертификат, PEM публичный ключ или объект ключа
+            max_age (int, optional): Время жизни набора; без него набор не обновляется
+        """
+        keys = {kid: self._load_key(value) for kid, value in key_set.items()}
+        expires_at = time.monotonic() + max_age if max_age is not None else float('inf')
+        with self._lock:
+            self._keys = keys
+            self._expires_at = expires_at
+            self._auto_refresh = max_age is not None
+            self._last_fetch = time.monotonic()
+
+    def verify(self, id_token):
+        """
+        Проверяет подпись и claims Firebase ID токена.
+
+        Returns:
+            dict: Декодированный токен, uid продублирован из sub
+
+        Raises:
+            FirebaseTokenError: Если токен недействителен или истек
+        """
+        project_id = self._get_project_id()
+        if not project_id:
+            raise FirebaseTokenError('Firebase project id is not configured')
+
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except jwt.PyJWTError as e:
+            raise FirebaseTokenError(f'Malformed Firebase ID token: {e}')
+
+        if header.get('alg') != 'RS256':
+            raise FirebaseTokenError('Firebase ID token has incorrect algorithm')
+
+        key = self._get_key(header.get('kid'))
+        if key is None:
+            raise FirebaseTokenError('Firebase ID token has unknown key id')
+
+        try:
+            decoded_token = jwt.decode(
+                id_token,
+                key,
+                algorithms=['RS256'],
+                audience=project_id,
+                issuer=f'https://securetoken.google.com/{project_id}',
+                leeway=self.CLOCK_SKEW_SECONDS,
+                options={'require': ['exp', 'iat', 'aud', 'iss', 'sub']},
+            )
+        except jwt.ExpiredSignatureError:
+            raise FirebaseTokenError('Firebase ID token has expired')
+        except jwt.PyJWTError as e:
+            raise FirebaseTokenError(f'Invalid Firebase ID token: {e}')
+
+        subject = decoded_token['sub']
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise FirebaseTokenError('Firebase ID token has invalid subject')
+        if decoded_token.get('auth_time', 0) > time.time() + self.CLOCK_SKEW_SECONDS:
+            raise FirebaseTokenError('Firebase ID token has future auth_time')
+
+        decoded_token['uid'] = subject
+        return decoded_token
+
+    def _get_key(self, kid):
+        if not self._keys:
+            # Холодный старт или все прошлые загрузки неудачны
+            self._refresh_now()
+            if not self._keys:
+                raise FirebaseTokenError('Firebase public keys are unavailable')
+        elif time.monotonic() >= self._expires_at - self.REFRESH_MARGIN_SECONDS:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if (key is None and self._auto_refresh
+                and time.monotonic() >= self._last_fetch + self.MIN_REFRESH_INTERVAL_SECONDS):
+            self._refresh_now()
+            key = self._keys.get(kid)
+        return key
+
+    def _refresh_now(self):
+        """Синхронная загрузка, если ее только что не выполнил другой поток"""
+        requested_at = time.monotonic()
+        with self._fetch_lock:
+            if self._last_fetch >= requested_at or time.monotonic() < self._retry_at:
+                return
+            self._refresh()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True, name='firebase-certs-refresh').start()
+
+    def _background_refresh(self):
+        try:
+            self._refresh_now()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh(self):
+        self._last_fetch = time.monotonic()
+        try:
+            with external_call('firebase_certs'):
+                response = self._session.get(self._certs_url, timeout=self.FETCH_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            keys = {kid: self._load_key(cert) for kid, cert in response.json().items()}
+            max_age = self._parse_max_age(response.headers.get('Cache-Control', ''))
+            with self._lock:
+                self._keys = keys
+                self._expires_at = time.monotonic() + max_age
+                self._failures = 0
+                self._retry_at = 0.0
+            logger.info("Сертификаты Firebase обновлены, kid: %s, max-age: %s", list(keys), max_age)
+        except Exception as e:
+            # Продолжаем работать со старыми ключами, следующая попытка - после задержки
+            with self._lock:
+                self._failures += 1
+                delay = min(2 ** self._failures, self.MAX_RETRY_DELAY_SECONDS)
+                self._retry_at = time.monotonic() + delay
+            logger.error("Ошибка загрузки сертификатов Firebase: %s, повтор через %s с", e, delay)
+
+    def _parse_max_age(self, cache_control):
+        match = re.search(r'max-age=(\d+)', cache_control)
+        return int(match.group(1)) if match else self.DEFAULT_MAX_AGE_SECONDS
+
+    @staticmethod
+    def _load_key(value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if not isinstance(value, bytes):
+            return value
+        if b'BEGIN CERTIFICATE' in value:
+            return x509.load_pem_x509_certificate(value).public_key()
+        return serialization.load_pem_public_key(value)
+
+    def _get_project_id(self):
+        project_id = self._project_id or getattr(settings, 'FIREBASE_PROJECT_ID', None)
+        if project_id:
+            return project_id
+
+        # Берем project_id из файла сервисного аккаунта
+        firebase_credentials = getattr(settings, 'FIREBASE_CREDENTIALS', None)
+        if isinstance(firebase_credentials, dict):
+            self._project_id = firebase_credentials.get('project_id')
+        elif firebase_credentials:
+            try:
+                with open(firebase_credentials) as f:
+                    self._project_id = json.load(f).get('project_id')
+            except (OSError, ValueError) as e:
+                logger.error("Не удалось прочитать project_id из %s: %s", firebase_credentials, e)
+        return self._project_id
+
+
+class VerifiedTokenCache:
+    """
+    Кеш уже проверенных Firebase ID токенов.
+
+    Клиенты повторяют вход с тем же токеном при плохой сети. По sha256
+    токена хранится результат первого успешного входа (id пользователя и
+    данные для ответа) до истечения exp токена, поэтому повтор не требует
+    криптографии. Токены, которые ни разу не прошли проверку, в кеш не
+    попадают и проверяются как обычно. Записи пользователя удаляются
+    (forget_user) при удалении или деактивации аккаунта.
+    """
+
+    KEY_PREFIX = 'firebase_verified_token_'
+    USER_KEY_PREFIX = 'firebase_verified_user_'
+    # Firebase ID токен живет час: список ключей пользователя не нужен дольше
+    USER_KEYS_TIMEOUT = 3600
+
+    def get(self, id_token):
+        return cache.get(self._key(id_token))
+
+    def remember(self, id_token, decoded_token, login_data):
+        timeout = int(decoded_token.get('exp', 0) - time.time())
+        if timeout > 0:
+            key = self._key(id_token)
+            cache.set(key, login_data, timeout=timeout)
+            user_key = self.USER_KEY_PREFIX + str(login_data['user']['id'])
+            cache.set(user_key, cache.get(user_key, []) + [key], timeout=self.USER_KEYS_TIMEOUT)
+
+    def forget(self, id_token):
+        cache.delete(self._key(id_token))
+
+    def forget_user(self, user_id):
+        """Удаляет все кешированные входы пользователя"""
+        user_key = self.USER_KEY_PREFIX + str(user_id)
+        cache.delete_many(cache.get(user_key, []) + [user_key])
+
+    def _key(self, id_token):
+        return self.KEY_PREFIX + hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+
 class FirebaseAuthService:
     """Сервис для работы с Firebase Authentication"""
     
-    def __init__(self):
-        self._initialize_firebase()
+    def __init__(self, token_verifier=None):
+        self.token_verifier = token_verifier or firebase_token_verifier
     
     def _initialize_firebase(self):
-        """Инициализация Firebase Admin SDK"""
+        """Инициализация Firebase Admin SDK (нужна только для операций управления пользователями)"""
         if not firebase_admin._apps:
             try:
                 # Для продакшена используем переменную окружения с JSON ключом
@@ -32,7 +288,7 @@ class FirebaseAuthService:
                 firebase_admin.initialize_app(cred)
                 logger.info("Firebase Admin SDK инициализирован успешно")
             except Exception as e:
-                logger.error(f"Ошибка инициализации Firebase: {e}")
+                logger.error("Ошибка инициализации Firebase: %s", e)
                 raise
     
     def verify_id_token(self, id_token):
@@ -46,21 +302,17 @@ class FirebaseAuthService:
             dict: Данные пользователя из Firebase
             
         Raises:
-            firebase_auth.InvalidIdTokenError: Если токен недействителен
-            firebase_auth.ExpiredIdTokenError: Если токен истек
+            FirebaseTokenError: Если токен недействителен или истек
         """
         try:
-            decoded_token = firebase_auth.verify_id_token(id_token)
-            logger.info(f"Firebase токен проверен для пользователя: {decoded_token.get('uid')}")
+            decoded_token = self.token_verifier.verify(id_token)
+            logger.debug("Firebase токен проверен для пользователя: %s", decoded_token.get('uid'))
             return decoded_token
-        except firebase_auth.InvalidIdTokenError as e:
-            logger.error(f"Недействительный Firebase токен: {e}")
-            raise
-        except firebase_auth.ExpiredIdTokenError as e:
-            logger.error(f"Истекший Firebase токен: {e}")
+        except FirebaseTokenError as e:
+            logger.error("Недействительный Firebase токен: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Ошибка проверки Firebase токена: {e}")
+            logger.error("Ошибка проверки Firebase токена: %s", e)
             raise
     
     def get_user_by_uid(self, uid):
@@ -74,13 +326,15 @@ class FirebaseAuthService:
             firebase_auth.UserRecord: Данные пользователя
         """
         try:
-            user_record = firebase_auth.get_user(uid)
+            self._initialize_firebase()
+            with external_call('firebase'):
+                user_record = firebase_auth.get_user(uid)
             return user_record
         except firebase_auth.UserNotFoundError as e:
-            logger.error(f"Пользователь не найден в Firebase: {e}")
+            logger.error("Пользователь не найден в Firebase: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Ошибка получения пользователя из Firebase: {e}")
+            logger.error("Ошибка получения пользователя из Firebase: %s", e)
             raise
     
     def create_user(self, phone_number, display_name=None):
@@ -95,14 +349,16 @@ class FirebaseAuthService:
             firebase_auth.UserRecord: Созданный пользователь
         """
         try:
-            user_record = firebase_auth.create_user(
-                phone_number=phone_number,
-                display_name=display_name
-            )
-            logger.info(f"Пользователь создан в Firebase: {user_record.uid}")
+            self._initialize_firebase()
+            with external_call('firebase'):
+                user_record = firebase_auth.create_user(
+                    phone_number=phone_number,
+                    display_name=display_name
+                )
+            logger.info("Пользователь создан в Firebase: %s", user_record.uid)
             return user_record
         except Exception as e:
-            logger.error(f"Ошибка создания пользователя в Firebase: {e}")
+            logger.error("Ошибка создания пользователя в Firebase: %s", e)
             raise
     
     def update_user_phone(self, uid, phone_number):
@@ -114,10 +370,12 @@ class FirebaseAuthService:
             phone_number (str): Новый номер телефона
         """
         try:
-            firebase_auth.update_user(uid, phone_number=phone_number)
-            logger.info(f"Номер телефона обновлен для пользователя: {uid}")
+            self._initialize_firebase()
+            with external_call('firebase'):
+                firebase_auth.update_user(uid, phone_number=phone_number)
+            logger.info("Номер телефона обновлен для пользователя: %s", uid)
         except Exception as e:
-            logger.error(f"Ошибка обновления номера телефона: {e}")
+            logger.error("Ошибка обновления номера телефона: %s", e)
             raise
     
     def delete_user(self, uid):
@@ -128,10 +386,12 @@ class FirebaseAuthService:
             uid (str): Firebase UID пользователя
         """
         try:
-            firebase_auth.delete_user(uid)
-            logger.info(f"Пользователь удален из Firebase: {uid}")
+            self._initialize_firebase()
+            with external_call('firebase'):
+                firebase_auth.delete_user(uid)
+            logger.info("Пользователь удален из Firebase: %s", uid)
         except Exception as e:
-            logger.error(f"Ошибка удаления пользователя из Firebase: {e}")
+            logger.error("Ошибка удаления пользователя из Firebase: %s", e)
             raise
     
     def verify_phone_number_token(self, id_token):
@@ -163,16 +423,11 @@ class FirebaseAuthService:
             'picture': decoded_token.get('picture'),
             'email_verified': decoded_token.get('email_verified', False),
             'phone_verified': True,
+            'exp': decoded_token.get('exp'),
         }
 
 
-
-
-
-
-
-
-
-
-
-
+# Глобальные экземпляры на процесс: ключи Google и состояние SDK переиспользуются между запросами
+firebase_token_verifier = FirebaseTokenVerifier()
+verified_token_cache = VerifiedTokenCache()
+firebase_auth_service = FirebaseAuthService()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from accounts.retention import POLICIES, BatchDeleter, apply_retention
+
+
+class Command(BaseCommand):
+    help = 'Удаляет данные старше сроков RETENTION_*_DAYS пачками (политики: ' + ', '.join(POLICIES) + ')'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--policy', action='append', dest='policies', choices=list(POLICIES),
+            help='Применить только эту политику, можно несколько',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк в одном DELETE')
+        parser.add_argument('--pause', type=float, default=0.1, help='Пауза между пачками, секунд')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать количество строк')
+
+    def handle(self, *args, **options):
+        deleter = BatchDeleter(options['batch_size'], options['pause'], options['dry_run'])
+        results = apply_retention(deleter, options['policies'])
+        if not results:
+            self.stdout.write('Нет включенных политик')
+        action = 'Подлежит удалению' if options['dry_run'] else 'Удалено'
+        for policy, counts in results.items():
+            details = ', '.join(f'{model}: {count}' for model, count in counts.items())
+            self.stdout.write(self.style.SUCCESS(f'{policy}: {action.lower()} {details}'))
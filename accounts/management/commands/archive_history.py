@@ -0,0 +1,58 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+
+from accounts.archive import ARCHIVE_MODELS, archive_boundary, archive_rows, restore_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит AppUsageRecord и DailyTimeline старше HISTORY_HOT_DAYS в архивные таблицы '
+        'целыми месяцами или возвращает месяц из архива (--restore)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--restore', metavar='YYYY-MM', help='Вернуть месяц из архива в горячие таблицы')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать количество строк по месяцам')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['restore']:
+            start = self._parse_month(options['restore'])
+            end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        else:
+            start, end = None, archive_boundary()
+
+        for model, archive_model in ARCHIVE_MODELS.items():
+            if options['dry_run']:
+                source = model if start is None else archive_model
+                rows = source.objects.filter(date__lt=end)
+                if start is not None:
+                    rows = rows.filter(date__gte=start)
+                self._print_months(source, rows)
+            elif start is None:
+                count = archive_rows(model, end, batch_size)
+                self.stdout.write(self.style.SUCCESS(f'{model.__name__}: в архив до {end} перенесено {count}'))
+            else:
+                count = restore_rows(model, start, end, batch_size)
+                self.stdout.write(self.style.SUCCESS(f'{model.__name__}: из архива возвращено {count}'))
+
+    def _print_months(self, source, rows):
+        months = (
+            rows.annotate(month=TruncMonth('date')).values('month')
+            .annotate(count=Count('pk')).order_by('month')
+        )
+        self.stdout.write(f'{source.__name__}:')
+        for row in months:
+            self.stdout.write(f'  {row["month"]:%Y-%m}: {row["count"]}')
+
+    @staticmethod
+    def _parse_month(value):
+        try:
+            year, month = (int(part) for part in value.split('-'))
+            return date(year, month, 1)
+        except ValueError:
+            raise CommandError(f'Месяц в формате YYYY-MM, получено: {value}')
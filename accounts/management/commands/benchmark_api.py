@@ -0,0 +1,278 @@
+import json
+import random
+import statistics
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import date, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from accounts.firebase_auth_service import firebase_token_verifier
+from accounts.models import (
+    Achievement, App, AppUsageRecord, ChatMessage, ChatSession, DailyTimeline, User, UserExperience,
+)
+from accounts.sms_dispatcher import SmsDispatcher
+from accounts.sms_providers import FakeSMSProvider, SMSRouter
+from accounts.throttling import SlidingWindowThrottle
+from accounts.tokens import UserRefreshToken
+
+BENCHMARK_FIREBASE_PROJECT = 'benchmark-project'
+BENCHMARK_FIREBASE_KID = 'benchmark-key'
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон основных эндпоинтов в процессе: создает тестовую БД, '
+        'заполняет ее данными и выводит req/s, p50/p99 и запросы к БД на запрос'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=3, help='Пользователей с данными')
+        parser.add_argument('--apps', type=int, default=150, help='Приложений на пользователя')
+        parser.add_argument('--days', type=int, default=90, help='Дней истории (timeline, usage, опыт)')
+        parser.add_argument('--sessions', type=int, default=5, help='Чатов на пользователя')
+        parser.add_argument('--messages', type=int, default=200, help='Сообщений в чате')
+        parser.add_argument('--requests', type=int, default=50, help='Запросов на эндпоинт')
+        parser.add_argument('--warmup', type=int, default=5, help='Запросов прогрева на эндпоинт')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--only', nargs='*', help='Запустить только эти эндпоинты')
+        parser.add_argument('--json', action='store_true', help='Вывести результат в JSON')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        old_name = connection.settings_dict['NAME']
+        # Отдельная тестовая БД того же движка (SQLite или Postgres), рабочая не трогается
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with self._local_stubs():
+                users = self._seed(options)
+                results = self._run(users, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self._print_table(results)
+
+    # Данные
+
+    def _seed(self, options):
+        today = date.today()
+        days = [today - timedelta(days=offset) for offset in range(options['days'])]
+        users = []
+        for index in range(options['users']):
+            user = User.objects.create_user(
+                username=f'bench_user_{index}', phone_number=f'7999{index:07d}', password=None,
+            )
+
+            apps = App.objects.bulk_create([
+                App(
+                    user=user, package_name=f'com.bench.app{app_index}', app_name=f'App {app_index}',
+                    category=self.rng.choice(['useful', 'harmful', 'useless']),
+                    total_usage_seconds=self.rng.randint(0, 500000),
+                )
+                for app_index in range(options['apps'])
+            ])
+            AppUsageRecord.objects.bulk_create([
+                AppUsageRecord(
+                    app=app, date=day, usage_seconds=self.rng.randint(0, 3600),
+                    sessions_count=self.rng.randint(0, 20),
+                )
+                for app in apps for day in days
+            ], batch_size=5000)
+
+            timelines = []
+            for day in days:
+                timeline = DailyTimeline(user=user, date=day, sessions_count=self.rng.randint(0, 30))
+                for segment in range(15):
+                    timeline.set_segment_data(segment, self.rng.randint(0, 3600), self.rng.randint(0, 3600))
+                timeline.update_totals()
+                timelines.append(timeline)
+            DailyTimeline.objects.bulk_create(timelines)
+
+            total = 0
+            experience = []
+            for day in reversed(days):
+                daily = self.rng.randint(0, 500)
+                total += daily
+                experience.append(UserExperience(
+                    user=user, date=day, total_experience=total, daily_experience=daily,
+                    segments_completed=self.rng.randint(0, 15),
+                ))
+            UserExperience.objects.bulk_create(experience)
+
+            Achievement.objects.bulk_create([
+                Achievement(
+                    user=user, achievement_id=f'achievement_{number}', title=f'Achievement {number}',
+                    description='Benchmark achievement', icon_code_point=57000 + number,
+                    achievement_type=achievement_type, required_value=number + 1,
+                )
+                for number, achievement_type in enumerate(
+                    [choice for choice, _ in Achievement.ACHIEVEMENT_TYPES] * 4
+                )
+            ])
+
+            for session_index in range(options['sessions']):
+                session = ChatSession.objects.create(user=user, title=f'Chat {session_index}')
+                ChatMessage.objects.bulk_create([
+                    ChatMessage(
+                        session=session, role='user' if message_index % 2 == 0 else 'assistant',
+                        content=f'Message {message_index} ' + 'lorem ipsum ' * self.rng.randint(5, 50),
+                    )
+                    for message_index in range(options['messages'])
+                ], batch_size=1000)
+
+            users.append(user)
+        return users
+
+    # Заглушки внешних сервисов
+
+    def _local_stubs(self):
+        """OpenAI, Firebase и SMS отвечают локально, без сети"""
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.firebase_private_key = private_key
+
+        def openai_create(**kwargs):
+            message = SimpleNamespace(content='Ответ заглушки OpenAI для нагрузочного теста.')
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+        patches = [
+            mock.patch.multiple(
+                firebase_token_verifier,
+                _project_id=BENCHMARK_FIREBASE_PROJECT,
+                _keys={BENCHMARK_FIREBASE_KID: private_key.public_key()},
+                _expires_at=float('inf'),
+            ),
+            mock.patch(
+                'accounts.services.openai',
+                SimpleNamespace(api_key=None, ChatCompletion=SimpleNamespace(create=openai_create)),
+            ),
+            mock.patch(
+                'accounts.sms_dispatcher._dispatcher',
+                SmsDispatcher(SMSRouter([FakeSMSProvider()], rate_limit=0)),
+            ),
+            # Лимиты частоты отклонили бы повторяющиеся запросы с одного адреса
+            mock.patch.object(SlidingWindowThrottle, 'allow_request', lambda self, request, view: True),
+            override_settings(SMS_PROVIDER='fake', METRICS_SAMPLE_RATE=0),
+        ]
+        stack = ExitStack()
+        for patch in patches:
+            stack.enter_context(patch)
+        return stack
+
+    def _firebase_token(self, phone_number):
+        now = int(time.time())
+        uid = uuid.uuid4().hex
+        return jwt.encode({
+            'iss': f'https://securetoken.google.com/{BENCHMARK_FIREBASE_PROJECT}',
+            'aud': BENCHMARK_FIREBASE_PROJECT,
+            'sub': uid,
+            'iat': now,
+            'exp': now + 3600,
+            'auth_time': now,
+            'phone_number': phone_number,
+            'firebase': {'identities': {'phone': [phone_number]}, 'sign_in_provider': 'phone'},
+        }, self.firebase_private_key, algorithm='RS256', headers={'kid': BENCHMARK_FIREBASE_KID})
+
+    # Прогон
+
+    def _endpoints(self, user):
+        session = user.chat_sessions.first()
+        days = list(DailyTimeline.objects.filter(user=user).values_list('date', flat=True))
+        achievements = [
+            {
+                'id': f'achievement_{number}', 'title': f'Achievement {number}',
+                'description': 'Benchmark achievement', 'icon_code_point': 57000 + number,
+                'achievement_type': 'daily_streak', 'required_value': number + 1,
+                'is_unlocked': number % 3 == 0,
+            }
+            for number in range(20)
+        ]
+        counter = iter(range(10 ** 9))
+
+        def phone():
+            return f'+7998{next(counter):07d}'
+
+        def firebase_login():
+            number = phone()
+            return {'phone_number': number, 'firebase_id_token': self._firebase_token(number)}
+
+        # имя -> (метод, путь, фабрика тела запроса, нужна ли авторизация)
+        return {
+            'apps': ('get', lambda: '/api/apps/', None, True),
+            'timeline': ('get', lambda: f'/api/timeline/?date={self.rng.choice(days)}', None, True),
+            'experience': ('get', lambda: '/api/experience/', None, True),
+            'achievements_sync': ('post', lambda: '/api/achievements/sync/', lambda: {'achievements': achievements}, True),
+            'chat_sessions': ('get', lambda: '/api/chat/sessions/', None, True),
+            'chat_send': ('post', lambda: f'/api/chat/sessions/{session.id}/send/', lambda: {'content': 'Привет'}, True),
+            'sync': ('get', lambda: '/api/sync/', None, True),
+            'sms_send': ('post', lambda: '/api/auth/sms/send/', lambda: {'phone_number': phone()}, False),
+            'firebase_login': ('post', lambda: '/api/auth/firebase/phone/', firebase_login, False),
+        }
+
+    def _run(self, users, options):
+        clients = []
+        for user in users:
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(user).access_token}')
+            clients.append(client)
+        anonymous = APIClient()
+
+        results = []
+        for name, (method, path, payload, authenticated) in self._endpoints(users[0]).items():
+            if options['only'] and name not in options['only']:
+                continue
+
+            def call(index):
+                client = clients[index % len(clients)] if authenticated else anonymous
+                data = payload() if payload else None
+                return getattr(client, method)(path(), data, format='json' if data is not None else None)
+
+            for index in range(options['warmup']):
+                call(index)
+
+            # Запросы к БД считаются отдельным вызовом, чтобы не искажать время
+            queries = []
+            with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+                response = call(0)
+            status_code = response.status_code
+
+            timings = []
+            started = time.perf_counter()
+            for index in range(options['requests']):
+                request_started = time.perf_counter()
+                call(index)
+                timings.append(time.perf_counter() - request_started)
+            elapsed = time.perf_counter() - started
+
+            timings.sort()
+            results.append({
+                'endpoint': name,
+                'status': status_code,
+                'requests': len(timings),
+                'rps': round(len(timings) / elapsed, 1) if elapsed else 0,
+                'p50_ms': round(statistics.median(timings) * 1000, 2),
+                'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 2),
+                'queries': len(queries),
+            })
+        return results
+
+    def _print_table(self, results):
+        header = f"{'endpoint':<20}{'status':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'queries':>9}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in results:
+            self.stdout.write(
+                f"{row['endpoint']:<20}{row['status']:>8}{row['rps']:>10}"
+                f"{row['p50_ms']:>10}{row['p99_ms']:>10}{row['queries']:>9}"
+            )
+
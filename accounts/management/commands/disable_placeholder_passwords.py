@@ -0,0 +1,45 @@
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.management.base import BaseCommand
+
+from accounts.models import User
+
+# Пароли-заглушки, с которыми раньше создавались аккаунты SMS и email входа
+PLACEHOLDER_PASSWORDS = ('dummy_password_for_sms_user', 'dummy_password_for_email_user')
+
+
+class Command(BaseCommand):
+    help = 'Заменяет пароли-заглушки у аккаунтов SMS/email входа на непригодные'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Только показать количество')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Такие аккаунты создавались с username user_<телефон или email>
+        candidates = (
+            User.objects.filter(username__startswith='user_')
+            .exclude(password__startswith='!')
+            .order_by('id')
+            .values_list('id', 'password')
+        )
+
+        found = 0
+        batch = []
+        for user_id, encoded in candidates.iterator(chunk_size=batch_size):
+            # Проверка без setter: хеш не обновляется, только сравнивается
+            if any(check_password(placeholder, encoded) for placeholder in PLACEHOLDER_PASSWORDS):
+                batch.append(user_id)
+            if len(batch) >= batch_size:
+                found += self._disable(batch, options['dry_run'])
+                batch = []
+        if batch:
+            found += self._disable(batch, options['dry_run'])
+
+        action = 'Найдено' if options['dry_run'] else 'Отключено'
+        self.stdout.write(self.style.SUCCESS(f'{action} паролей-заглушек: {found}'))
+
+    def _disable(self, user_ids, dry_run):
+        if not dry_run:
+            User.objects.filter(id__in=user_ids).update(password=make_password(None))
+        return len(user_ids)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from accounts.rollups import compacted_before, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает недельные, месячные и годовые итоги использования по дневным записям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='id пользователя, можно несколько')
+        parser.add_argument('--batch-size', type=int, default=500, help='Пользователей в одной транзакции')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Пересчитать и периоды старше RETENTION_DAILY_DAYS (только если retention еще не запускался)',
+        )
+
+    def handle(self, *args, **options):
+        since = None if options['full'] else compacted_before()
+        count = rebuild_rollups(options['user_ids'], options['batch_size'], since)
+        self.stdout.write(self.style.SUCCESS(f'Итоги пересчитаны для пользователей: {count}'))
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_achievement_achievementstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(max_length=50)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['deleted_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, upload_to='avatars/'),
+        ),
+        migrations.AddIndex(
+            model_name='achievement',
+            index=models.Index(fields=['user', 'updated_at'], name='accounts_ac_user_id_b996a4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='app',
+            index=models.Index(fields=['user', 'last_used'], name='accounts_ap_user_id_08d96f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailynote',
+            index=models.Index(fields=['user', 'updated_at'], name='accounts_da_user_id_e6963b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailytimeline',
+            index=models.Index(fields=['user', 'updated_at'], name='accounts_da_user_id_3e7561_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='habit',
+            index=models.Index(fields=['user', 'updated_at'], name='accounts_ha_user_id_97ad49_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userexperience',
+            index=models.Index(fields=['user', 'updated_at'], name='accounts_us_user_id_0fe1bd_idx'),
+        ),
+        migrations.AddField(
+            model_name='deletedrecord',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deleted_records', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='deletedrecord',
+            index=models.Index(fields=['user', 'deleted_at'], name='accounts_de_user_id_1d3592_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def normalize_phone(phone_number):
+    if not phone_number:
+        return None
+    digits = ''.join(c for c in phone_number if c.isdigit())
+    if not digits:
+        return None
+    if digits.startswith('8') and len(digits) == 11:
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    return '+' + digits
+
+
+def normalize_email(email):
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+def backfill_normalized_fields(apps, schema_editor):
+    """
+    Заполняет нормализованные поля.
+
+    Если несколько пользователей делят номер или email, значение получает
+    самый ранний аккаунт, у остальных поле остается пустым.
+    """
+    User = apps.get_model('accounts', 'User')
+    seen_phones = set()
+    seen_emails = set()
+    batch = []
+
+    users = User.objects.order_by('id').only('id', 'phone_number', 'email')
+    for user in users.iterator(chunk_size=BATCH_SIZE):
+        phone = normalize_phone(user.phone_number)
+        email = normalize_email(user.email)
+        user.phone_e164 = phone if phone not in seen_phones else None
+        user.email_normalized = email if email not in seen_emails else None
+        seen_phones.add(phone)
+        seen_emails.add(email)
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['phone_e164', 'email_normalized'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['phone_e164', 'email_normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_sync_updated_at_indexes_deletedrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_e164',
+            field=models.CharField(blank=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='email_normalized',
+            field=models.CharField(blank=True, editable=False, max_length=254, null=True),
+        ),
+        migrations.RunPython(backfill_normalized_fields, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_e164',
+            field=models.CharField(blank=True, editable=False, max_length=16, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='email_normalized',
+            field=models.CharField(blank=True, editable=False, max_length=254, null=True, unique=True),
+        ),
+    ]
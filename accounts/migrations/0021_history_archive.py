@@ -0,0 +1,79 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0020_statelessuser'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTimelineArchive',
+            fields=[
+                ('date', models.DateField()),
+                ('segment_0_useful', models.IntegerField(default=0)),
+                ('segment_0_harmful', models.IntegerField(default=0)),
+                ('segment_1_useful', models.IntegerField(default=0)),
+                ('segment_1_harmful', models.IntegerField(default=0)),
+                ('segment_2_useful', models.IntegerField(default=0)),
+                ('segment_2_harmful', models.IntegerField(default=0)),
+                ('segment_3_useful', models.IntegerField(default=0)),
+                ('segment_3_harmful', models.IntegerField(default=0)),
+                ('segment_4_useful', models.IntegerField(default=0)),
+                ('segment_4_harmful', models.IntegerField(default=0)),
+                ('segment_5_useful', models.IntegerField(default=0)),
+                ('segment_5_harmful', models.IntegerField(default=0)),
+                ('segment_6_useful', models.IntegerField(default=0)),
+                ('segment_6_harmful', models.IntegerField(default=0)),
+                ('segment_7_useful', models.IntegerField(default=0)),
+                ('segment_7_harmful', models.IntegerField(default=0)),
+                ('segment_8_useful', models.IntegerField(default=0)),
+                ('segment_8_harmful', models.IntegerField(default=0)),
+                ('segment_9_useful', models.IntegerField(default=0)),
+                ('segment_9_harmful', models.IntegerField(default=0)),
+                ('segment_10_useful', models.IntegerField(default=0)),
+                ('segment_10_harmful', models.IntegerField(default=0)),
+                ('segment_11_useful', models.IntegerField(default=0)),
+                ('segment_11_harmful', models.IntegerField(default=0)),
+                ('segment_12_useful', models.IntegerField(default=0)),
+                ('segment_12_harmful', models.IntegerField(default=0)),
+                ('segment_13_useful', models.IntegerField(default=0)),
+                ('segment_13_harmful', models.IntegerField(default=0)),
+                ('segment_14_useful', models.IntegerField(default=0)),
+                ('segment_14_harmful', models.IntegerField(default=0)),
+                ('total_useful_seconds', models.IntegerField(default=0)),
+                ('total_harmful_seconds', models.IntegerField(default=0)),
+                ('total_screen_time_seconds', models.IntegerField(default=0)),
+                ('sessions_count', models.IntegerField(default=0)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_daily_timelines', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('user', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AppUsageRecordArchive',
+            fields=[
+                ('date', models.DateField()),
+                ('usage_seconds', models.IntegerField(default=0)),
+                ('sessions_count', models.IntegerField(default=0)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_usage_records', to='accounts.app')),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('app', 'date')},
+            },
+        ),
+    ]
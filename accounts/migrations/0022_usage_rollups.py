@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_rollups(apps, schema_editor):
+    from accounts.rollups import rebuild_rollups
+    rebuild_rollups(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0021_history_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'Неделя'), ('month', 'Месяц'), ('year', 'Год')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('total_useful_seconds', models.BigIntegerField(default=0)),
+                ('total_harmful_seconds', models.BigIntegerField(default=0)),
+                ('total_screen_time_seconds', models.BigIntegerField(default=0)),
+                ('sessions_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-period_start'],
+                'unique_together': {('user', 'period', 'period_start')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AppUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'Неделя'), ('month', 'Месяц'), ('year', 'Год')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('usage_seconds', models.BigIntegerField(default=0)),
+                ('sessions_count', models.IntegerField(default=0)),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='accounts.app')),
+            ],
+            options={
+                'ordering': ['-period_start'],
+                'unique_together': {('app', 'period', 'period_start')},
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,66 @@
-from django.contrib.auth.models import AbstractUser
-from django.db import models
+import secrets
+
+from django.contrib.auth.models import AbstractUser, UserManager as DjangoUserManager
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 
 
+def normalize_phone(phone_number):
+    """Приводит номер телефона к формату E.164 (+7XXXXXXXXXX)"""
+    if not phone_number:
+        return None
+    digits = ''.join(c for c in phone_number if c.isdigit())
+    if not digits:
+        return None
+    if digits.startswith('8') and len(digits) == 11:
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    return '+' + digits
+
+
+def normalize_email(email):
+    """Приводит email к нижнему регистру для поиска без учета регистра"""
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+class UserManager(DjangoUserManager):
+    # Попыток с новым случайным суффиксом, если имя уже занято
+    USERNAME_ATTEMPTS = 5
+    USERNAME_SUFFIX_BYTES = 3
+
+    def create_user_with_unique_username(self, base_username, password=None, **extra_fields):
+        """
+        Создает пользователя, занимая свободный username одним INSERT.
+
+        Сначала пробует base_username, при нарушении уникальности добавляет
+        случайный суффикс. Занятость имени не проверяется заранее, поэтому
+        одновременные регистрации не гонятся друг с другом.
+        """
+        max_length = self.model._meta.get_field('username').max_length
+        suffix_length = self.USERNAME_SUFFIX_BYTES * 2 + 1
+        base_username = base_username[:max_length - suffix_length]
+
+        username = base_username
+        for attempt in range(self.USERNAME_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self.create_user(username=username, password=password, **extra_fields)
+            except IntegrityError:
+                # Конфликт не по username (например, телефон уже занят) повтором не решить
+                if attempt == self.USERNAME_ATTEMPTS - 1 or not self.filter(username=username).exists():
+                    raise
+            username = f"{base_username}_{secrets.token_hex(self.USERNAME_SUFFIX_BYTES)}"
+
+
 class User(AbstractUser):
     email = models.EmailField(blank=True, null=True)
     phone_number = models.CharField(max_length=15, blank=True, null=True)
+    # Нормализованные копии для индексированного поиска при входе
+    phone_e164 = models.CharField(max_length=16, unique=True, null=True, blank=True, editable=False)
+    email_normalized = models.CharField(max_length=254, unique=True, null=True, blank=True, editable=False)
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
     
     # Подписка
@@ -22,6 +77,100 @@ class User(AbstractUser):
     subscription_start_date = models.DateTimeField(null=True, blank=True)
     subscription_end_date = models.DateTimeField(null=True, blank=True)
     subscription_auto_renew = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserManager()
+
+    # Контакт -> (нормализованная копия, функция нормализации)
+    CONTACT_FIELDS = {
+        'phone_number': ('phone_e164', normalize_phone),
+        'email': ('email_normalized', normalize_email),
+    }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_contacts()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._remember_contacts()
+
+    def _remember_contacts(self):
+        # Значения контактов в БД; отложенные поля не загружаются
+        self._saved_contacts = {
+            field: self.__dict__[field] for field in self.CONTACT_FIELDS if field in self.__dict__
+        }
+
+    def _contact_changed(self, field, update_fields):
+        if update_fields is not None:
+            return field in update_fields
+        if self._state.adding:
+            return True
+        saved = getattr(self, '_saved_contacts', {})
+        # Отложенное поле не загружалось и не менялось
+        return field in self.__dict__ and (field not in saved or self.__dict__[field] != saved[field])
+
+    def save(self, *args, **kwargs):
+        # Нормализуем только измененные контакты: у старых дубликатов миграция
+        # 0018 оставила копии пустыми, и пересчет при любом сохранении упал
+        # бы на уникальности
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+        for field, (normalized_field, normalize) in self.CONTACT_FIELDS.items():
+            if self._contact_changed(field, update_fields):
+                setattr(self, normalized_field, normalize(getattr(self, field)))
+                if update_fields is not None:
+                    update_fields.add(normalized_field)
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+        self._remember_contacts()
+
+
+class StatelessUser(User):
+    """
+    Пользователь, собранный из claims access токена без запроса к БД.
+
+    Заполнены только id и поля из токена, остальные отложены. При первом
+    обращении к отложенному полю одним запросом загружаются все еще
+    отложенные поля; уже заполненные (и измененные в памяти) не
+    перезаписываются. Значения из токена могут отставать от БД, поэтому
+    view, которые сохраняют пользователя, загружают его строку из БД, а
+    save() пишет только явно перечисленные update_fields без полей токена.
+    """
+    # Поля, значения которых пришли из claims токена
+    claim_fields = frozenset()
+
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def from_claims(cls, user_id, fields):
+        field_names = ['id', *fields]
+        values = [user_id, *fields.values()]
+        user = cls.from_db(None, field_names, values)
+        user.claim_fields = frozenset(fields)
+        return user
+
+    def save(self, *args, **kwargs):
+        # Полное сохранение вернуло бы в БД устаревшие claims (например,
+        # подписку, которую уже сменили)
+        update_fields = kwargs.get('update_fields')
+        if args or update_fields is None or self.claim_fields.intersection(update_fields):
+            raise ValueError(
+                'StatelessUser built from token claims can only save explicit update_fields '
+                'without token claims; load the user from the database to save it'
+            )
+        super().save(**kwargs)
+
+    def refresh_from_db(self, using=None, fields=None):
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred and deferred.issuperset(fields):
+            fields = list(deferred)
+        super().refresh_from_db(using=using, fields=fields)
 
 
 class UserTestResult(models.Model):
@@ -54,6 +203,7 @@ class Habit(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['user', 'updated_at'])]
 
 
 class DailyNote(models.Model):
@@ -75,6 +225,7 @@ class DailyNote(models.Model):
     class Meta:
         unique_together = ['user', 'date']
         ordering = ['-date']
+        indexes = [models.Index(fields=['user', 'updated_at'])]
 
 
 class AppUsage(models.Model):
@@ -157,6 +308,7 @@ class UserExperience(models.Model):
     class Meta:
         unique_together = ['user', 'date']
         ordering = ['-date']
+        indexes = [models.Index(fields=['user', 'updated_at'])]
     
     @property
     def level(self):
@@ -231,26 +383,44 @@ class App(models.Model):
     class Meta:
         unique_together = ['user', 'package_name']
         ordering = ['-last_used']
+        indexes = [models.Index(fields=['user', 'last_used'])]
     
     def __str__(self):
         return f"{self.user.username} - {self.app_name} ({self.category})"
 
 
-class AppUsageRecord(models.Model):
-    """Модель для детального отслеживания использования приложений"""
-    app = models.ForeignKey(App, on_delete=models.CASCADE, related_name='usage_records')
+class AppUsageRecordFields(models.Model):
+    """Поля использования приложения за день: общие для горячей и архивной таблиц"""
     date = models.DateField()
     usage_seconds = models.IntegerField(default=0)
     sessions_count = models.IntegerField(default=0)
     
+    class Meta:
+        abstract = True
+
+
+class AppUsageRecord(AppUsageRecordFields):
+    """Модель для детального отслеживания использования приложений"""
+    app = models.ForeignKey(App, on_delete=models.CASCADE, related_name='usage_records')
+    
     class Meta:
         unique_together = ['app', 'date']
         ordering = ['-date']
 
 
-class DailyTimeline(models.Model):
-    """Модель для хранения данных о времени использования по сегментам дня"""
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_timelines')
+class AppUsageRecordArchive(AppUsageRecordFields):
+    """Записи использования старше HISTORY_HOT_DAYS (см. accounts.archive)"""
+    id = models.BigIntegerField(primary_key=True)
+    app = models.ForeignKey(App, on_delete=models.CASCADE, related_name='archived_usage_records')
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['app', 'date']
+        ordering = ['-date']
+
+
+class DailyTimelineFields(models.Model):
+    """Сегменты и итоги дня: общие для горячей и архивной таблиц timeline"""
     date = models.DateField()
     
     # 15 сегментов по ~1.6 часа каждый (0-14)
@@ -291,12 +461,8 @@ class DailyTimeline(models.Model):
     total_screen_time_seconds = models.IntegerField(default=0)
     sessions_count = models.IntegerField(default=0)
     
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
-    
     class Meta:
-        unique_together = ['user', 'date']
-        ordering = ['-date']
+        abstract = True
     
     def get_segment_data(self, segment_index):
         """Получить данные для конкретного сегмента"""
@@ -337,6 +503,66 @@ class DailyTimeline(models.Model):
         self.total_screen_time_seconds = total_useful + total_harmful
 
 
+class DailyTimeline(DailyTimelineFields):
+    """Модель для хранения данных о времени использования по сегментам дня"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_timelines')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['user', 'date']
+        ordering = ['-date']
+        indexes = [models.Index(fields=['user', 'updated_at'])]
+
+
+class DailyTimelineArchive(DailyTimelineFields):
+    """Timeline старше HISTORY_HOT_DAYS (см. accounts.archive)"""
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_daily_timelines')
+    # Время переносится из горячей таблицы как есть
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['user', 'date']
+        ordering = ['-date']
+
+
+class AppUsageRollup(models.Model):
+    """Сумма AppUsageRecord приложения за неделю, месяц или год (см. accounts.rollups)"""
+    PERIOD_CHOICES = [
+        ('week', 'Неделя'),
+        ('month', 'Месяц'),
+        ('year', 'Год'),
+    ]
+    
+    app = models.ForeignKey(App, on_delete=models.CASCADE, related_name='usage_rollups')
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    period_start = models.DateField()
+    usage_seconds = models.BigIntegerField(default=0)
+    sessions_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['app', 'period', 'period_start']
+        ordering = ['-period_start']
+
+
+class TimelineRollup(models.Model):
+    """Итоги DailyTimeline пользователя за неделю, месяц или год (см. accounts.rollups)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_rollups')
+    period = models.CharField(max_length=5, choices=AppUsageRollup.PERIOD_CHOICES)
+    period_start = models.DateField()
+    total_useful_seconds = models.BigIntegerField(default=0)
+    total_harmful_seconds = models.BigIntegerField(default=0)
+    total_screen_time_seconds = models.BigIntegerField(default=0)
+    sessions_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['user', 'period', 'period_start']
+        ordering = ['-period_start']
+
+
 class Achievement(models.Model):
     """Модель для хранения достижений пользователя"""
     ACHIEVEMENT_TYPES = [
@@ -364,6 +590,7 @@ class Achievement(models.Model):
     class Meta:
         unique_together = ['user', 'achievement_id']
         ordering = ['-unlocked_at', 'achievement_type', 'required_value']
+        indexes = [models.Index(fields=['user', 'updated_at'])]
     
     def __str__(self):
         return f"{self.user.username} - {self.title} ({'Разблокировано' if self.is_unlocked else 'Заблокировано'})"
@@ -394,4 +621,16 @@ class AchievementStats(models.Model):
         unique_together = ['user']
     
     def __str__(self):
-        return f"{self.user.username} - Achievement Stats"
\ No newline at end of file
+        return f"{self.user.username} - Achievement Stats"
+
+
+class DeletedRecord(models.Model):
+    """Надгробие удаленной записи для дельта-синхронизации клиента"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='deleted_records')
+    collection = models.CharField(max_length=50)  # Ключ коллекции в ответе sync/
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['deleted_at']
+        indexes = [models.Index(fields=['user', 'deleted_at'])]
@@ -1,22 +1,43 @@
-import os
 import random
 import requests
+from requests.adapters import HTTPAdapter
 from django.core.cache import cache
 from django.conf import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+P1SMS_API_URL = "https://admin.p1sms.ru/apiSms/create"
+
+
+def build_http_session(pool_size=10):
+    """HTTP сессия с пулом keep-alive соединений для API провайдеров"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Content-Type': 'application/json',
+        'accept': 'application/json'
+    })
+    return session
+
+
 class P1SMSService:
     """Сервис для отправки SMS через P1SMS API"""
 
-    def __init__(self):
+    name = 'p1sms'
+
+    def __init__(self, session=None):
         self.api_key = settings.P1SMS_API_KEY
+        self.session = session or build_http_session()
+        # (connect, read): медленный провайдер не должен держать поток 30 секунд
+        self.timeout = (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT)
 
         if not self.api_key:
             logger.warning("P1SMS API key not configured. Using debug mode.")
         else:
-            logger.info(f"P1SMS client initialized with API key: {self.api_key[:10]}...")
+            logger.info("P1SMS client initialized")
 
     def generate_verification_code(self):
         """Генерирует 6-значный код подтверждения"""
@@ -45,10 +66,11 @@ class P1SMSService:
         """
         try:
             normalized_phone = self.normalize_phone_number(phone)
-            logger.info(f"Отправка SMS через P1SMS на {normalized_phone}")
+            logger.debug("Отправка SMS через P1SMS на %s", normalized_phone)
 
             if not self.api_key:
-                raise Exception("P1SMS API key not configured.")
+                # Ошибка настройки провайдера: сообщение может доставить другой провайдер
+                return {'success': False, 'message': 'P1SMS API key not configured', 'retryable': True}
 
             # Формируем данные согласно документации
             data = {
@@ -66,70 +88,83 @@ class P1SMSService:
             if sender and channel in ["char", "viber", "whatsapp"]:
                 data["sms"][0]["sender"] = sender
 
-            url = "https://admin.p1sms.ru/apiSms/create"
-            headers = {
-                'Content-Type': 'application/json',
-                'accept': 'application/json'
-            }
-
-            logger.info(f"URL: {url}")
-            logger.info(f"Data: {data}")
-
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            response = self.session.post(P1SMS_API_URL, json=data, timeout=self.timeout)
             response.raise_for_status()
 
             p1sms_result = response.json()
-            logger.info(f"P1SMS response: {p1sms_result}")
+            logger.debug("P1SMS response status: %s", p1sms_result.get('status'))
 
             if p1sms_result.get('status') == 'success':
                 # Проверяем статус каждого сообщения
                 for sms_data in p1sms_result.get('data', []):
                     if sms_data.get('status') == 'sent':
-                        logger.info(f"SMS успешно отправлена на {normalized_phone}")
+                        logger.debug("SMS успешно отправлена на %s", normalized_phone)
                         return {'success': True, 'p1sms_result': p1sms_result}
                     else:
                         error_desc = sms_data.get('errorDescription', 'Unknown error')
                         error_code = sms_data.get('errorCode', 'N/A')
-                        logger.error(f"P1SMS API вернул ошибку для {normalized_phone}: {error_desc} (Code: {error_code})")
-                        return {'success': False, 'message': f'P1SMS API error: {error_desc}', 'p1sms_result': p1sms_result}
+                        logger.error("P1SMS API вернул ошибку для %s: %s (Code: %s)", normalized_phone, error_desc, error_code)
+                        return {
+                            'success': False, 'message': f'P1SMS API error: {error_desc}',
+                            'p1sms_result': p1sms_result, 'retryable': True,
+                        }
                 
                 # Если дошли сюда, значит нет сообщений со статусом 'sent'
-                logger.error(f"P1SMS API не вернул статус 'sent' для {normalized_phone}")
-                return {'success': False, 'message': 'P1SMS API did not return sent status', 'p1sms_result': p1sms_result}
+                logger.error("P1SMS API не вернул статус 'sent' для %s", normalized_phone)
+                return {
+                    'success': False, 'message': 'P1SMS API did not return sent status',
+                    'p1sms_result': p1sms_result, 'retryable': True,
+                }
             else:
                 error_desc = p1sms_result.get('errorDescription', 'Unknown error')
                 error_code = p1sms_result.get('errorCode', 'N/A')
-                logger.error(f"P1SMS API вернул ошибку: {error_desc} (Code: {error_code})")
-                return {'success': False, 'message': f'P1SMS API error: {error_desc}', 'p1sms_result': p1sms_result}
+                logger.error("P1SMS API вернул ошибку: %s (Code: %s)", error_desc, error_code)
+                # Ошибка аккаунта или сервиса (баланс, ключ, сбой): сообщение
+                # может доставить другой провайдер
+                return {
+                    'success': False, 'message': f'P1SMS API error: {error_desc}',
+                    'p1sms_result': p1sms_result, 'retryable': True,
+                }
 
         except requests.exceptions.RequestException as e:
-            logger.error(f"P1SMS HTTP error: {e}")
-            return {'success': False, 'message': f'P1SMS HTTP error: {e}'}
+            logger.error("P1SMS HTTP error: %s", e)
+            # Сетевые ошибки, таймауты и 5xx имеет смысл повторить
+            status_code = getattr(e.response, 'status_code', None)
+            retryable = status_code is None or status_code >= 500 or status_code == 429
+            return {'success': False, 'message': f'P1SMS HTTP error: {e}', 'retryable': retryable}
         except Exception as e:
-            logger.error(f"Ошибка отправки SMS через P1SMS на {phone}: {e}")
-            return {'success': False, 'message': f'Ошибка отправки SMS: {e}'}
+            logger.error("Ошибка отправки SMS через P1SMS на %s: %s", phone, e)
+            # Неожиданный ответ провайдера (не JSON и т.п.) не должен блокировать доставку кода
+            return {'success': False, 'message': f'Ошибка отправки SMS: {e}', 'retryable': True}
 
-    def send_verification_code(self, phone_number):
+    def prepare_verification_code(self, phone_number):
         """
-        Отправляет SMS с кодом подтверждения через P1SMS API.
+        Генерирует код, сохраняет его в кеш и возвращает (код, текст SMS).
         """
         normalized_phone = self.normalize_phone_number(phone_number)
         code = self.generate_verification_code()
         cache_key = f'sms_code_{normalized_phone}'
         cache.set(cache_key, code, timeout=600)  # 10 минут
+        return code, f"Ваш код подтверждения: {code}"
+
+    def send_verification_code(self, phone_number):
+        """
+        Отправляет SMS с кодом подтверждения через P1SMS API.
+        """
+        normalized_phone = self.normalize_phone_number(phone_number)
+        code, text = self.prepare_verification_code(phone_number)
 
         if not self.api_key:
-            logger.error(f"P1SMS API key not configured!")
+            logger.error("P1SMS API key not configured!")
             return {
                 'success': False,
                 'message': 'P1SMS API key not configured'
             }
         
-        text = f"Ваш код подтверждения: {code}"
         result = self.send_sms(phone_number, text, channel="telegram_auth")
 
         if result['success']:
-            logger.info(f"SMS отправлена на {normalized_phone} через P1SMS")
+            logger.debug("SMS отправлена на %s через P1SMS", normalized_phone)
             return {
                 'success': True,
                 'message': 'SMS код отправлен успешно',
@@ -137,7 +172,7 @@ class P1SMSService:
                 'p1sms_result': result.get('p1sms_result')
             }
         else:
-            logger.error(f"Ошибка отправки SMS на {phone_number}: {result['message']}")
+            logger.error("Ошибка отправки SMS на %s: %s", phone_number, result['message'])
             return {
                 'success': False,
                 'message': f'Ошибка отправки SMS: {result["message"]}'
@@ -152,15 +187,15 @@ class P1SMSService:
         saved_code = cache.get(cache_key)
 
         if not saved_code:
-            logger.warning(f"Код не найден для {normalized_phone} (истек или не был отправлен)")
+            logger.warning("Код не найден для %s (истек или не был отправлен)", normalized_phone)
             return False
 
         if str(saved_code) == str(code):
             cache.delete(cache_key)
-            logger.info(f"Код успешно проверен для {normalized_phone}")
+            logger.debug("Код успешно проверен для %s", normalized_phone)
             return True
         else:
-            logger.warning(f"Неверный код для {normalized_phone}")
+            logger.warning("Неверный код для %s", normalized_phone)
             return False
 
     def clear_code(self, phone_number):
@@ -168,4 +203,15 @@ class P1SMSService:
         normalized_phone = self.normalize_phone_number(phone_number)
         cache_key = f'sms_code_{normalized_phone}'
         cache.delete(cache_key)
-        logger.info(f"Код удален для {normalized_phone}")
+        logger.debug("Код удален для %s", normalized_phone)
+
+
+_p1sms_service = None
+
+
+def get_p1sms_service():
+    """Общий экземпляр сервиса: одна HTTP сессия с пулом соединений на процесс"""
+    global _p1sms_service
+    if _p1sms_service is None:
+        _p1sms_service = P1SMSService()
+    return _p1sms_service
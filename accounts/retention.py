@@ -0,0 +1,168 @@
+"""
+Сроки хранения данных.
+
+Каждая политика удаляет записи старше своего срока из settings
+(RETENTION_*_DAYS, 0 - политика выключена) небольшими пачками. Каждая пачка
+удаляется отдельным коротким DELETE по id с паузой после него, так что
+таблицы не блокируются надолго, а реплики успевают догонять.
+
+Удаление идет в обход post_delete: это не удаление пользователем, и
+надгробия для синхронизации не создаются.
+
+- daily_history: дневные AppUsageRecord и DailyTimeline (и их архив)
+  старше RETENTION_DAILY_DAYS; их суммы уже есть в AppUsageRollup и
+  TimelineRollup (accounts.rollups), которые поддерживаются при записи.
+- experience: UserExperience старше RETENTION_EXPERIENCE_DAYS, кроме
+  последней записи пользователя с текущим total_experience.
+- chat_messages: сообщения активных чатов старше RETENTION_CHAT_MESSAGES_DAYS.
+- deleted_chats: чаты, удаленные пользователем (is_active=False) больше
+  RETENTION_DELETED_CHATS_DAYS назад, со всеми сообщениями и вложениями.
+- deleted_records: надгробия синхронизации (DeletedRecord) старше
+  RETENTION_DELETED_RECORDS_DAYS; клиент с более старым курсором получает
+  полную синхронизацию (accounts.sync_views).
+"""
+import time
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import (
+    AppUsageRecord, AppUsageRecordArchive, ChatAttachment, ChatMessage, ChatSession, DailyTimeline,
+    DailyTimelineArchive, DeletedRecord, UserExperience,
+)
+from .rollups import compacted_before
+
+# Модели, строки которых удаляет raw_delete -> модели со ссылками на них.
+# Ссылающиеся строки вызывающий код удаляет раньше: вложения до сообщений,
+# сообщения до чатов. Других обратных связей быть не должно, это проверяет тест
+RAW_DELETE_MODELS = {
+    AppUsageRecord: (),
+    AppUsageRecordArchive: (),
+    DailyTimeline: (),
+    DailyTimelineArchive: (),
+    UserExperience: (),
+    ChatAttachment: (),
+    ChatMessage: (ChatAttachment,),
+    ChatSession: (ChatMessage,),
+    DeletedRecord: (),
+}
+
+
+def raw_delete(rows):
+    """
+    Удаляет строки queryset одним DELETE, возвращает их число.
+
+    QuerySet.delete() сначала выбирает строки для каскадов и сигналов, а
+    post_delete моделей синхронизации пишет надгробия DeletedRecord
+    (accounts.signals). Для переноса в архив и сроков хранения это не нужно:
+    каскадов нет (RAW_DELETE_MODELS), сигналов нет, и надгробия не нужны,
+    потому что это не удаление пользователем.
+    """
+    if rows.model not in RAW_DELETE_MODELS:
+        raise ValueError(f'raw_delete is not allowed for {rows.model.__name__}')
+    return rows._raw_delete(rows.db)
+
+
+class BatchDeleter:
+    """Удаляет строки queryset пачками по batch_size с паузой pause секунд"""
+
+    def __init__(self, batch_size=1000, pause=0, dry_run=False):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.dry_run = dry_run
+
+    def delete(self, queryset, file_field=None):
+        """
+        Возвращает число удаленных (в dry_run - подлежащих удалению) строк.
+
+        С file_field после удаления строк удаляются и их файлы из хранилища.
+        """
+        if self.dry_run:
+            return queryset.count()
+        model = queryset.model
+        storage = model._meta.get_field(file_field).storage if file_field else None
+        deleted = 0
+        while True:
+            batch = list(queryset.order_by('pk').values_list('pk', file_field or 'pk')[:self.batch_size])
+            if not batch:
+                return deleted
+            rows = model.objects.filter(pk__in=[pk for pk, _ in batch])
+            deleted += raw_delete(rows)
+            if storage is not None:
+                for _, name in batch:
+                    if name:
+                        storage.delete(name)
+            if self.pause:
+                time.sleep(self.pause)
+
+
+def _days_ago(days):
+    return timezone.now() - timedelta(days=days)
+
+
+def compact_daily_history(deleter):
+    """Удаляет дневные записи, уже учтенные в итогах по периодам"""
+    before = compacted_before()
+    return {
+        model.__name__: deleter.delete(model.objects.filter(date__lt=before))
+        for model in (AppUsageRecord, AppUsageRecordArchive, DailyTimeline, DailyTimelineArchive)
+    }
+
+
+def prune_experience(deleter):
+    before = date.today() - timedelta(days=settings.RETENTION_EXPERIENCE_DAYS)
+    newer = UserExperience.objects.filter(user=OuterRef('user'), date__gt=OuterRef('date'))
+    rows = UserExperience.objects.filter(date__lt=before).filter(Exists(newer))
+    return {'UserExperience': deleter.delete(rows)}
+
+
+def _delete_messages(deleter, messages):
+    attachments = ChatAttachment.objects.filter(message__in=messages)
+    return {
+        'ChatAttachment': deleter.delete(attachments, file_field='file'),
+        'ChatMessage': deleter.delete(messages),
+    }
+
+
+def prune_chat_messages(deleter):
+    messages = ChatMessage.objects.filter(
+        session__is_active=True, created_at__lt=_days_ago(settings.RETENTION_CHAT_MESSAGES_DAYS),
+    )
+    return _delete_messages(deleter, messages)
+
+
+def prune_deleted_chats(deleter):
+    sessions = ChatSession.objects.filter(
+        is_active=False, updated_at__lt=_days_ago(settings.RETENTION_DELETED_CHATS_DAYS),
+    )
+    counts = _delete_messages(deleter, ChatMessage.objects.filter(session__in=sessions))
+    counts['ChatSession'] = deleter.delete(sessions)
+    return counts
+
+
+def prune_deleted_records(deleter):
+    rows = DeletedRecord.objects.filter(deleted_at__lt=_days_ago(settings.RETENTION_DELETED_RECORDS_DAYS))
+    return {'DeletedRecord': deleter.delete(rows)}
+
+
+# Имя политики -> (настройка срока, функция)
+POLICIES = {
+    'daily_history': ('RETENTION_DAILY_DAYS', compact_daily_history),
+    'experience': ('RETENTION_EXPERIENCE_DAYS', prune_experience),
+    'chat_messages': ('RETENTION_CHAT_MESSAGES_DAYS', prune_chat_messages),
+    'deleted_chats': ('RETENTION_DELETED_CHATS_DAYS', prune_deleted_chats),
+    'deleted_records': ('RETENTION_DELETED_RECORDS_DAYS', prune_deleted_records),
+}
+
+
+def apply_retention(deleter, policies=None):
+    """Применяет включенные политики, возвращает {политика: {модель: строк}}"""
+    results = {}
+    for name, (setting, prune) in POLICIES.items():
+        if policies and name not in policies:
+            continue
+        if getattr(settings, setting):
+            results[name] = prune(deleter)
+    return results
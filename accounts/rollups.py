@@ -0,0 +1,184 @@
+"""
+Недельные, месячные и годовые итоги использования.
+
+AppUsageRollup и TimelineRollup обновляются на каждой записи
+AppUsageRecord/DailyTimeline прибавлением разницы (add_app_usage,
+add_timeline_change), поэтому usage_this_week/usage_this_month приложения и
+статистика timeline за длинные периоды читаются одной строкой вместо
+суммирования сотен дневных записей. Итоги включают и архивную историю
+(accounts.archive): перенос в архив их не меняет.
+
+rebuild_rollups пересчитывает итоги по дневным таблицам (команда
+rebuild_rollups). Дневные записи старше RETENTION_DAILY_DAYS удаляет
+retention (accounts.retention), и итоги остаются единственной историей
+за те периоды: пересчет их не трогает.
+"""
+from datetime import date, timedelta
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import TruncMonth, TruncWeek, TruncYear
+
+from .models import AppUsageRollup, TimelineRollup
+
+APP_USAGE_FIELDS = ('usage_seconds', 'sessions_count')
+TIMELINE_FIELDS = (
+    'total_useful_seconds', 'total_harmful_seconds', 'total_screen_time_seconds', 'sessions_count',
+)
+# Начало периода в БД: неделя с понедельника, как date.weekday()
+PERIOD_TRUNCS = {'week': TruncWeek, 'month': TruncMonth, 'year': TruncYear}
+
+
+def period_starts(day):
+    """Начала недели, месяца и года, в которые попадает день"""
+    day = models.DateField().to_python(day)
+    return {
+        'week': day - timedelta(days=day.weekday()),
+        'month': day.replace(day=1),
+        'year': day.replace(month=1, day=1),
+    }
+
+
+def _increment(model, owner, day, deltas):
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    starts = period_starts(day)
+    # Сначала строки периодов гарантированно существуют, затем атомарное
+    # прибавление: параллельные записи не теряют друг друга
+    model.objects.bulk_create(
+        [model(**owner, period=period, period_start=start) for period, start in starts.items()],
+        ignore_conflicts=True,
+    )
+    periods = Q()
+    for period, start in starts.items():
+        periods |= Q(period=period, period_start=start)
+    model.objects.filter(periods, **owner).update(
+        **{field: F(field) + value for field, value in deltas.items()}
+    )
+
+
+def add_app_usage(app_id, day, usage_seconds, sessions_count):
+    """Прибавляет использование приложения за день к итогам его периодов"""
+    _increment(AppUsageRollup, {'app_id': app_id}, day, {
+        'usage_seconds': usage_seconds,
+        'sessions_count': sessions_count,
+    })
+
+
+def timeline_totals(timeline):
+    """Итоговые поля timeline для add_timeline_change"""
+    return {field: getattr(timeline, field) for field in TIMELINE_FIELDS}
+
+
+def add_timeline_change(user_id, day, before, after):
+    """Прибавляет к итогам периодов разницу timeline до и после изменения"""
+    _increment(TimelineRollup, {'user_id': user_id}, day, {
+        field: after[field] - before[field] for field in TIMELINE_FIELDS
+    })
+
+
+def timeline_stats(user_id, day):
+    """
+    Итоги timeline за неделю, месяц и год, в которые попадает день, и за все
+    время: два запроса по TimelineRollup независимо от длины истории
+    """
+    starts = period_starts(day)
+    periods = Q()
+    for period, start in starts.items():
+        periods |= Q(period=period, period_start=start)
+    rollups = {rollup.period: rollup for rollup in TimelineRollup.objects.filter(periods, user_id=user_id)}
+
+    stats = {}
+    for period, start in starts.items():
+        rollup = rollups.get(period)
+        totals = timeline_totals(rollup) if rollup is not None else dict.fromkeys(TIMELINE_FIELDS, 0)
+        stats[period] = {'period_start': start, **totals}
+    all_time = TimelineRollup.objects.filter(user_id=user_id, period='year').aggregate(
+        **{field: Sum(field) for field in TIMELINE_FIELDS}
+    )
+    stats['all_time'] = {field: value or 0 for field, value in all_time.items()}
+    return stats
+
+
+def compacted_before(today=None):
+    """Дата, раньше которой retention удаляет дневные записи, или None"""
+    days = settings.RETENTION_DAILY_DAYS
+    if not days:
+        return None
+    return (today or date.today()) - timedelta(days=days)
+
+
+def rebuild_rollups(user_ids=None, batch_size=500, since=None, apps=global_apps):
+    """
+    Пересчитывает итоги пользователей (всех или user_ids) по дневным
+    таблицам, горячим и архивным. Возвращает число пользователей.
+
+    С since пересчитываются только периоды, начавшиеся не раньше since:
+    дневных записей более ранних периодов уже может не быть.
+    apps - реестр моделей; миграция передает свой исторический.
+    """
+    User = apps.get_model('accounts', 'User')
+    users = User.objects.order_by('pk').values_list('pk', flat=True)
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+
+    done = 0
+    batch = []
+    for user_id in users.iterator(chunk_size=batch_size):
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            done += _rebuild_batch(apps, batch, since)
+            batch = []
+    if batch:
+        done += _rebuild_batch(apps, batch, since)
+    return done
+
+
+def _rebuild_batch(apps, user_ids, since):
+    recent = {} if since is None else {'date__gte': since}
+    app_rollups = apps.get_model('accounts', 'AppUsageRollup').objects.filter(app__user_id__in=user_ids)
+    timeline_rollups = apps.get_model('accounts', 'TimelineRollup').objects.filter(user_id__in=user_ids)
+    if since is not None:
+        app_rollups = app_rollups.filter(period_start__gte=since)
+        timeline_rollups = timeline_rollups.filter(period_start__gte=since)
+
+    with transaction.atomic():
+        app_rollups.delete()
+        timeline_rollups.delete()
+        _rebuild_model(
+            app_rollups.model, 'app_id', APP_USAGE_FIELDS, since,
+            [apps.get_model('accounts', name).objects.filter(app__user_id__in=user_ids, **recent)
+             for name in ('AppUsageRecord', 'AppUsageRecordArchive')],
+        )
+        _rebuild_model(
+            timeline_rollups.model, 'user_id', TIMELINE_FIELDS, since,
+            [apps.get_model('accounts', name).objects.filter(user_id__in=user_ids, **recent)
+             for name in ('DailyTimeline', 'DailyTimelineArchive')],
+        )
+    return len(user_ids)
+
+
+def _rebuild_model(rollup_model, owner_field, fields, since, sources):
+    totals = {}
+    for rows in sources:
+        for period, trunc in PERIOD_TRUNCS.items():
+            grouped = (
+                rows.annotate(period_start=trunc('date')).order_by()
+                .values(owner_field, 'period_start')
+                .annotate(**{f'sum_{field}': Sum(field) for field in fields})
+            )
+            for row in grouped.iterator():
+                # Период, начатый до since, неполон: его итог остается прежним
+                if since is not None and row['period_start'] < since:
+                    continue
+                key = (row[owner_field], period, row['period_start'])
+                total = totals.setdefault(key, dict.fromkeys(fields, 0))
+                for field in fields:
+                    total[field] += row[f'sum_{field}'] or 0
+    rollup_model.objects.bulk_create([
+        rollup_model(**{owner_field: owner, 'period': period, 'period_start': start}, **values)
+        for (owner, period, start), values in totals.items()
+    ], batch_size=1000)
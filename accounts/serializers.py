@@ -1,12 +1,55 @@
+from datetime import date, timedelta
+
 from django.contrib.auth import get_user_model
+from django.db.models import OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from .models import Habit, DailyNote, AppUsage, ChatSession, ChatMessage, ChatAttachment, UserExperience, DailyTimeline, App, AppUsageRecord, UserTestResult, Achievement, AchievementStats
+from .achievement_engine import AchievementEngine
+from .archive import hot_cutoff
+from .models import normalize_email, normalize_phone, Habit, DailyNote, AppUsage, ChatSession, ChatMessage, ChatAttachment, UserExperience, DailyTimeline, App, AppUsageRecord, AppUsageRecordArchive, AppUsageRollup, UserTestResult, Achievement, AchievementStats
+from .rollups import period_starts
+from .tokens import UserRefreshToken
 
 User = get_user_model()
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UniqueContactsMixin:
+	"""
+	Проверяет, что email и телефон не заняты другим пользователем.
+
+	Неизмененный контакт не проверяется: у старых дубликатов миграция 0018
+	оставила нормализованные копии пустыми, и они могут сохранять профиль.
+	"""
+
+	def validate_email(self, value):
+		return self._validate_unique_contact(
+			value, 'email', 'email_normalized', normalize_email,
+			'A user with this email already exists.'
+		)
+
+	def validate_phone_number(self, value):
+		return self._validate_unique_contact(
+			value, 'phone_number', 'phone_e164', normalize_phone,
+			'A user with this phone number already exists.'
+		)
+
+	def _validate_unique_contact(self, value, field, lookup_field, normalize, message):
+		normalized = normalize(value)
+		if not normalized:
+			return value
+		if self.instance is not None and getattr(self.instance, field) == value:
+			return value
+		queryset = User.objects.filter(**{lookup_field: normalized})
+		if self.instance is not None:
+			queryset = queryset.exclude(pk=self.instance.pk)
+		if queryset.exists():
+			raise serializers.ValidationError(message)
+		return value
+
+
+class UserSerializer(UniqueContactsMixin, serializers.ModelSerializer):
 	avatar_url = serializers.SerializerMethodField()
 	level = serializers.SerializerMethodField()
 	experience = serializers.SerializerMethodField()
@@ -18,23 +61,29 @@ class UserSerializer(serializers.ModelSerializer):
 			'has_subscription', 'subscription_type', 'subscription_start_date', 
 			'subscription_end_date', 'subscription_auto_renew', 'date_joined', 'level', 'experience'
 		]
-	
+
 	def get_avatar_url(self, obj):
 		if obj.avatar:
 			# Формируем правильный URL для nginx
 			return f'http://147.45.214.86:8080{obj.avatar.url}'
 		return None
 	
+	def _latest_experience(self, obj):
+		# level и experience читают одну и ту же запись: один запрос на пользователя
+		if not hasattr(obj, '_latest_experience'):
+			obj._latest_experience = obj.experience_records.first()
+		return obj._latest_experience
+	
 	def get_level(self, obj):
 		# Получаем последнюю запись опыта пользователя
-		latest_exp = obj.experience_records.first()
+		latest_exp = self._latest_experience(obj)
 		if latest_exp:
 			return latest_exp.level
 		return 1
 	
 	def get_experience(self, obj):
 		# Получаем последнюю запись опыта пользователя
-		latest_exp = obj.experience_records.first()
+		latest_exp = self._latest_experience(obj)
 		if latest_exp:
 			return {
 				'total': latest_exp.total_experience,
@@ -52,7 +101,7 @@ class UserSerializer(serializers.ModelSerializer):
 		}
 
 
-class RegisterSerializer(serializers.ModelSerializer):
+class RegisterSerializer(UniqueContactsMixin, serializers.ModelSerializer):
 	password = serializers.CharField(write_only=True, min_length=8)
 
 	class Meta:
@@ -70,6 +119,8 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+	token_class = UserRefreshToken
+
 	def validate(self, attrs):
 		data = super().validate(attrs)
 		data['user'] = UserSerializer(self.user).data
@@ -100,16 +151,58 @@ class AppUsageSerializer(serializers.ModelSerializer):
 		return super().create(validated_data)
 
 
+def attach_app_usage(notes):
+	"""
+	Кладет в note.day_app_usage записи AppUsageRecord приложений автора
+	заметки за ее день. Один запрос на все заметки и еще один к архиву,
+	если среди них есть даты старше горячего окна.
+	"""
+	usage = {(note.user_id, note.date): [] for note in notes}
+	if not usage:
+		return
+	user_ids = {user_id for user_id, _ in usage}
+	dates = {day for _, day in usage}
+	sources = [AppUsageRecord]
+	if min(dates) < hot_cutoff():
+		sources.append(AppUsageRecordArchive)
+	for model in sources:
+		records = model.objects.filter(app__user_id__in=user_ids, date__in=dates).select_related('app')
+		for record in records:
+			usage.get((record.app.user_id, record.date), []).append(record)
+	for note in notes:
+		note.day_app_usage = sorted(usage[(note.user_id, note.date)], key=lambda record: -record.usage_seconds)
+
+
+class NoteAppUsageSerializer(serializers.Serializer):
+	"""Использование приложения за день заметки в прежнем формате AppUsageSerializer"""
+	app_name = serializers.CharField(source='app.app_name')
+	app_category = serializers.CharField(source='app.category')
+	usage_time_seconds = serializers.IntegerField(source='usage_seconds')
+
+
+class DailyNoteListSerializer(serializers.ListSerializer):
+	def to_representation(self, data):
+		notes = list(data.all() if hasattr(data, 'all') else data)
+		attach_app_usage(notes)
+		return super().to_representation(notes)
+
+
 class DailyNoteSerializer(serializers.ModelSerializer):
-	app_usage = AppUsageSerializer(many=True, read_only=True)
+	app_usage = serializers.SerializerMethodField()
 	
 	class Meta:
 		model = DailyNote
+		list_serializer_class = DailyNoteListSerializer
 		fields = [
 			'id', 'date', 'mood', 'note', 'app_usage', 'created_at', 'updated_at'
 		]
 		read_only_fields = ['id', 'created_at', 'updated_at']
 
+	def get_app_usage(self, obj):
+		if not hasattr(obj, 'day_app_usage'):
+			attach_app_usage([obj])
+		return NoteAppUsageSerializer(obj.day_app_usage, many=True).data
+
 	def create(self, validated_data):
 		validated_data['user'] = self.context['request'].user
 		return super().create(validated_data)
@@ -147,6 +240,7 @@ class ChatSessionSerializer(serializers.ModelSerializer):
 		read_only_fields = ['id', 'created_at', 'updated_at']
 	
 	def get_message_count(self, obj):
+		# С prefetch_related('messages') считается по уже загруженным сообщениям
 		return obj.messages.count()
 	
 	def create(self, validated_data):
@@ -154,6 +248,13 @@ class ChatSessionSerializer(serializers.ModelSerializer):
 		return super().create(validated_data)
 
 
+def prefetch_chat_messages(queryset):
+	"""Сообщения и вложения для ChatSessionSerializer двумя запросами на весь список"""
+	return queryset.prefetch_related(
+		Prefetch('messages', queryset=ChatMessage.objects.prefetch_related('attachments'))
+	)
+
+
 class SendMessageSerializer(serializers.Serializer):
 	content = serializers.CharField(max_length=4000)
 	attachments = serializers.ListField(
@@ -206,46 +307,84 @@ class DailyTimelineSerializer(serializers.ModelSerializer):
 		return super().create(validated_data)
 
 
+def annotate_app_usage(queryset):
+	"""
+	Добавляет к приложениям использование одним запросом:
+	usage_today - дневная запись, usage_week/usage_month - скользящие суммы
+	за последние 7 и 30 дней (не больше 31 дневной строки горячей таблицы на
+	приложение), usage_this_week/usage_this_month - календарные неделя и
+	месяц из AppUsageRollup, по одной строке на приложение
+	"""
+	today = date.today()
+	starts = period_starts(today)
+
+	def usage(rows):
+		return Coalesce(Subquery(rows.filter(app=OuterRef('pk')).values('usage_seconds')[:1]), 0)
+
+	def usage_since(since):
+		rows = (
+			AppUsageRecord.objects.filter(app=OuterRef('pk'), date__gte=since, date__lte=today)
+			.order_by().values('app').annotate(total=Sum('usage_seconds')).values('total')
+		)
+		return Coalesce(Subquery(rows), 0)
+
+	return queryset.annotate(
+		usage_today=usage(AppUsageRecord.objects.filter(date=today)),
+		usage_week=usage_since(today - timedelta(days=7)),
+		usage_month=usage_since(today - timedelta(days=30)),
+		usage_this_week=usage(AppUsageRollup.objects.filter(period='week', period_start=starts['week'])),
+		usage_this_month=usage(AppUsageRollup.objects.filter(period='month', period_start=starts['month'])),
+	)
+
+
+APP_USAGE_ANNOTATIONS = ('usage_today', 'usage_week', 'usage_month', 'usage_this_week', 'usage_this_month')
+
+
 class AppSerializer(serializers.ModelSerializer):
 	"""Сериализатор для модели App"""
 	usage_today = serializers.SerializerMethodField()
 	usage_week = serializers.SerializerMethodField()
 	usage_month = serializers.SerializerMethodField()
+	usage_this_week = serializers.SerializerMethodField()
+	usage_this_month = serializers.SerializerMethodField()
 	
 	class Meta:
 		model = App
 		fields = [
 			'id', 'package_name', 'app_name', 'category', 'icon_base64',
 			'first_seen', 'last_used', 'total_usage_seconds', 'is_gpt_classified',
-			'usage_today', 'usage_week', 'usage_month'
+			'usage_today', 'usage_week', 'usage_month', 'usage_this_week', 'usage_this_month'
 		]
 		read_only_fields = ['id', 'first_seen', 'last_used', 'total_usage_seconds', 'is_gpt_classified']
 	
+	def _usage(self, obj, name):
+		# Списки приходят из annotate_app_usage; одиночное приложение
+		# (после создания или обновления) считается отдельным запросом
+		if not hasattr(obj, name):
+			usage = annotate_app_usage(App.objects.filter(pk=obj.pk)).values(*APP_USAGE_ANNOTATIONS).first() or {}
+			for key in APP_USAGE_ANNOTATIONS:
+				setattr(obj, key, usage.get(key, 0))
+		return getattr(obj, name)
+	
 	def get_usage_today(self, obj):
 		"""Получить использование за сегодня"""
-		from datetime import date
-		today = date.today()
-		try:
-			usage = obj.usage_records.get(date=today)
-			return usage.usage_seconds
-		except AppUsageRecord.DoesNotExist:
-			return 0
+		return self._usage(obj, 'usage_today')
 	
 	def get_usage_week(self, obj):
-		"""Получить использование за неделю"""
-		from datetime import date, timedelta
-		today = date.today()
-		week_ago = today - timedelta(days=7)
-		usage_records = obj.usage_records.filter(date__gte=week_ago, date__lte=today)
-		return sum(record.usage_seconds for record in usage_records)
+		"""Получить использование за последние 7 дней"""
+		return self._usage(obj, 'usage_week')
 	
 	def get_usage_month(self, obj):
-		"""Получить использование за месяц"""
-		from datetime import date, timedelta
-		today = date.today()
-		month_ago = today - timedelta(days=30)
-		usage_records = obj.usage_records.filter(date__gte=month_ago, date__lte=today)
-		return sum(record.usage_seconds for record in usage_records)
+		"""Получить использование за последние 30 дней"""
+		return self._usage(obj, 'usage_month')
+	
+	def get_usage_this_week(self, obj):
+		"""Получить использование за текущую неделю (с понедельника)"""
+		return self._usage(obj, 'usage_this_week')
+	
+	def get_usage_this_month(self, obj):
+		"""Получить использование за текущий месяц"""
+		return self._usage(obj, 'usage_this_month')
 
 
 class AppUsageRecordSerializer(serializers.ModelSerializer):
@@ -316,18 +455,24 @@ class AchievementStatsSerializer(serializers.ModelSerializer):
 			'app_blocking_count', 'low_screen_time_days', 'first_usage_date',
 			'total_usage_months', 'last_sync_date', 'created_at'
 		]
-		read_only_fields = ['last_sync_date', 'created_at']
+		# Счетчики считает сервер (accounts.achievement_engine): значения
+		# клиента разблокировали бы любые достижения
+		read_only_fields = [
+			'daily_usage_date', 'consecutive_days', 'ai_chat_usage_count',
+			'app_blocking_count', 'low_screen_time_days', 'total_usage_months',
+			'last_sync_date', 'created_at'
+		]
 	
 	def create(self, validated_data):
-		validated_data['user'] = self.context['request'].user
-		# Получаем или создаем статистику для пользователя
-		stats, created = AchievementStats.objects.get_or_create(
-			user=validated_data['user'],
-			defaults=validated_data
-		)
-		if not created:
-			# Обновляем существующую статистику
-			for key, value in validated_data.items():
-				setattr(stats, key, value)
-			stats.save()
+		user = self.context['request'].user
+		stats, created = AchievementStats.objects.select_for_update().get_or_create(user=user)
+		# Дата первого использования с клиента (история до установки новой
+		# версии) только сдвигается раньше, но не раньше регистрации
+		first_usage_date = validated_data.get('first_usage_date')
+		if first_usage_date is not None:
+			first_usage_date = max(first_usage_date, user.date_joined)
+			if stats.first_usage_date is None or first_usage_date < stats.first_usage_date:
+				stats.first_usage_date = first_usage_date
+				stats.total_usage_months = AchievementEngine.months_between(first_usage_date, timezone.now())
+		stats.save()
 		return stats
@@ -1,6 +1,7 @@
 import openai
 import os
 from django.conf import settings
+from core.metrics import external_call
 from .models import ChatSession, ChatMessage, ChatAttachment
 import asyncio
 from typing import List, Dict, Optional
@@ -111,12 +112,13 @@ class ChatGPTService:
                     last_message['content'] = self.process_attachments(user_msg)
             
             # Отправляем в ChatGPT используя старый API
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.7
-            )
+            with external_call('openai'):
+                response = openai.ChatCompletion.create(
+                    model="gpt-3.5-turbo",
+                    messages=messages,
+                    max_tokens=1000,
+                    temperature=0.7
+                )
             
             # Получаем ответ
             assistant_content = response.choices[0].message.content
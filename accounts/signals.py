@@ -0,0 +1,33 @@
+from django.db.models.signals import post_delete, post_save
+
+from .firebase_auth_service import verified_token_cache
+from .models import DeletedRecord, User
+from .sync_views import SYNC_COLLECTIONS
+
+
+def record_deletion(sender, instance, origin=None, **kwargs):
+    """Сохраняет надгробие удаленной записи для дельта-синхронизации"""
+    # При удалении аккаунта каскадные удаления синхронизировать некому
+    if isinstance(origin, User) or getattr(origin, 'model', None) is User:
+        return
+    DeletedRecord.objects.create(
+        user_id=instance.user_id,
+        collection=COLLECTION_BY_MODEL[sender],
+        object_id=instance.pk,
+    )
+
+
+COLLECTION_BY_MODEL = {model: key for key, (model, *_) in SYNC_COLLECTIONS.items()}
+
+for model in COLLECTION_BY_MODEL:
+    post_delete.connect(record_deletion, sender=model, dispatch_uid=f'sync_tombstone_{model.__name__}')
+
+
+def forget_verified_logins(sender, instance, **kwargs):
+    """Удаленный или деактивированный аккаунт не входит повтором кешированного токена"""
+    if kwargs.get('signal') is post_delete or not instance.is_active:
+        verified_token_cache.forget_user(instance.pk)
+
+
+post_save.connect(forget_verified_logins, sender=User, dispatch_uid='forget_verified_logins_save')
+post_delete.connect(forget_verified_logins, sender=User, dispatch_uid='forget_verified_logins_delete')
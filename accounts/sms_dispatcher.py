@@ -0,0 +1,142 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .sms_providers import build_sms_router
+
+logger = logging.getLogger(__name__)
+
+
+STATUS_QUEUED = 'queued'
+STATUS_SENDING = 'sending'
+STATUS_RETRYING = 'retrying'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+
+class SmsDispatcher:
+    """
+    Фоновая отправка SMS.
+
+    enqueue() кладет сообщение в очередь и сразу возвращает message_id, а
+    рабочий поток отправляет его через провайдера (обычно SMSRouter, который
+    ограничивает частоту и переключает провайдеров) с повторами
+    с экспоненциальной задержкой. Статус доставки хранится в кеше
+    и доступен по message_id.
+
+    Очередь живет в памяти процесса: сообщения, не отправленные до остановки
+    процесса, теряются. Для опроса статуса из нескольких процессов нужен общий
+    кеш (Redis).
+    """
+    STATUS_KEY_PREFIX = 'sms_status_'
+
+    def __init__(self, provider, max_attempts=None, backoff=None):
+        self.provider = provider
+        self.max_attempts = settings.SMS_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.backoff = settings.SMS_RETRY_BACKOFF_SECONDS if backoff is None else backoff
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._pending_retries = 0
+
+    def enqueue(self, phone, text, **kwargs):
+        message_id = uuid.uuid4().hex
+        self._set_status(message_id, STATUS_QUEUED, attempts=0)
+        self._queue.put((message_id, phone, text, kwargs, 1))
+        self._ensure_worker()
+        return message_id
+
+    @classmethod
+    def get_status(cls, message_id):
+        # Статус хранится в кеше: читать его можно без создания провайдеров
+        return cache.get(f'{cls.STATUS_KEY_PREFIX}{message_id}')
+
+    def join(self, poll_interval=0.01):
+        """Ждет отправки всех сообщений, включая запланированные повторы (для тестов и команд)"""
+        while True:
+            self._queue.join()
+            with self._lock:
+                if not self._pending_retries:
+                    return
+            time.sleep(poll_interval)
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='sms-dispatcher', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._deliver(*item)
+            except Exception:
+                logger.exception("SMS dispatch failed for message %s", item[0])
+                self._set_status(item[0], STATUS_FAILED, attempts=item[4], error='Internal error')
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, message_id, phone, text, kwargs, attempt):
+        self._set_status(message_id, STATUS_SENDING, attempts=attempt)
+
+        result = self.provider.send_sms(phone, text, **kwargs)
+        provider = result.get('provider', self.provider.name)
+        if result.get('success'):
+            self._set_status(message_id, STATUS_SENT, attempts=attempt, provider=provider)
+            return
+
+        error = result.get('message', 'Unknown error')
+        if result.get('retryable') and attempt < self.max_attempts:
+            delay = self.backoff * (2 ** (attempt - 1))
+            logger.warning("SMS %s attempt %s failed, retry in %ss: %s", message_id, attempt, delay, error)
+            self._set_status(message_id, STATUS_RETRYING, attempts=attempt, error=error, provider=provider)
+            # Повтор планируется таймером, чтобы не блокировать очередь на время задержки
+            with self._lock:
+                self._pending_retries += 1
+            timer = threading.Timer(
+                delay, self._requeue, args=((message_id, phone, text, kwargs, attempt + 1),)
+            )
+            timer.daemon = True
+            timer.start()
+            return
+
+        logger.error("SMS %s failed after %s attempts: %s", message_id, attempt, error)
+        self._set_status(message_id, STATUS_FAILED, attempts=attempt, error=error, provider=provider)
+
+    def _requeue(self, item):
+        self._queue.put(item)
+        with self._lock:
+            self._pending_retries -= 1
+
+    def _set_status(self, message_id, status, attempts, error=None, provider=None):
+        cache.set(f'{self.STATUS_KEY_PREFIX}{message_id}', {
+            'message_id': message_id,
+            'status': status,
+            'attempts': attempts,
+            'provider': provider,
+            'error': error,
+            'updated_at': timezone.now().isoformat(),
+        }, timeout=settings.SMS_STATUS_TTL)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_sms_dispatcher():
+    """Диспетчер для провайдеров из settings.SMS_PROVIDER (создается при первом вызове)"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = SmsDispatcher(build_sms_router())
+    return _dispatcher
@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+
+from core.metrics import external_call
+from .p1sms_service import build_http_session, get_p1sms_service
+
+logger = logging.getLogger(__name__)
+
+
+class SMSProvider:
+    """
+    Интерфейс провайдера SMS.
+
+    send_sms возвращает словарь: success, message (текст ошибки) и retryable -
+    True, если ошибка временная (таймаут, сеть, 5xx) или относится к самому
+    провайдеру (баланс, ключ API), и сообщение можно отправить повторно или
+    через другого провайдера. Ошибка номера получателя не повторяется.
+    """
+    name = None
+
+    def send_sms(self, phone, text, **kwargs):
+        raise NotImplementedError
+
+
+class FakeSMSProvider(SMSProvider):
+    """
+    Локальный провайдер для тестов и разработки.
+
+    Ничего не отправляет, а запоминает сообщения в sent. Задержку и ошибки
+    можно задать, чтобы проверить повторы и таймауты без реального API.
+    """
+    name = 'fake'
+
+    def __init__(self, latency=0.0, failures=None, name=None):
+        if name:
+            self.name = name
+        self.latency = latency
+        # Очередь результатов для первых вызовов: 'retryable' или 'error'
+        self.failures = list(failures or [])
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_sms(self, phone, text, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            failure = self.failures.pop(0) if self.failures else None
+            if failure is None:
+                self.sent.append({'phone': phone, 'text': text, **kwargs})
+        if failure == 'retryable':
+            return {'success': False, 'message': 'Fake provider timeout', 'retryable': True}
+        if failure == 'error':
+            return {'success': False, 'message': 'Fake provider rejected message'}
+        return {'success': True}
+
+
+class SMSRuProvider(SMSProvider):
+    """Отправка через SMS.RU (https://sms.ru/sms/send)"""
+    name = 'smsru'
+    API_URL = 'https://sms.ru/sms/send'
+    # Коды SMS.RU, при которых номер не примет сообщение ни у какого
+    # провайдера: неверный номер, доставка на номер невозможна, номер в
+    # стоп-листе. Остальные ошибки (баланс, ключ, лимиты, сбои) относятся
+    # к аккаунту или провайдеру и переключают на следующего.
+    INVALID_NUMBER_CODES = {202, 207, 209}
+
+    def __init__(self, session=None):
+        self.api_key = settings.SMS_RU_API_KEY
+        self.session = session or build_http_session()
+        self.timeout = (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT)
+
+    def send_sms(self, phone, text, **kwargs):
+        if not self.api_key:
+            return {'success': False, 'message': 'SMS.RU API key not configured', 'retryable': True}
+
+        digits = ''.join(c for c in phone if c.isdigit())
+        try:
+            response = self.session.post(self.API_URL, data={
+                'api_id': self.api_key,
+                'to': digits,
+                'msg': text,
+                'json': 1,
+            }, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except requests.exceptions.RequestException as e:
+            status_code = getattr(e.response, 'status_code', None)
+            retryable = status_code is None or status_code >= 500 or status_code == 429
+            return {'success': False, 'message': f'SMS.RU HTTP error: {e}', 'retryable': retryable}
+        except ValueError:
+            return {'success': False, 'message': 'SMS.RU returned invalid JSON', 'retryable': True}
+
+        if result.get('status') != 'OK':
+            return self._error(result)
+        sms_status = result.get('sms', {}).get(digits, {})
+        if sms_status.get('status') != 'OK':
+            return self._error(sms_status)
+        return {'success': True}
+
+    def _error(self, status):
+        try:
+            code = int(status.get('status_code'))
+        except (TypeError, ValueError):
+            code = None
+        return {
+            'success': False,
+            'message': f"SMS.RU error: {status.get('status_text', 'Unknown error')}",
+            'retryable': code not in self.INVALID_NUMBER_CODES,
+        }
+
+
+class RateLimiter:
+    """Token bucket: не больше rate отправок в секунду"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProviderStats:
+    """
+    Скользящее окно последних отправок провайдера: успех и задержка.
+
+    Отправки старше MAX_SAMPLE_AGE не учитываются, поэтому провайдер,
+    понизившийся из-за сбоя, со временем снова получает трафик.
+    """
+    MAX_SAMPLE_AGE = 300
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, success, latency):
+        with self._lock:
+            self.samples.append((time.monotonic(), success, latency))
+
+    def snapshot(self):
+        min_time = time.monotonic() - self.MAX_SAMPLE_AGE
+        with self._lock:
+            samples = [(success, latency) for recorded, success, latency in self.samples if recorded >= min_time]
+        if not samples:
+            return {'count': 0, 'success_rate': 1.0, 'p95_latency': 0.0}
+        latencies = sorted(latency for _, latency in samples)
+        return {
+            'count': len(samples),
+            'success_rate': sum(1 for success, _ in samples if success) / len(samples),
+            'p95_latency': latencies[int(0.95 * (len(latencies) - 1))],
+        }
+
+
+class SMSRouter(SMSProvider):
+    """
+    Маршрутизация SMS между несколькими провайдерами.
+
+    Для каждого провайдера считаются доля успешных отправок и p95 задержки
+    по последним отправкам. Сообщение уходит самому здоровому провайдеру:
+    сначала провайдеры с долей успеха не ниже HEALTHY_SUCCESS_RATE в порядке
+    p95, затем остальные. При временной ошибке (таймаут, 5xx) сообщение сразу
+    отправляется следующему провайдеру; постоянная ошибка (например, неверный
+    номер) возвращается без перебора.
+    """
+    name = 'router'
+    HEALTHY_SUCCESS_RATE = 0.9
+    # Пока отправок меньше, провайдер считается здоровым, чтобы он получал трафик
+    MIN_SAMPLES = 5
+
+    def __init__(self, providers, rate_limit=None, window=None):
+        self.providers = list(providers)
+        rate = settings.SMS_RATE_LIMIT_PER_SECOND if rate_limit is None else rate_limit
+        self.rate_limiters = {provider.name: RateLimiter(rate) for provider in self.providers}
+        window = window or settings.SMS_ROUTER_WINDOW
+        self.stats = {provider.name: ProviderStats(window) for provider in self.providers}
+
+    def ranked_providers(self):
+        def health(provider):
+            stats = self.stats[provider.name].snapshot()
+            if stats['count'] < self.MIN_SAMPLES:
+                return (False, 0.0, stats['p95_latency'])
+            unhealthy = stats['success_rate'] < self.HEALTHY_SUCCESS_RATE
+            return (unhealthy, -stats['success_rate'] if unhealthy else 0.0, stats['p95_latency'])
+        return sorted(self.providers, key=health)
+
+    def send_sms(self, phone, text, **kwargs):
+        result = {'success': False, 'message': 'No SMS providers configured', 'retryable': False}
+        for provider in self.ranked_providers():
+            self.rate_limiters[provider.name].acquire()
+            started = time.monotonic()
+            try:
+                with external_call(f'sms_{provider.name}'):
+                    result = provider.send_sms(phone, text, **kwargs)
+            except Exception as e:
+                logger.exception("SMS provider %s raised an error", provider.name)
+                result = {'success': False, 'message': str(e), 'retryable': True}
+            success = bool(result.get('success'))
+            # Постоянная ошибка (неверный номер) не говорит о здоровье провайдера
+            if success or result.get('retryable'):
+                self.stats[provider.name].record(success, time.monotonic() - started)
+            result = {**result, 'provider': provider.name}
+            if success or not result.get('retryable'):
+                return result
+            logger.warning("SMS provider %s failed, trying next: %s", provider.name, result.get('message'))
+        return result
+
+    def health(self):
+        """Текущая статистика провайдеров (для мониторинга)"""
+        return {provider.name: self.stats[provider.name].snapshot() for provider in self.providers}
+
+
+PROVIDER_FACTORIES = {
+    'p1sms': get_p1sms_service,
+    'smsru': SMSRuProvider,
+    'fake': FakeSMSProvider,
+}
+
+
+def configured_provider_names():
+    return [name.strip() for name in settings.SMS_PROVIDER.split(',') if name.strip()]
+
+
+def build_sms_router(names=None):
+    """Роутер для провайдеров из settings.SMS_PROVIDER (через запятую, в порядке приоритета)"""
+    if names is None:
+        names = configured_provider_names()
+    unknown = [name for name in names if name not in PROVIDER_FACTORIES]
+    if unknown:
+        raise ImproperlyConfigured(
+            f"Unknown SMS providers: {', '.join(unknown)}. Available: {', '.join(PROVIDER_FACTORIES)}"
+        )
+    return SMSRouter([PROVIDER_FACTORIES[name]() for name in names])
+
+
+def check_sms_providers(app_configs, **kwargs):
+    """Проверка SMS_PROVIDER при запуске, а не при первой отправке"""
+    if settings.SMS_PROVIDER == 'stub':
+        return []
+    unknown = [name for name in configured_provider_names() if name not in PROVIDER_FACTORIES]
+    if not unknown:
+        return []
+    return [checks.Error(
+        f"SMS_PROVIDER contains unknown providers: {', '.join(unknown)}",
+        hint=f"Use 'stub' or a comma-separated list of: {', '.join(PROVIDER_FACTORIES)}",
+        id='accounts.E001',
+    )]
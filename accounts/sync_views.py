@@ -0,0 +1,96 @@
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from core.query_budget import query_budget
+from .models import (
+    Achievement, App, DailyNote, DailyTimeline, DailyTimelineArchive, DeletedRecord, Habit, UserExperience,
+)
+from .serializers import (
+    AchievementSerializer, AppSerializer, DailyNoteSerializer, DailyTimelineSerializer,
+    HabitSerializer, UserExperienceSerializer, UserSerializer, annotate_app_usage,
+)
+
+
+# Ключ в ответе -> (модель, сериализатор, поле с временем изменения, подготовка queryset)
+SYNC_COLLECTIONS = {
+    'habits': (Habit, HabitSerializer, 'updated_at', None),
+    'daily_notes': (DailyNote, DailyNoteSerializer, 'updated_at', None),
+    'achievements': (Achievement, AchievementSerializer, 'updated_at', None),
+    'apps': (App, AppSerializer, 'last_used', annotate_app_usage),
+    'timeline': (DailyTimeline, DailyTimelineSerializer, 'updated_at', None),
+    'experience': (UserExperience, UserExperienceSerializer, 'updated_at', None),
+}
+
+
+@method_decorator(query_budget(10), name='dispatch')
+class SyncView(APIView):
+    """
+    Дельта-синхронизация клиента за один запрос.
+
+    GET /api/sync/?since=<cursor> возвращает записи всех коллекций, измененные
+    после курсора, и id удаленных записей. Без since возвращается все.
+    Полученный cursor клиент передает в следующий запрос.
+
+    Курсор отстает на SYNC_CURSOR_OVERLAP_SECONDS, поэтому часть записей
+    приходит повторно: клиент применяет их по id. full=true означает полный
+    снимок (без since или с курсором старше хранения надгробий), и клиент
+    заменяет им локальные данные.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        since = None
+        since_str = request.query_params.get('since')
+        if since_str:
+            since = parse_datetime(since_str)
+            if since is None:
+                return Response({'error': 'Invalid cursor. Use ISO 8601 datetime'}, status=400)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, dt_timezone.utc)
+
+        now = timezone.now()
+        tombstone_days = settings.RETENTION_DELETED_RECORDS_DAYS
+        if since is not None and tombstone_days and since < now - timedelta(days=tombstone_days):
+            # Надгробия после такого курсора могли уже удалить
+            since = None
+
+        # Курсор фиксируется до чтения и с запасом: строка, закоммиченная
+        # после чтения, могла получить updated_at раньше момента чтения
+        cursor = now - timedelta(seconds=settings.SYNC_CURSOR_OVERLAP_SECONDS)
+        user = request.user
+        context = {'request': request}
+
+        data = {'cursor': cursor.isoformat().replace('+00:00', 'Z'), 'full': since is None}
+        for key, (model, serializer_class, timestamp_field, prepare) in SYNC_COLLECTIONS.items():
+            queryset = model.objects.filter(user=user)
+            if prepare is not None:
+                queryset = prepare(queryset)
+            if since is not None:
+                queryset = queryset.filter(**{f'{timestamp_field}__gt': since})
+            data[key] = serializer_class(queryset, many=True, context=context).data
+        if since is None:
+            # Полная синхронизация отдает и архивную историю; архив не
+            # меняется, поэтому дельте он не нужен
+            archived = DailyTimelineArchive.objects.filter(user=user)
+            data['timeline'] += DailyTimelineSerializer(archived, many=True, context=context).data
+
+        if since is None or user.updated_at > since:
+            data['profile'] = UserSerializer(user, context=context).data
+        else:
+            data['profile'] = None
+
+        deleted = {key: [] for key in SYNC_COLLECTIONS}
+        if since is not None:
+            tombstones = DeletedRecord.objects.filter(user=user, deleted_at__gt=since)
+            for collection, object_id in tombstones.values_list('collection', 'object_id'):
+                deleted.setdefault(collection, []).append(object_id)
+        data['deleted'] = deleted
+
+        return Response(data)
@@ -1,3 +1,1351 @@
-from django.test import TestCase
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import prometheus_client
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, router
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import URLPattern
+from prometheus_client import values as prometheus_values
+from prometheus_client.parser import text_string_to_metric_families
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+from rest_framework.views import APIView
+
+from core import logging_utils, metrics
+from core.db_routers import ReplicaRoutingMiddleware
+from core.logging_utils import JsonFormatter, QueueLogHandler, SamplingFilter, parse_sample_rates
+from core.profiling import list_profiles, profile_path, prune_profiles
+from core.query_budget import QueryBudgetExceeded, get_query_budget, query_budget
+from .achievement_engine import achievement_engine
+from .archive import archive_boundary
+from .authentication import StatelessJWTAuthentication, authenticate_credentials
+from .firebase_auth_service import (
+    FirebaseTokenError, FirebaseTokenVerifier, firebase_auth_service, verified_token_cache,
+)
+from .models import (
+    Achievement, AchievementStats, App, AppUsage, AppUsageRecord, AppUsageRecordArchive, AppUsageRollup,
+    ChatAttachment, ChatMessage, ChatSession, DailyNote, DailyTimeline, DailyTimelineArchive, DeletedRecord, Habit,
+    TimelineRollup, User, UserExperience,
+)
+from .p1sms_service import P1SMSService
+from .retention import RAW_DELETE_MODELS, raw_delete
+from .rollups import period_starts
+from .sms_providers import FakeSMSProvider, SMSRouter, SMSRuProvider, build_sms_router, check_sms_providers
+from .throttling import AchievementEventThrottle, AuthIPThrottle, PhoneThrottle
+from .tokens import UserRefreshToken, user_from_claims
+from .urls import urlpatterns
+
+
+class QueryBudgetDecoratorTests(SimpleTestCase):
+    databases = ['default']
+
+    def setUp(self):
+        def view(request):
+            list(User.objects.all())
+            list(User.objects.all())
+            return 'ok'
+        self.view = view
+        self.request = RequestFactory().get('/budget/')
+
+    @override_settings(QUERY_BUDGET_ACTION='raise')
+    def test_raises_when_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            query_budget(1)(self.view)(self.request)
+
+    @override_settings(QUERY_BUDGET_ACTION='raise')
+    def test_per_method_budget(self):
+        self.assertEqual(query_budget(1, get=2)(self.view)(self.request), 'ok')
+
+    @override_settings(QUERY_BUDGET_ACTION='log')
+    def test_logs_in_production(self):
+        with self.assertLogs('core.query_budget', level='WARNING') as logs:
+            self.assertEqual(query_budget(1)(self.view)(self.request), 'ok')
+        self.assertIn('2 SQL queries, budget 1', logs.output[0])
+
+
+class QueryBudgetCoverageTests(SimpleTestCase):
+    def test_every_view_declares_budget(self):
+        missing = [
+            pattern.name for pattern in urlpatterns
+            if isinstance(pattern, URLPattern) and get_query_budget(pattern.callback) is None
+        ]
+        self.assertEqual(missing, [])
+
+
+@override_settings(QUERY_BUDGET_ACTION='raise')
+class QueryBudgetTestCase(TestCase):
+    """Тесты эндпоинтов: превышение бюджета запросов роняет тест, а не пишется в лог"""
+
+
+class QueryCountIndependentOfDataTests(QueryBudgetTestCase):
+    """
+    Эндпоинты укладываются в бюджет и делают одинаковое число запросов
+    для пользователя с одной записью и с десятками записей
+    """
+
+    def make_user(self, name, size):
+        user = User.objects.create_user(username=name, password=None)
+        today = date.today()
+        days = [today - timedelta(days=offset) for offset in range(size)]
+        for index in range(size):
+            app = App.objects.create(user=user, package_name=f'com.{name}.app{index}', app_name=f'App {index}')
+            AppUsageRecord.objects.bulk_create([
+                AppUsageRecord(app=app, date=day, usage_seconds=60) for day in days
+            ])
+            session = ChatSession.objects.create(user=user, title=f'Chat {index}')
+            ChatMessage.objects.bulk_create([
+                ChatMessage(session=session, role='user', content=f'Message {number}') for number in range(size)
+            ])
+            Habit.objects.create(user=user, name=f'Habit {index}', habit_type='good')
+            Achievement.objects.create(
+                user=user, achievement_id=f'achievement_{index}', title='Title', description='Description',
+                icon_code_point=1, achievement_type='daily_streak', required_value=index + 1,
+            )
+        for day in days:
+            DailyTimeline.objects.create(user=user, date=day)
+            UserExperience.objects.create(user=user, date=day, total_experience=100)
+            note = DailyNote.objects.create(user=user, date=day, mood=3)
+            AppUsage.objects.create(
+                user=user, date=day, app_name='App', app_category='useful', usage_time_seconds=60
+            )
+        return user
+
+    def count_queries(self, user, method, path, data=None):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(user).access_token}')
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 300, f'{method.upper()} {path}: {response.status_code}')
+        return len(queries)
+
+    def paths(self, user):
+        session = user.chat_sessions.first()
+        app = user.apps.first()
+        note = user.daily_notes.first()
+        return [
+            ('get', '/api/apps/', None),
+            ('get', f'/api/apps/{app.id}/', None),
+            ('get', '/api/chat/sessions/', None),
+            ('get', f'/api/chat/sessions/{session.id}/', None),
+            ('get', f'/api/chat/sessions/{session.id}/messages/', None),
+            ('get', '/api/habits/', None),
+            ('get', '/api/daily-notes/', None),
+            ('get', f'/api/daily-notes/date/{note.date}/', None),
+            ('get', '/api/user/profile/', None),
+            ('get', '/api/achievements/', None),
+            ('post', '/api/achievements/sync/', {'achievements': [{
+                'id': 'achievement_new', 'title': 'Title', 'description': 'Description',
+                'icon_code_point': 1, 'achievement_type': 'daily_streak', 'required_value': 1,
+            }]}),
+            ('get', f'/api/timeline/?date={date.today()}', None),
+            ('get', '/api/timeline/stats/', None),
+            ('get', '/api/experience/', None),
+            ('get', '/api/sync/', None),
+        ]
+
+    def test_query_count_does_not_grow_with_data(self):
+        small = self.make_user('small', 1)
+        large = self.make_user('large', 10)
+        for (method, small_path, data), (_, large_path, _) in zip(self.paths(small), self.paths(large)):
+            with self.subTest(path=large_path):
+                self.assertEqual(
+                    self.count_queries(small, method, small_path, data),
+                    self.count_queries(large, method, large_path, data),
+                )
+
+
+@override_settings(REPLICA_DATABASES=['replica_0'], DATABASE_ROUTERS=['core.db_routers.ReplicaRouter'])
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = ReplicaRoutingMiddleware(lambda request: router.db_for_read(User))
+        token = jwt.encode({'user_id': 7}, 'secret', algorithm='HS256')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.middleware(self.factory.get('/api/apps/', **self.headers)), 'replica_0')
+
+    def test_writes_use_default(self):
+        self.assertEqual(self.middleware(self.factory.post('/api/habits/', **self.headers)), 'default')
+
+    def test_reads_stick_to_default_after_own_write(self):
+        self.middleware(self.factory.post('/api/habits/', **self.headers))
+        self.assertEqual(self.middleware(self.factory.get('/api/habits/', **self.headers)), 'default')
+        self.assertEqual(self.middleware(self.factory.get('/api/habits/')), 'replica_0')
+
+    def test_login_without_token_sticks_issued_user_to_default(self):
+        issued = jwt.encode({'user_id': 7}, 'secret', algorithm='HS256')
+        login = ReplicaRoutingMiddleware(lambda request: Response({'access': issued, 'refresh': 'x'}))
+        login(self.factory.post('/api/auth/firebase/phone/'))
+        self.assertEqual(self.middleware(self.factory.get('/api/user/profile/', **self.headers)), 'default')
+
+    def test_failed_login_does_not_stick(self):
+        failed = ReplicaRoutingMiddleware(lambda request: Response({'access': 'not-a-token'}, status=400))
+        failed(self.factory.post('/api/auth/token/'))
+        self.assertEqual(self.middleware(self.factory.get('/api/user/profile/', **self.headers)), 'replica_0')
+
+    def test_reads_outside_requests_use_default(self):
+        self.assertEqual(router.db_for_read(User), 'default')
+
+    @override_settings(REPLICA_DATABASES=[])
+    def test_without_replicas(self):
+        self.assertEqual(self.middleware(self.factory.get('/api/apps/', **self.headers)), 'default')
+
+
+@override_settings(HISTORY_HOT_DAYS=60)
+class HistoryArchiveTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='archive', password=None)
+        self.app = App.objects.create(user=self.user, package_name='com.archive.app', app_name='App')
+        self.old_day = archive_boundary() - timedelta(days=1)
+        self.today = date.today()
+        for day in (self.old_day, self.today):
+            DailyTimeline.objects.create(user=self.user, date=day, total_screen_time_seconds=100)
+            AppUsageRecord.objects.create(app=self.app, date=day, usage_seconds=60)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def archive(self):
+        call_command('archive_history', stdout=io.StringIO())
+
+    def test_dry_run_lists_months(self):
+        output = io.StringIO()
+        call_command('archive_history', dry_run=True, stdout=output)
+        self.assertIn(f'{self.old_day:%Y-%m}: 1', output.getvalue())
+        self.assertEqual(DailyTimeline.objects.count(), 2)
+
+    def test_moves_only_whole_old_months(self):
+        created_at = DailyTimeline.objects.get(date=self.old_day).created_at
+        self.archive()
+        self.assertEqual(list(DailyTimeline.objects.values_list('date', flat=True)), [self.today])
+        self.assertEqual(list(AppUsageRecord.objects.values_list('date', flat=True)), [self.today])
+        self.assertEqual(DailyTimelineArchive.objects.get().created_at, created_at)
+        self.assertEqual(AppUsageRecordArchive.objects.get().date, self.old_day)
+        # Перенос в архив не попадает в синхронизацию как удаление
+        self.assertFalse(DeletedRecord.objects.exists())
+
+    def test_reads_archived_day(self):
+        self.archive()
+        response = self.client.get(f'/api/timeline/?date={self.old_day}')
+        self.assertEqual(response.json()['total_screen_time_seconds'], 100)
+        self.assertFalse(DailyTimeline.objects.filter(date=self.old_day).exists())
+
+    def test_write_restores_archived_day(self):
+        self.archive()
+        response = self.client.post('/api/timeline/', {
+            'date': str(self.old_day), 'segments': [{'index': 0, 'useful_seconds': 30, 'harmful_seconds': 0}],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(DailyTimelineArchive.objects.exists())
+        self.assertEqual(DailyTimeline.objects.get(date=self.old_day).total_useful_seconds, 30)
+
+        response = self.client.post(
+            f'/api/apps/{self.app.id}/usage/', {'date': str(self.old_day), 'usage_seconds': 15}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(AppUsageRecordArchive.objects.exists())
+        self.assertEqual(AppUsageRecord.objects.get(date=self.old_day).usage_seconds, 75)
+
+    def test_full_sync_includes_archive(self):
+        self.archive()
+        dates = [row['date'] for row in self.client.get('/api/sync/').json()['timeline']]
+        self.assertEqual(dates, [str(self.today), str(self.old_day)])
+
+    def test_restore_month(self):
+        self.archive()
+        call_command('archive_history', restore=f'{self.old_day:%Y-%m}', stdout=io.StringIO())
+        self.assertFalse(DailyTimelineArchive.objects.exists())
+        self.assertEqual(DailyTimeline.objects.count(), 2)
+        self.assertEqual(AppUsageRecord.objects.count(), 2)
+
+
+class UsageRollupTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='rollup', password=None)
+        self.app = App.objects.create(user=self.user, package_name='com.rollup.app', app_name='App')
+        self.today = date.today()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def add_usage(self, day, seconds):
+        response = self.client.post(
+            f'/api/apps/{self.app.id}/usage/', {'date': str(day), 'usage_seconds': seconds}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def save_timeline(self, method, day, useful_seconds):
+        response = getattr(self.client, method)('/api/timeline/', {
+            'date': str(day), 'segments': [{'index': 0, 'useful_seconds': useful_seconds, 'harmful_seconds': 5}],
+        }, format='json')
+        self.assertLess(response.status_code, 300)
+
+    def rollups(self):
+        return sorted(
+            list(AppUsageRollup.objects.values_list('period', 'period_start', 'usage_seconds', 'sessions_count'))
+            + list(TimelineRollup.objects.values_list('period', 'period_start', 'total_useful_seconds', 'sessions_count'))
+        )
+
+    def test_usage_writes_update_rollups(self):
+        self.add_usage(self.today, 60)
+        self.add_usage(self.today, 30)
+        self.add_usage(self.today - timedelta(days=400), 1000)
+        month = AppUsageRollup.objects.get(period='month', period_start=period_starts(self.today)['month'])
+        self.assertEqual((month.usage_seconds, month.sessions_count), (90, 2))
+
+        app = self.client.get(f'/api/apps/{self.app.id}/').json()
+        self.assertEqual((app['usage_today'], app['usage_week'], app['usage_month']), (90, 90, 90))
+        self.assertEqual((app['usage_this_week'], app['usage_this_month']), (90, 90))
+
+    def test_week_and_month_stay_rolling_windows(self):
+        starts = period_starts(self.today)
+        for days_ago, seconds in ((0, 1), (6, 10), (20, 100), (40, 1000)):
+            self.add_usage(self.today - timedelta(days=days_ago), seconds)
+
+        app = next(app for app in self.client.get('/api/apps/').json() if app['id'] == self.app.id)
+        self.assertEqual((app['usage_today'], app['usage_week'], app['usage_month']), (1, 11, 111))
+
+        def calendar(start):
+            return sum(seconds for days_ago, seconds in ((0, 1), (6, 10), (20, 100), (40, 1000))
+                       if self.today - timedelta(days=days_ago) >= start)
+        self.assertEqual(
+            (app['usage_this_week'], app['usage_this_month']), (calendar(starts['week']), calendar(starts['month'])),
+        )
+
+    def test_failed_rollup_rolls_back_daily_record(self):
+        self.add_usage(self.today, 60)
+        self.save_timeline('post', self.today, 30)
+        with mock.patch('accounts.app_views.add_app_usage', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.add_usage(self.today, 30)
+        with mock.patch('accounts.views.add_timeline_change', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.save_timeline('put', self.today, 10)
+
+        self.assertEqual(AppUsageRecord.objects.get(app=self.app, date=self.today).usage_seconds, 60)
+        self.assertEqual(App.objects.get(pk=self.app.pk).total_usage_seconds, 60)
+        self.assertEqual(DailyTimeline.objects.get(user=self.user, date=self.today).total_useful_seconds, 30)
+
+    def test_timeline_writes_apply_difference(self):
+        self.save_timeline('post', self.today, 30)
+        self.save_timeline('put', self.today, 10)
+        stats = self.client.get(f'/api/timeline/stats/?date={self.today}').json()
+        for period in ('week', 'month', 'year', 'all_time'):
+            self.assertEqual(stats[period]['total_useful_seconds'], 10)
+            self.assertEqual(stats[period]['total_screen_time_seconds'], 15)
+        self.assertEqual(stats['month']['period_start'], str(period_starts(self.today)['month']))
+
+    def test_rebuild_matches_incremental(self):
+        for offset in (0, 3, 40, 400):
+            day = self.today - timedelta(days=offset)
+            self.add_usage(day, 60 + offset)
+            self.save_timeline('post', day, offset)
+        incremental = self.rollups()
+        AppUsageRollup.objects.update(usage_seconds=0)
+        TimelineRollup.objects.all().delete()
+
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+
+@override_settings(
+    RETENTION_DAILY_DAYS=365, RETENTION_EXPERIENCE_DAYS=365, RETENTION_CHAT_MESSAGES_DAYS=0,
+    RETENTION_DELETED_CHATS_DAYS=30,
+)
+class RetentionTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='retention', password=None)
+        self.app = App.objects.create(user=self.user, package_name='com.retention.app', app_name='App')
+        self.today = date.today()
+        self.old_day = self.today - timedelta(days=400)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def retention(self, *args, **options):
+        output = io.StringIO()
+        call_command('apply_retention', *args, batch_size=1, pause=0, stdout=output, **options)
+        return output.getvalue()
+
+    def make_chat(self, is_active, deleted_days_ago=0):
+        session = ChatSession.objects.create(user=self.user, is_active=is_active)
+        message = ChatMessage.objects.create(session=session, role='user', content='Message', has_attachments=True)
+        ChatAttachment.objects.create(
+            message=message, file='chat_attachments/missing.png', file_type='image', file_name='missing.png', file_size=1,
+        )
+        ChatSession.objects.filter(pk=session.pk).update(updated_at=timezone.now() - timedelta(days=deleted_days_ago))
+        return session
+
+    def test_compacts_daily_history_into_rollups(self):
+        for day in (self.old_day, self.today):
+            self.client.post(f'/api/apps/{self.app.id}/usage/', {'date': str(day), 'usage_seconds': 60}, format='json')
+            self.client.post('/api/timeline/', {
+                'date': str(day), 'segments': [{'index': 0, 'useful_seconds': 60, 'harmful_seconds': 0}],
+            }, format='json')
+        year_start = period_starts(self.old_day)['year']
+        self.retention(policy=['daily_history'])
+
+        self.assertEqual(list(AppUsageRecord.objects.values_list('date', flat=True)), [self.today])
+        self.assertEqual(list(DailyTimeline.objects.values_list('date', flat=True)), [self.today])
+        self.assertFalse(DeletedRecord.objects.exists())
+        # Пересчет не трогает периоды, дневных записей которых уже нет
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(AppUsageRollup.objects.get(period='year', period_start=year_start).usage_seconds, 60)
+        self.assertEqual(
+            TimelineRollup.objects.get(period='year', period_start=year_start).total_useful_seconds, 60
+        )
+
+    def test_deletes_soft_deleted_chats_after_grace_period(self):
+        expired = self.make_chat(is_active=False, deleted_days_ago=31)
+        recent = self.make_chat(is_active=False, deleted_days_ago=1)
+        active = self.make_chat(is_active=True, deleted_days_ago=100)
+        self.retention(policy=['deleted_chats'])
+
+        self.assertEqual(set(ChatSession.objects.values_list('pk', flat=True)), {recent.pk, active.pk})
+        self.assertFalse(ChatMessage.objects.filter(session_id=expired.pk).exists())
+        self.assertEqual(ChatAttachment.objects.count(), 2)
+
+    def test_keeps_latest_experience(self):
+        for offset in (800, 500, 400):
+            UserExperience.objects.create(user=self.user, date=self.today - timedelta(days=offset))
+        other = User.objects.create_user(username='retention_other', password=None)
+        UserExperience.objects.create(user=other, date=self.old_day)
+        self.retention(policy=['experience'])
+
+        self.assertEqual(list(self.user.experience_records.values_list('date', flat=True)), [self.old_day])
+        self.assertEqual(other.experience_records.count(), 1)
+
+    def test_dry_run_deletes_nothing(self):
+        self.make_chat(is_active=False, deleted_days_ago=31)
+        output = self.retention(dry_run=True)
+        self.assertIn('ChatSession: 1', output)
+        self.assertNotIn('chat_messages', output)
+        self.assertEqual(ChatSession.objects.count(), 1)
+
+    def test_raw_deleted_models_have_no_other_references(self):
+        # Новая ссылка на эти модели оставила бы после raw_delete висячие строки
+        for model, cleared in RAW_DELETE_MODELS.items():
+            references = {relation.related_model for relation in model._meta.related_objects}
+            self.assertEqual(references, set(cleared), model.__name__)
+            self.assertEqual(model._meta.many_to_many, (), model.__name__)
+        with self.assertRaises(ValueError):
+            raw_delete(App.objects.all())
+        self.assertEqual(App.objects.count(), 1)
+
+
+class AchievementEngineTests(QueryBudgetTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='achiever', password=None)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+        self.today = date.today()
+
+    def make_achievement(self, achievement_type, required_value):
+        return Achievement.objects.create(
+            user=self.user, achievement_id=f'{achievement_type}_{required_value}', title='Title',
+            description='Description', icon_code_point=1, achievement_type=achievement_type,
+            required_value=required_value,
+        )
+
+    def record_activity_on(self, today, activity_date):
+        with mock.patch('accounts.achievement_engine.timezone.localdate', return_value=today):
+            return achievement_engine.record_activity(self.user, activity_date)
+
+    def test_record_activity_counts_streak_and_low_screen_time(self):
+        streak = self.make_achievement('daily_streak', 4)
+        DailyTimeline.objects.create(user=self.user, date=self.today - timedelta(days=3), total_screen_time_seconds=60)
+        for offset in (3, 2, 1):
+            day = self.today - timedelta(days=offset)
+            self.assertEqual(self.record_activity_on(day, day), [])
+        # Повтор того же дня не продлевает серию
+        self.record_activity_on(self.today, self.today - timedelta(days=1))
+        unlocked = self.record_activity_on(self.today, self.today)
+
+        self.assertEqual([achievement.pk for achievement in unlocked], [streak.pk])
+        stats = AchievementStats.objects.get(user=self.user)
+        self.assertEqual((stats.consecutive_days, stats.low_screen_time_days), (4, 1))
+
+        self.record_activity_on(self.today + timedelta(days=3), self.today + timedelta(days=3))
+        stats.refresh_from_db()
+        self.assertEqual(stats.consecutive_days, 1)
+
+    def test_client_dates_outside_today_and_yesterday_are_ignored(self):
+        self.make_achievement('daily_streak', 3)
+        for offset in (5, 4, 3, 2):
+            self.assertEqual(self.record_activity_on(self.today, self.today - timedelta(days=offset)), [])
+        self.assertEqual(self.record_activity_on(self.today, date(2099, 1, 1)), [])
+        self.assertFalse(AchievementStats.objects.filter(user=self.user).exists())
+
+        # Будущая дата через API не останавливает серию
+        self.client.post('/api/timeline/', {'date': '2099-01-01', 'segments': []}, format='json')
+        self.record_activity_on(self.today, self.today)
+        stats = AchievementStats.objects.get(user=self.user)
+        self.assertEqual((stats.daily_usage_date, stats.consecutive_days), (self.today, 1))
+
+    def test_unlocks_once_threshold_is_reached(self):
+        blocking = self.make_achievement('app_blocking', 2)
+        self.assertEqual(achievement_engine.record_app_blocking(self.user), [])
+        self.assertEqual(achievement_engine.record_app_blocking(self.user), [blocking])
+        self.assertEqual(achievement_engine.record_app_blocking(self.user), [])
+        blocking.refresh_from_db()
+        self.assertTrue(blocking.is_unlocked)
+
+    def test_event_endpoint_accepts_only_client_side_events(self):
+        for event in ('ai_chat_usage', 'daily_usage', ['app_blocking'], None):
+            with self.subTest(event=event):
+                response = self.client.post('/api/achievements/events/', {'event': event}, format='json')
+                self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/achievements/events/', {'event': 'app_blocking'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AchievementStats.objects.get(user=self.user).app_blocking_count, 1)
+
+    def test_event_endpoint_is_throttled(self):
+        with mock.patch.object(AchievementEventThrottle, 'THROTTLE_RATES', {'achievement_event': '2/hour'}):
+            codes = [
+                self.client.post('/api/achievements/events/', {'event': 'app_blocking'}, format='json').status_code
+                for _ in range(3)
+            ]
+        self.assertEqual(codes, [200, 200, 429])
+        self.assertEqual(AchievementStats.objects.get(user=self.user).app_blocking_count, 2)
+
+    def test_stats_post_does_not_inflate_counters(self):
+        self.make_achievement('ai_chat_usage', 10)
+        response = self.client.post('/api/achievements/stats/', {
+            'consecutive_days': 1000, 'ai_chat_usage_count': 1000, 'app_blocking_count': 1000,
+            'first_usage_date': '2000-01-01T00:00:00Z',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        stats = AchievementStats.objects.get(user=self.user)
+        self.assertEqual((stats.consecutive_days, stats.ai_chat_usage_count, stats.app_blocking_count), (0, 0, 0))
+        self.assertEqual(stats.first_usage_date, self.user.date_joined)
+        self.assertFalse(Achievement.objects.filter(user=self.user, is_unlocked=True).exists())
+
+
+class AchievementSyncTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='syncer', password=None)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def payload(self, achievement_id, **fields):
+        return {
+            'id': achievement_id, 'title': 'Title', 'description': 'Description', 'icon_code_point': 1,
+            'achievement_type': 'daily_streak', 'required_value': 3, **fields,
+        }
+
+    def sync(self, *achievements):
+        response = self.client.post('/api/achievements/sync/', {'achievements': list(achievements)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return sorted(achievement['achievement_id'] for achievement in response.json())
+
+    def test_returns_only_changed_achievements(self):
+        self.assertEqual(self.sync(self.payload('first'), self.payload('second')), ['first', 'second'])
+        updated_at = Achievement.objects.get(achievement_id='first').updated_at
+
+        self.assertEqual(self.sync(self.payload('first'), self.payload('second', title='Renamed')), ['second'])
+        self.assertEqual(self.sync(self.payload('first'), self.payload('second', title='Renamed')), [])
+        self.assertEqual(Achievement.objects.get(achievement_id='first').updated_at, updated_at)
+        self.assertEqual(Achievement.objects.get(achievement_id='second').title, 'Renamed')
+
+    def test_client_cannot_unlock_or_lower_threshold(self):
+        self.sync(self.payload('first', is_unlocked=True, unlocked_at='2026-01-01T00:00:00Z'))
+        self.assertEqual(self.sync(self.payload('first', required_value=1, achievement_type='app_blocking')), [])
+
+        achievement = Achievement.objects.get(achievement_id='first')
+        self.assertEqual((achievement.is_unlocked, achievement.unlocked_at), (False, None))
+        self.assertEqual((achievement.achievement_type, achievement.required_value), ('daily_streak', 3))
+
+    def test_new_achievement_is_unlocked_by_engine(self):
+        AchievementStats.objects.create(user=self.user, consecutive_days=5)
+        self.sync(self.payload('reached'), self.payload('far', required_value=10))
+        self.assertEqual(
+            list(Achievement.objects.filter(is_unlocked=True).values_list('achievement_id', flat=True)), ['reached'],
+        )
+
+    def test_last_duplicate_wins(self):
+        self.assertEqual(self.sync(self.payload('first', title='Old'), self.payload('first', title='New')), ['first'])
+        self.assertEqual(list(Achievement.objects.values_list('title', flat=True)), ['New'])
+
+
+class ConditionalGetTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='etag', password=None)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+        Habit.objects.create(user=self.user, name='Habit', habit_type='good')
+
+    def get(self, path, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(path, **headers)
+
+    def test_matching_etag_returns_not_modified(self):
+        for path in ('/api/habits/', '/api/apps/', '/api/achievements/', '/api/daily-notes/', '/api/user/profile/'):
+            with self.subTest(path=path):
+                response = self.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('private', response['Cache-Control'])
+                self.assertIn('Authorization', response['Vary'])
+
+                cached = self.get(path, response['ETag'])
+                self.assertEqual(cached.status_code, 304)
+                self.assertEqual(cached.content, b'')
+
+    def test_change_invalidates_etag(self):
+        etag = self.get('/api/habits/')['ETag']
+        Habit.objects.create(user=self.user, name='Another', habit_type='bad')
+        response = self.get('/api/habits/', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_query_and_user(self):
+        etag = self.get('/api/habits/')['ETag']
+        self.assertEqual(self.get('/api/habits/?type=good', etag).status_code, 200)
+
+        other = User.objects.create_user(username='etag_other', password=None)
+        Habit.objects.create(user=other, name='Habit', habit_type='good')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(other).access_token}')
+        self.assertEqual(self.get('/api/habits/', etag).status_code, 200)
+
+
+@override_settings(SYNC_CURSOR_OVERLAP_SECONDS=30, RETENTION_DELETED_RECORDS_DAYS=90)
+class DeltaSyncTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='delta', password=None)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def sync(self, since=None):
+        response = self.client.get('/api/sync/', {'since': since.isoformat()} if since else None)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_deletion_leaves_tombstone(self):
+        habit = Habit.objects.create(user=self.user, name='Habit', habit_type='good')
+        DailyTimeline.objects.create(user=self.user, date=date.today())
+        since = timezone.now() - timedelta(seconds=1)
+        habit_id = habit.pk
+        habit.delete()
+        self.user.daily_timelines.all().delete()
+
+        deleted = self.sync(since)['deleted']
+        self.assertEqual(deleted['habits'], [habit_id])
+        self.assertEqual(len(deleted['timeline']), 1)
+        self.assertEqual(DeletedRecord.objects.filter(user=self.user).count(), 2)
+
+    def test_account_deletion_leaves_no_tombstones(self):
+        Habit.objects.create(user=self.user, name='Habit', habit_type='good')
+        self.user.delete()
+        self.assertFalse(DeletedRecord.objects.exists())
+
+    def test_since_returns_only_newer_changes(self):
+        old = Habit.objects.create(user=self.user, name='Old', habit_type='good')
+        Habit.objects.filter(pk=old.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        since = timezone.now() - timedelta(minutes=1)
+        new = Habit.objects.create(user=self.user, name='New', habit_type='good')
+
+        data = self.sync(since)
+        self.assertFalse(data['full'])
+        self.assertEqual([habit['id'] for habit in data['habits']], [new.pk])
+        self.assertEqual(len(self.sync()['habits']), 2)
+
+    def test_cursor_overlaps_read_time(self):
+        data = self.sync()
+        before = timezone.now()
+        self.assertTrue(data['full'])
+        cursor = timezone.datetime.fromisoformat(data['cursor'].replace('Z', '+00:00'))
+        self.assertLessEqual(cursor, before - timedelta(seconds=30))
+
+        # Запись с updated_at внутри перекрытия приходит и по новому курсору
+        habit = Habit.objects.create(user=self.user, name='Late', habit_type='good')
+        Habit.objects.filter(pk=habit.pk).update(updated_at=before - timedelta(seconds=10))
+        self.assertEqual([item['id'] for item in self.sync(cursor)['habits']], [habit.pk])
+
+    def test_cursor_older_than_tombstones_gets_full_sync(self):
+        Habit.objects.create(user=self.user, name='Habit', habit_type='good')
+        data = self.sync(timezone.now() - timedelta(days=91))
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['habits']), 1)
+
+    def test_retention_prunes_old_tombstones(self):
+        for pk in (1, 2):
+            DeletedRecord.objects.create(user=self.user, collection='habits', object_id=pk)
+        DeletedRecord.objects.filter(object_id=1).update(deleted_at=timezone.now() - timedelta(days=91))
+        call_command('apply_retention', policy=['deleted_records'], pause=0, stdout=io.StringIO())
+        self.assertEqual(list(DeletedRecord.objects.values_list('object_id', flat=True)), [2])
+
+
+@override_settings(HISTORY_HOT_DAYS=60)
+class DailyNoteAppUsageTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='notes', password=None)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+        self.today = date.today()
+        self.old_day = self.today - timedelta(days=200)
+        useful = App.objects.create(user=self.user, package_name='com.notes.useful', app_name='Useful', category='useful')
+        harmful = App.objects.create(user=self.user, package_name='com.notes.harmful', app_name='Harmful', category='harmful')
+        AppUsageRecord.objects.create(app=useful, date=self.today, usage_seconds=60)
+        AppUsageRecord.objects.create(app=harmful, date=self.today, usage_seconds=120)
+        AppUsageRecordArchive.objects.create(id=1000, app=useful, date=self.old_day, usage_seconds=30)
+        other = User.objects.create_user(username='notes_other', password=None)
+        other_app = App.objects.create(user=other, package_name='com.notes.useful', app_name='Other')
+        AppUsageRecord.objects.create(app=other_app, date=self.today, usage_seconds=10)
+
+    def test_note_lists_usage_of_its_day(self):
+        response = self.client.post('/api/daily-notes/', {'date': str(self.today), 'mood': 3}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['app_usage'], [
+            {'app_name': 'Harmful', 'app_category': 'harmful', 'usage_time_seconds': 120},
+            {'app_name': 'Useful', 'app_category': 'useful', 'usage_time_seconds': 60},
+        ])
+        self.assertFalse(AppUsage.objects.exists())
+
+    def test_list_reads_hot_and_archived_usage(self):
+        DailyNote.objects.create(user=self.user, date=self.today, mood=3)
+        DailyNote.objects.create(user=self.user, date=self.old_day, mood=2)
+        DailyNote.objects.create(user=self.user, date=self.today - timedelta(days=1), mood=1)
+        notes = {note['date']: note['app_usage'] for note in self.client.get('/api/daily-notes/').json()}
+
+        self.assertEqual([usage['usage_time_seconds'] for usage in notes[str(self.today)]], [120, 60])
+        self.assertEqual(notes[str(self.old_day)], [
+            {'app_name': 'Useful', 'app_category': 'useful', 'usage_time_seconds': 30},
+        ])
+        self.assertEqual(notes[str(self.today - timedelta(days=1))], [])
+
+    def test_usage_change_invalidates_etag(self):
+        DailyNote.objects.create(user=self.user, date=self.today, mood=3)
+        etag = self.client.get('/api/daily-notes/')['ETag']
+        app = self.user.apps.get(app_name='Useful')
+        self.client.post(f'/api/apps/{app.id}/usage/', {'usage_seconds': 5}, format='json')
+        self.assertEqual(self.client.get('/api/daily-notes/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class FirebaseTokenVerifierTests(SimpleTestCase):
+    PROJECT_ID = 'test-project'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_keys = {kid: rsa.generate_private_key(public_exponent=65537, key_size=2048) for kid in ('k1', 'k2')}
+
+    def public_pem(self, kid):
+        return self.private_keys[kid].public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+
+    def make_token(self, kid='k1', **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://securetoken.google.com/{self.PROJECT_ID}', 'aud': self.PROJECT_ID,
+            'sub': 'firebase-uid', 'iat': now, 'exp': now + 3600, 'auth_time': now, **claims,
+        }
+        return jwt.encode(payload, self.private_keys[kid], algorithm='RS256', headers={'kid': kid})
+
+    def make_verifier(self, *fetched):
+        """Верификатор, который вместо Google получает fetched по очереди (ключи или исключение)"""
+        verifier = FirebaseTokenVerifier(project_id=self.PROJECT_ID)
+        responses = []
+        for item in fetched:
+            if isinstance(item, Exception):
+                responses.append(item)
+            else:
+                responses.append(mock.Mock(
+                    json=mock.Mock(return_value={kid: self.public_pem(kid) for kid in item}),
+                    headers={'Cache-Control': 'public, max-age=3600'},
+                ))
+        verifier._session = mock.Mock(get=mock.Mock(side_effect=responses))
+        return verifier
+
+    def test_verifies_token_with_local_key_set(self):
+        verifier = FirebaseTokenVerifier(project_id=self.PROJECT_ID, key_set={'k1': self.public_pem('k1')})
+        self.assertEqual(verifier.verify(self.make_token())['uid'], 'firebase-uid')
+
+        for token in (
+            self.make_token(aud='other-project'),
+            self.make_token(exp=int(time.time()) - 3600),
+            self.make_token(sub=''),
+            self.make_token(kid='k2'),
+        ):
+            with self.assertRaises(FirebaseTokenError):
+                verifier.verify(token)
+
+    def test_cold_start_failure_backs_off(self):
+        verifier = self.make_verifier(requests.ConnectionError('down'), ['k1'])
+        with self.assertRaisesMessage(FirebaseTokenError, 'unavailable'):
+            verifier.verify(self.make_token())
+        with self.assertRaisesMessage(FirebaseTokenError, 'unavailable'):
+            verifier.verify(self.make_token())
+        self.assertEqual(verifier._session.get.call_count, 1)
+
+        verifier._retry_at = 0
+        self.assertEqual(verifier.verify(self.make_token())['uid'], 'firebase-uid')
+        self.assertEqual(verifier._session.get.call_count, 2)
+
+    def test_unknown_kid_refreshes_keys_at_most_once_per_interval(self):
+        verifier = self.make_verifier(['k1'], ['k1', 'k2'])
+        verifier.verify(self.make_token('k1'))
+        with self.assertRaisesMessage(FirebaseTokenError, 'unknown key id'):
+            verifier.verify(self.make_token('k2'))
+        self.assertEqual(verifier._session.get.call_count, 1)
+
+        verifier._last_fetch -= verifier.MIN_REFRESH_INTERVAL_SECONDS
+        self.assertEqual(verifier.verify(self.make_token('k2'))['uid'], 'firebase-uid')
+        self.assertEqual(verifier._session.get.call_count, 2)
+
+
+class VerifiedLoginReplayTests(QueryBudgetTestCase):
+    TOKEN = 'firebase-id-token'
+    PHONE = '+79001234567'
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.decoded = {'uid': 'firebase-uid', 'phone_number': self.PHONE, 'exp': time.time() + 3600}
+        patcher = mock.patch.object(firebase_auth_service, 'verify_id_token', return_value=self.decoded)
+        self.verify = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self):
+        return self.client.post(
+            '/api/auth/sms/verify/', {'phone_number': self.PHONE, 'firebase_id_token': self.TOKEN}, format='json'
+        )
+
+    def test_replay_keeps_new_user_flag(self):
+        first = self.login()
+        self.assertEqual(first.status_code, 201)
+        self.assertTrue(first.json()['isNewUser'])
+
+        replay = self.login()
+        self.assertEqual(replay.status_code, 201)
+        self.assertTrue(replay.json()['isNewUser'])
+        self.assertEqual(replay.json()['user'], first.json()['user'])
+        self.assertEqual(self.verify.call_count, 1)
+
+    def test_replay_rejects_deactivated_account(self):
+        self.login()
+        user = User.objects.get(phone_e164=self.PHONE)
+        user.is_active = False
+        user.save()
+        self.assertIsNone(verified_token_cache.get(self.TOKEN))
+
+        # Кеш мог пережить деактивацию (запись добавлена другим процессом)
+        verified_token_cache.remember(self.TOKEN, self.decoded, {'phone_e164': self.PHONE, 'user': {'id': user.pk}})
+        self.login()
+        self.assertEqual(self.verify.call_count, 2)
+        self.assertIsNone(verified_token_cache.get(self.TOKEN))
+
+    def test_deleted_account_is_not_replayed(self):
+        self.login()
+        User.objects.get(phone_e164=self.PHONE).delete()
+        self.assertIsNone(verified_token_cache.get(self.TOKEN))
+
+        response = self.login()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.verify.call_count, 2)
+
+
+class EmailVerifyTests(QueryBudgetTestCase):
+    EMAIL = 'Same@Mail.ru'
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        patcher = mock.patch.object(
+            firebase_auth_service, 'verify_id_token', return_value={'uid': 'firebase-uid', 'email': self.EMAIL}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_registration_returns_existing_user(self):
+        existing = User.objects.create_user(username='concurrent', email='same@mail.ru', password=None)
+
+        # Параллельный запрос зарегистрировал тот же email уже после поиска: поиск его не видит
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            response = self.client.post(
+                '/api/auth/email/verify/', {'email': self.EMAIL, 'firebase_id_token': 'token'}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['isNewUser'])
+        self.assertEqual(response.json()['user']['id'], existing.pk)
+        self.assertEqual(User.objects.count(), 1)
+
+
+class UserContactNormalizationTests(TestCase):
+    def setUp(self):
+        self.original = User.objects.create_user(username='original', phone_number='89001234567', email='Same@Mail.ru')
+        # Дубликат из старых данных: миграция 0018 оставила его копии пустыми
+        self.duplicate = User.objects.create_user(username='duplicate', password=None)
+        User.objects.filter(pk=self.duplicate.pk).update(phone_number='+7(900)1234567', email='same@mail.ru')
+        self.duplicate.refresh_from_db()
+
+    def test_unchanged_contacts_are_not_normalized_again(self):
+        self.duplicate.first_name = 'Legacy'
+        self.duplicate.save()
+        self.duplicate.save(update_fields=['first_name'])
+        self.duplicate.refresh_from_db()
+        self.assertEqual((self.duplicate.phone_e164, self.duplicate.email_normalized), (None, None))
+
+    def test_changed_contacts_are_normalized(self):
+        self.duplicate.phone_number = '8 (900) 765-43-21'
+        self.duplicate.save()
+        self.duplicate.email = 'New@Mail.ru'
+        self.duplicate.save(update_fields=['email'])
+        self.duplicate.refresh_from_db()
+        self.assertEqual(
+            (self.duplicate.phone_e164, self.duplicate.email_normalized), ('+79007654321', 'new@mail.ru')
+        )
+
+    def test_profile_update_keeps_legacy_duplicate_contacts(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.duplicate).access_token}')
+        response = client.put('/api/user/profile/', {
+            'first_name': 'Legacy', 'phone_number': self.duplicate.phone_number, 'email': self.duplicate.email,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        response = client.put('/api/user/profile/', {'email': 'SAME@mail.ru '}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.json())
+
+    def test_registration_rejects_taken_contacts(self):
+        response = APIClient().post('/api/auth/register/', {
+            'username': 'another', 'password': 'long-password', 'phone_number': '+79001234567',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('phone_number', response.json())
+
+
+class PasswordLoginTests(QueryBudgetTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='owner', email='Owner@Mail.ru', phone_number='89001234567', password='long-password',
+        )
+
+    def login(self, login, password='long-password'):
+        return APIClient().post('/api/auth/token/', {'username': login, 'password': password}, format='json')
+
+    def test_login_by_username_email_and_phone(self):
+        for login in ('owner', ' OWNER@mail.ru', '+7 (900) 123-45-67'):
+            response = self.login(login)
+            self.assertEqual(response.status_code, 200, login)
+            self.assertEqual(UserRefreshToken(response.json()['refresh'])['user_id'], self.user.pk)
+
+    def test_credentials_are_resolved_in_one_query(self):
+        for login in ('owner', 'owner@mail.ru', '89001234567', 'missing@mail.ru'):
+            with CaptureQueriesContext(connection) as queries:
+                authenticate_credentials(login, 'long-password')
+            self.assertEqual(len(queries), 1, login)
+
+    def test_username_wins_over_other_accounts_contacts(self):
+        other = User.objects.create_user(username='owner@mail.ru', password='other-password')
+        self.assertEqual(authenticate_credentials('owner@mail.ru', 'other-password'), other)
+        self.assertIsNone(authenticate_credentials('owner@mail.ru', 'long-password'))
+
+    def test_wrong_password_and_unknown_login_are_rejected(self):
+        self.assertEqual(self.login('owner', 'wrong-password').status_code, 400)
+        self.assertEqual(self.login('+79990000000').status_code, 400)
+        self.assertEqual(self.login(['owner']).status_code, 400)
+
+
+    def test_legacy_hash_is_upgraded_within_query_budget(self):
+        User.objects.filter(pk=self.user.pk).update(
+            password=make_password('long-password', hasher='pbkdf2_sha1'),
+        )
+        response = self.login('owner')
+
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.password.startswith('pbkdf2_sha1$'))
+        self.assertTrue(self.user.check_password('long-password'))
+
+
+class UniqueUsernameTests(TestCase):
+    def test_taken_username_gets_suffix(self):
+        User.objects.create_user(username='user_79001234567', password=None)
+        user = User.objects.create_user_with_unique_username('user_79001234567', phone_number='79001234567')
+        self.assertRegex(user.username, r'^user_79001234567_[0-9a-f]{6}$')
+        self.assertEqual(User.objects.count(), 2)
+
+    def test_suffix_collision_is_retried(self):
+        User.objects.create_user(username='base', password=None)
+        User.objects.create_user(username='base_aaaaaa', password=None)
+        with mock.patch('accounts.models.secrets.token_hex', side_effect=['aaaaaa', 'bbbbbb']):
+            user = User.objects.create_user_with_unique_username('base')
+        self.assertEqual(user.username, 'base_bbbbbb')
+
+    def test_gives_up_after_attempts(self):
+        User.objects.create_user(username='base', password=None)
+        User.objects.create_user(username='base_aaaaaa', password=None)
+        with mock.patch('accounts.models.secrets.token_hex', return_value='aaaaaa'):
+            with self.assertRaises(IntegrityError):
+                User.objects.create_user_with_unique_username('base')
+
+    def test_other_conflicts_are_not_retried(self):
+        User.objects.create_user(username='first', phone_number='79001234567')
+        with mock.patch('accounts.models.secrets.token_hex') as token_hex:
+            with self.assertRaises(IntegrityError):
+                User.objects.create_user_with_unique_username('second', phone_number='+79001234567')
+        token_hex.assert_not_called()
+
+    def test_long_base_is_truncated_to_fit_suffix(self):
+        base = 'x' * 200
+        User.objects.create_user(username=base[:143], password=None)
+        user = User.objects.create_user_with_unique_username(base)
+        self.assertEqual(len(user.username), 150)
+
+
+class StatelessUserTests(QueryBudgetTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='stateless', phone_number='79001234567', email='stateless@mail.ru', subscription_type='premium',
+        )
+        # Как при STATELESS_JWT_AUTH: request.user собирается из claims токена
+        stateless_auth = mock.patch.object(APIView, 'authentication_classes', [StatelessJWTAuthentication])
+        stateless_auth.start()
+        self.addCleanup(stateless_auth.stop)
+
+    def test_save_keeps_in_memory_changes(self):
+        user = user_from_claims(self.user.pk, {'subscription_type': 'premium', 'subscription_end_date': None})
+        user.first_name = 'Changed'
+        # Чтение отложенного поля не перезаписывает измененное в памяти
+        self.assertEqual(user.email, 'stateless@mail.ru')
+        self.assertEqual(user.first_name, 'Changed')
+        user.save(update_fields=['first_name'])
+
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.subscription_type, self.user.first_name), ('premium', 'Changed'))
+
+    def test_token_claims_are_never_saved(self):
+        user = user_from_claims(self.user.pk, {'subscription_type': 'free', 'subscription_end_date': None})
+        for kwargs in ({}, {'update_fields': ['first_name', 'subscription_type']}):
+            with self.assertRaises(ValueError):
+                user.save(**kwargs)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscription_type, 'premium')
+
+    def test_me_update_keeps_subscription_changed_after_token(self):
+        token = UserRefreshToken.for_user(user_from_claims(self.user.pk, {
+            'subscription_type': 'free', 'subscription_end_date': None,
+        })).access_token
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        response = client.patch('/api/auth/me/', {'first_name': 'X'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.subscription_type), ('X', 'premium'))
+
+    def test_writer_views_save_database_row(self):
+        # Claims токена устарели: подписку уже сменили в БД
+        token = UserRefreshToken.for_user(self.user).access_token
+        User.objects.filter(pk=self.user.pk).update(first_name='Fresh')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        response = client.put('/api/user/profile/', {'last_name': 'Updated'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = client.post('/api/user/subscription/', {'subscription_type': 'free'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name), ('Fresh', 'Updated'))
+        self.assertEqual((self.user.subscription_type, self.user.has_subscription), ('free', False))
+        self.assertEqual(self.user.phone_e164, '+79001234567')
+
+
+@override_settings(SMS_RU_API_KEY='key', SMS_RATE_LIMIT_PER_SECOND=0, SMS_ROUTER_WINDOW=10)
+class SmsProviderTests(SimpleTestCase):
+    def smsru(self, payload):
+        session = mock.Mock()
+        session.post.return_value = mock.Mock(json=mock.Mock(return_value=payload))
+        return SMSRuProvider(session=session)
+
+    def test_smsru_account_errors_fail_over(self):
+        no_balance = self.smsru({'status': 'ERROR', 'status_code': 201, 'status_text': 'Not enough funds'})
+        backup = FakeSMSProvider(name='backup')
+        result = SMSRouter([no_balance, backup]).send_sms('+79001234567', 'Code 1234')
+
+        self.assertEqual((result['success'], result['provider']), (True, 'backup'))
+        self.assertEqual(len(backup.sent), 1)
+
+    @override_settings(P1SMS_API_KEY='key')
+    def test_p1sms_provider_errors_fail_over(self):
+        for payload in (
+            {'status': 'error', 'errorDescription': 'Insufficient balance'},
+            {'status': 'success', 'data': [{'status': 'error', 'errorDescription': 'Channel unavailable'}]},
+            {'status': 'success', 'data': []},
+            ValueError('not JSON'),
+        ):
+            with self.subTest(payload=payload):
+                session = mock.Mock()
+                response = session.post.return_value
+                response.json.side_effect = payload if isinstance(payload, Exception) else None
+                response.json.return_value = payload
+                backup = FakeSMSProvider(name='backup')
+                result = SMSRouter([P1SMSService(session=session), backup]).send_sms('+79001234567', 'Code 1234')
+
+                self.assertEqual((result['success'], result['provider']), (True, 'backup'))
+                self.assertEqual(len(backup.sent), 1)
+
+    def test_smsru_invalid_number_is_final(self):
+        invalid = self.smsru({'status': 'OK', 'sms': {'79001234567': {
+            'status': 'ERROR', 'status_code': 202, 'status_text': 'Invalid number',
+        }}})
+        backup = FakeSMSProvider(name='backup')
+        result = SMSRouter([invalid, backup]).send_sms('+79001234567', 'Code 1234')
+
+        self.assertFalse(result['success'])
+        self.assertFalse(result['retryable'])
+        self.assertEqual(result['provider'], 'smsru')
+        self.assertEqual(backup.sent, [])
+
+    def test_unknown_provider_names_are_rejected_up_front(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'smsro'):
+            build_sms_router(['fake', 'smsro'])
+        with override_settings(SMS_PROVIDER='fake,smsro'):
+            self.assertEqual([error.id for error in check_sms_providers(None)], ['accounts.E001'])
+        with override_settings(SMS_PROVIDER='stub'):
+            self.assertEqual(check_sms_providers(None), [])
+
+
+class SlidingWindowThrottleTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def allow(self, throttle_class, now, request=None):
+        throttle = throttle_class()
+        throttle.timer = lambda: now
+        return throttle.allow_request(request or self.factory.post('/auth/'), None)
+
+    def test_previous_window_is_weighted_by_overlap(self):
+        with mock.patch.object(AuthIPThrottle, 'THROTTLE_RATES', {'auth_ip': '4/min'}):
+            start = 600.0
+            self.assertEqual([self.allow(AuthIPThrottle, start + second) for second in range(5)], [True] * 4 + [False])
+            # В начале следующего окна предыдущее весит ~3/4: 4 * 0.75 + 0 < 4,
+            # 4 * 0.73 + 1 < 4, а третий запрос уже превышает лимит
+            self.assertTrue(self.allow(AuthIPThrottle, start + 75))
+            self.assertTrue(self.allow(AuthIPThrottle, start + 76))
+            self.assertFalse(self.allow(AuthIPThrottle, start + 77))
+            # Через два окна старые запросы не учитываются
+            self.assertTrue(self.allow(AuthIPThrottle, start + 180))
+
+    def test_denied_request_reports_wait_until_limit_frees(self):
+        with mock.patch.object(AuthIPThrottle, 'THROTTLE_RATES', {'auth_ip': '1/min'}):
+            self.assertTrue(self.allow(AuthIPThrottle, 600.0))
+            throttle = AuthIPThrottle()
+            throttle.timer = lambda: 615.0
+            self.assertFalse(throttle.allow_request(self.factory.post('/auth/'), None))
+            self.assertEqual(throttle.wait(), 45.0)
+
+    def test_phone_throttle_ignores_non_string_numbers(self):
+        with mock.patch.object(PhoneThrottle, 'THROTTLE_RATES', {'auth_phone': '1/min'}):
+            for phone in (['+79001234567'], {'number': 1}, None, True):
+                self.assertIsNone(PhoneThrottle().get_cache_key(mock.Mock(data={'phone_number': phone}), None))
+            numeric = PhoneThrottle().get_cache_key(mock.Mock(data={'phone_number': 79001234567}), None)
+            text = PhoneThrottle().get_cache_key(mock.Mock(data={'phone_number': '79001234567'}), None)
+            self.assertEqual(numeric, text)
+
+    def test_forwarded_for_is_trusted_only_behind_proxies(self):
+        request = self.factory.post('/auth/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='1.2.3.4, 5.6.7.8')
+        with override_settings(REST_FRAMEWORK={'NUM_PROXIES': 0}):
+            self.assertEqual(AuthIPThrottle().get_ident(request), '10.0.0.2')
+        with override_settings(REST_FRAMEWORK={'NUM_PROXIES': 1}):
+            self.assertEqual(AuthIPThrottle().get_ident(request), '5.6.7.8')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.labels = {'view': 'api/auth/token/', 'method': 'POST'}
+
+    def sample(self, name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, {**self.labels, **labels}) or 0
+
+    @override_settings(METRICS_SAMPLE_RATE=1.0)
+    def test_middleware_records_request_by_route(self):
+        before = self.sample('http_request_duration_seconds_count', status='400')
+        queries_before = self.sample('http_request_db_queries_sum')
+
+        response = APIClient().post('/api/auth/token/', {'username': 'missing', 'password': 'x'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.sample('http_request_duration_seconds_count', status='400'), before + 1)
+        self.assertEqual(self.sample('http_request_db_queries_sum'), queries_before + 1)
+        self.assertGreater(self.sample('http_response_size_bytes_sum'), 0)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_recorded(self):
+        before = self.sample('http_request_duration_seconds_count', status='400')
+        APIClient().post('/api/auth/token/', {}, format='json')
+        self.assertEqual(self.sample('http_request_duration_seconds_count', status='400'), before)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+
+        self.assertEqual(response.status_code, 200)
+        families = {family.name for family in text_string_to_metric_families(response.content.decode())}
+        self.assertIn('http_request_duration_seconds', families)
+
+    def test_multiprocess_rendering_sums_all_workers(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            # Два воркера пишут в общий каталог, scrape попадает в любой из них
+            for pid in (101, 102):
+                with mock.patch.object(prometheus_values, 'ValueClass', prometheus_values.MultiProcessValue(lambda: pid)):
+                    worker_metric = prometheus_client.Histogram(
+                        'worker_latency_seconds', 'test', ('view',), registry=None, buckets=(0.1, 1.0),
+                    )
+                    worker_metric.labels(view='home').observe(0.05)
+            rendered = metrics.render_metrics().decode()
+
+        self.assertIn('worker_latency_seconds_count{view="home"} 2.0', rendered)
+        self.assertIn('worker_latency_seconds_bucket{le="0.1",view="home"} 2.0', rendered)
+
+
+class StructuredLoggingTests(SimpleTestCase):
+    def record(self, msg='User %s logged in', args=('alice',), level=logging.INFO, name='accounts.views', **extra):
+        record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_writes_one_line_with_extra_fields(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = self.record(user_id=7)
+            record.exc_info = sys.exc_info()
+        line = JsonFormatter().format(record)
+
+        self.assertNotIn('\n', line)
+        data = json.loads(line)
+        self.assertEqual((data['level'], data['logger'], data['message']), ('INFO', 'accounts.views', 'User alice logged in'))
+        self.assertEqual(data['user_id'], 7)
+        self.assertIn('ValueError: boom', data['exception'])
+
+    def test_sampling_filter_thins_only_low_levels(self):
+        sampling = SamplingFilter('accounts=0,accounts.views.debug=1')
+        self.assertFalse(sampling.filter(self.record(name='accounts.views')))
+        self.assertTrue(sampling.filter(self.record(name='accounts.views.debug.sub')))
+        self.assertTrue(sampling.filter(self.record(name='accounts.views', level=logging.WARNING)))
+        self.assertTrue(sampling.filter(self.record(name='django.request')))
+        self.assertEqual(parse_sample_rates(' a=0.5,,b= ,c=1'), {'a': 0.5, 'c': 1.0})
+
+    def test_queue_handler_defers_formatting_of_immutable_args(self):
+        handler = QueueLogHandler([logging.NullHandler()])
+        handler.stop()
+        deferred = handler.prepare(self.record())
+        self.assertEqual((deferred.msg, deferred.args), ('User %s logged in', ('alice',)))
+
+        apps = ['first']
+        captured = handler.prepare(self.record('Apps %s', (apps,)))
+        apps.append('second')
+        self.assertEqual((captured.getMessage(), captured.args), ("Apps ['first']", None))
+
+    def test_queue_handler_writes_in_listener_and_drops_on_overflow(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JsonFormatter())
+        handler = QueueLogHandler([target])
+        handler.handle(self.record())
+        handler.stop()
+        self.assertEqual(json.loads(stream.getvalue())['message'], 'User alice logged in')
+
+        full = QueueLogHandler([target], maxsize=1)
+        full.stop()
+        full.handle(self.record())
+        full.handle(self.record())
+        self.assertEqual(full.dropped, 1)
+
+    def test_stopped_handlers_are_not_restarted_after_fork(self):
+        handler = QueueLogHandler([logging.NullHandler()])
+        self.assertIn(handler, logging_utils._running_handlers)
+        handler.stop()
+        self.assertNotIn(handler, logging_utils._running_handlers)
+        with mock.patch.object(QueueLogHandler, '_restart_after_fork', autospec=True) as restart:
+            logging_utils._restart_handlers_after_fork()
+        self.assertNotIn(mock.call(handler), restart.call_args_list)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(
+            PROFILING_DIR=self.directory, PROFILING_TOKEN='profile-token', PROFILING_SAMPLE_RATE=0,
+            PROFILING_MAX_FILES=200, PROFILING_MAX_BYTES=10 * 1024 * 1024,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_profile(self, name, size):
+        with open(os.path.join(self.directory, name), 'wb') as profile:
+            profile.write(b'x' * size)
+
+    def test_token_header_saves_profile_for_staff(self):
+        response = APIClient().post('/api/auth/token/', {}, format='json', HTTP_X_PROFILE='profile-token')
+        name = response['X-Profile-Id']
+        self.assertRegex(name, r'^\d{8}T\d+_POST_api_auth_token_\d+ms\.prof$')
+        self.assertEqual(os.listdir(self.directory), [name])
+
+        staff = User.objects.create_user(username='staff', password=None, is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual([p['name'] for p in self.client.get('/admin-tools/profiles/').json()['profiles']], [name])
+        summary = self.client.get(f'/admin-tools/profiles/{name}', {'format': 'text', 'limit': 5})
+        self.assertIn('function calls', summary.content.decode())
+
+    def test_requests_without_valid_token_are_not_profiled(self):
+        for headers in ({}, {'HTTP_X_PROFILE': 'wrong-token'}):
+            response = APIClient().post('/api/auth/token/', {}, format='json', **headers)
+            self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_prune_keeps_newest_within_file_limit(self):
+        for index in range(5):
+            self.write_profile(f'2026010{index}T000000_GET_x_1ms.prof', 10)
+        self.write_profile('notes.txt', 10)
+        with override_settings(PROFILING_MAX_FILES=2):
+            prune_profiles(self.directory)
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            '20260103T000000_GET_x_1ms.prof', '20260104T000000_GET_x_1ms.prof', 'notes.txt',
+        ])
+
+    def test_prune_keeps_newest_within_byte_limit(self):
+        for index, size in enumerate((40, 30, 20, 10)):
+            self.write_profile(f'2026010{index}T000000_GET_x_1ms.prof', size)
+        # Новые 10 + 20 + 30 байт укладываются в 65, с профилем в 40 байт уже нет
+        with override_settings(PROFILING_MAX_BYTES=65):
+            prune_profiles(self.directory)
+        self.assertEqual([profile['size'] for profile in list_profiles(self.directory)], [10, 20, 30])
+
+    def test_profile_path_rejects_other_files(self):
+        self.write_profile('20260101T000000_GET_x_1ms.prof', 10)
+        self.assertIsNotNone(profile_path('20260101T000000_GET_x_1ms.prof'))
+        for name in ('../settings.prof', 'missing.prof', 'notes.txt'):
+            self.assertIsNone(profile_path(name))
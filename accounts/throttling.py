@@ -0,0 +1,108 @@
+import hashlib
+import time
+
+from django.core.cache import cache as default_cache
+from rest_framework.throttling import SimpleRateThrottle
+
+from .models import normalize_email, normalize_phone
+
+
+class SlidingWindowThrottle(SimpleRateThrottle):
+    """
+    Ограничение частоты по скользящему окну на атомарных счетчиках кеша.
+
+    Считаются запросы в текущем и предыдущем окне, вклад предыдущего
+    пропорционален его перекрытию со скользящим окном. Каждая проверка -
+    одно чтение двух ключей и один incr, без списка меток времени, поэтому
+    счетчики корректно делятся между процессами через общий кеш (Redis).
+    Отклоненные запросы не увеличивают счетчик.
+    """
+    cache = default_cache
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = self.timer()
+        window = int(now // self.duration)
+        current_key = f'{self.key}:{window}'
+        previous_key = f'{self.key}:{window - 1}'
+        counts = self.cache.get_many([current_key, previous_key])
+        current = counts.get(current_key, 0)
+        previous = counts.get(previous_key, 0)
+
+        elapsed = (now % self.duration) / self.duration
+        if previous * (1 - elapsed) + current >= self.num_requests:
+            self.wait_seconds = self.duration * (1 - elapsed)
+            return False
+
+        # Ключ живет два окна: текущее и следующее, где он станет предыдущим
+        if not self.cache.add(current_key, 1, timeout=self.duration * 2):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                # Ключ истек между add и incr
+                self.cache.add(current_key, 1, timeout=self.duration * 2)
+        return True
+
+    def wait(self):
+        return getattr(self, 'wait_seconds', None)
+
+    def timer(self):
+        return time.time()
+
+
+class AuthIPThrottle(SlidingWindowThrottle):
+    """Все попытки входа и запросы кодов с одного IP"""
+    scope = 'auth_ip'
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
+
+
+class PhoneThrottle(SlidingWindowThrottle):
+    """Запросы по одному номеру телефона, с какого бы IP они ни шли"""
+    scope = 'auth_phone'
+
+    def get_cache_key(self, request, view):
+        phone = request.data.get('phone_number')
+        if isinstance(phone, int) and not isinstance(phone, bool):
+            phone = str(phone)
+        # Номер приходит от клиента как есть: списки, объекты и т.п. не лимитируем здесь,
+        # их отклонит валидация вьюхи
+        phone = normalize_phone(phone) if isinstance(phone, str) else None
+        if not phone:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': phone}
+
+
+class SmsSendPhoneThrottle(PhoneThrottle):
+    """Отправка SMS на один номер: каждая стоит денег у провайдера"""
+    scope = 'sms_send_phone'
+
+
+class LoginIdentifierThrottle(SlidingWindowThrottle):
+    """Попытки входа по паролю для одного логина (username, email или телефон)"""
+    scope = 'auth_identifier'
+
+    def get_cache_key(self, request, view):
+        identifier = request.data.get('username')
+        if not isinstance(identifier, str) or not identifier.strip():
+            return None
+        # Логин приходит от клиента как есть: хешируем, чтобы ключ кеша был безопасным
+        ident = hashlib.sha256(normalize_email(identifier).encode('utf-8')).hexdigest()
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+
+class AchievementEventThrottle(SlidingWindowThrottle):
+    """События достижений от клиента одного пользователя"""
+    scope = 'achievement_event'
+
+    def get_cache_key(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': request.user.pk}
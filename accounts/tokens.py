@@ -0,0 +1,89 @@
+from django.contrib.auth import get_user_model
+from django.utils.dateparse import parse_datetime
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import StatelessUser
+
+User = get_user_model()
+
+# Поля пользователя, которые копируются в токен и читаются без запроса к БД
+USER_CLAIM_FIELDS = ('subscription_type', 'subscription_end_date')
+
+
+def user_claims(user):
+    """Claims пользователя для токена (значения сериализуются в JSON)"""
+    end_date = user.subscription_end_date
+    return {
+        'subscription_type': user.subscription_type,
+        'subscription_end_date': end_date.isoformat() if end_date else None,
+    }
+
+
+def user_from_claims(user_id, claims):
+    """
+    Ленивый пользователь из claims токена.
+
+    Поля, которых нет в claims (например, у токенов, выпущенных до их
+    появления), будут загружены из БД при первом обращении.
+    """
+    fields = {}
+    if 'subscription_type' in claims:
+        fields['subscription_type'] = claims['subscription_type']
+    if 'subscription_end_date' in claims:
+        end_date = claims['subscription_end_date']
+        fields['subscription_end_date'] = parse_datetime(end_date) if end_date else None
+    return StatelessUser.from_claims(user_id, fields)
+
+
+class UserRefreshToken(RefreshToken):
+    """Refresh токен с claims подписки; access токен копирует их из него"""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        for claim, value in user_claims(user).items():
+            token[claim] = value
+        return token
+
+
+class UserTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Выдает новый access токен с актуальными claims подписки.
+
+    Claims в refresh токене фиксируются при входе, поэтому при обновлении
+    они перечитываются из БД одним запросом.
+    """
+    token_class = UserRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+
+        user_id = refresh.get(api_settings.USER_ID_CLAIM)
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).only(
+            api_settings.USER_ID_FIELD, *USER_CLAIM_FIELDS
+        ).first()
+        if user is None:
+            raise InvalidToken('User not found')
+        for claim, value in user_claims(user).items():
+            refresh[claim] = value
+
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                try:
+                    refresh.blacklist()
+                except AttributeError:
+                    # Приложение blacklist не установлено
+                    pass
+
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+
+            data['refresh'] = str(refresh)
+
+        return data
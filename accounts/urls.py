@@ -1,12 +1,15 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
 
+from core.query_budget import query_budget
+
 from .views import (
     RegisterView,
     MeView,
     FlexibleTokenObtainPairView,
     SmsRequestCodeView,
     SmsVerifyCodeView,
+    SmsStatusView,
     EmailVerifyView,
     SocialLoginStubView,
     FirebasePhoneLoginView,
@@ -27,11 +30,13 @@ from .views import (
     UserSubscriptionView,
     UserAvatarView,
     DailyTimelineView,
+    TimelineStatsView,
 )
 from .achievement_views import (
     AchievementListView,
     AchievementSyncView,
     AchievementStatsView,
+    AchievementEventView,
 )
 from .app_views import (
     get_user_apps,
@@ -41,16 +46,18 @@ from .app_views import (
     update_app_usage,
 )
 from .experience_views import ExperienceView
+from .sync_views import SyncView
 
 
 urlpatterns = [
     path('auth/register/', RegisterView.as_view(), name='auth-register'),
     path('auth/token/', FlexibleTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('auth/token/refresh/', query_budget(1)(TokenRefreshView.as_view()), name='token_refresh'),
     path('auth/me/', MeView.as_view(), name='auth-me'),
     # SMS authentication
     path('auth/sms/send/', SmsRequestCodeView.as_view(), name='auth-sms-send'),
     path('auth/sms/verify/', SmsVerifyCodeView.as_view(), name='auth-sms-verify'),
+    path('auth/sms/status/<str:message_id>/', SmsStatusView.as_view(), name='auth-sms-status'),
     # Email authentication
     path('auth/email/verify/', EmailVerifyView.as_view(), name='auth-email-verify'),
     # Social authentication
@@ -82,6 +89,7 @@ urlpatterns = [
     path('user/avatar/', UserAvatarView.as_view(), name='user-avatar'),
     # Timeline
     path('timeline/', DailyTimelineView.as_view(), name='timeline'),
+    path('timeline/stats/', TimelineStatsView.as_view(), name='timeline-stats'),
     path('experience/', ExperienceView.as_view(), name='experience'),
     # Apps
     path('apps/', get_user_apps, name='user-apps'),
@@ -93,6 +101,7 @@ urlpatterns = [
     path('achievements/', AchievementListView.as_view(), name='achievement-list'),
     path('achievements/sync/', AchievementSyncView.as_view(), name='achievement-sync'),
     path('achievements/stats/', AchievementStatsView.as_view(), name='achievement-stats'),
-]
-
-
+    path('achievements/events/', AchievementEventView.as_view(), name='achievement-events'),
+    # Delta sync
+    path('sync/', SyncView.as_view(), name='sync'),
+]
\ No newline at end of file
@@ -1,4 +1,6 @@
-from rest_framework import generics, status, serializers
+import logging
+
+from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
@@ -7,22 +9,67 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.conf import settings
-from .models import User, Habit, DailyNote, AppUsage, ChatSession, ChatMessage, ChatAttachment, DailyTimeline, App, AppUsageRecord, UserTestResult, Achievement, AchievementStats
+from django.db import IntegrityError, transaction
+from core.query_budget import query_budget
+from .models import normalize_email, normalize_phone, User, Habit, DailyNote, AppUsage, ChatSession, ChatMessage, ChatAttachment, DailyTimeline, App, AppUsageRecord, UserTestResult, Achievement, AchievementStats
 from .serializers import (
     RegisterSerializer, CustomTokenObtainPairSerializer, HabitSerializer, 
     DailyNoteSerializer, AppUsageSerializer, ChatSessionSerializer, 
     ChatMessageSerializer, SendMessageSerializer, ChatAttachmentSerializer,
     DailyTimelineSerializer, AppSerializer, AppCategoryUpdateSerializer,
     UserTestResultSerializer, AchievementSerializer, AchievementSyncSerializer,
-    AchievementStatsSerializer
+    AchievementStatsSerializer, prefetch_chat_messages
 )
 from .services import ChatGPTService, FileUploadService
-from .p1sms_service import P1SMSService
+from .achievement_engine import achievement_engine
+from .archive import get_archived, restore_archived
+from .rollups import add_timeline_change, timeline_stats, timeline_totals
+from .conditional import conditional_get, daily_notes_etag, habits_etag, user_profile_etag
+from .p1sms_service import get_p1sms_service
+from .sms_dispatcher import SmsDispatcher, get_sms_dispatcher
+from .firebase_auth_service import firebase_auth_service, verified_token_cache
+from .authentication import authenticate_credentials
+from .throttling import AuthIPThrottle, LoginIdentifierThrottle, PhoneThrottle, SmsSendPhoneThrottle
+from .tokens import UserRefreshToken
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+def load_request_user(request):
+    """
+    Строка пользователя запроса для записи.
+
+    request.user собран из claims access токена (StatelessUser), его
+    значения могут отставать от БД; сохранять нужно загруженную строку.
+    """
+    return User.objects.get(pk=request.user.pk)
+
 
+def replay_verified_login(firebase_id_token, phone_e164):
+    """
+    Повтор входа с уже проверенным Firebase токеном.
 
+    Подпись заново не проверяется, но пользователь читается из БД одним
+    запросом по первичному ключу: удаленный или деактивированный аккаунт
+    не получает токенов, а запись кеша удаляется, и вход идет обычным путем.
+
+    Returns:
+        tuple | None: (данные кешированного входа, пользователь)
+    """
+    cached_login = verified_token_cache.get(firebase_id_token)
+    if cached_login is None or cached_login['phone_e164'] != phone_e164:
+        return None
+    user = User.objects.filter(pk=cached_login['user']['id'], is_active=True).first()
+    if user is None:
+        verified_token_cache.forget(firebase_id_token)
+        return None
+    return cached_login, user
+
+
+@method_decorator(query_budget(3), name='dispatch')
 class UserRegistrationView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = RegisterSerializer
@@ -38,46 +85,27 @@ class UserRegistrationView(generics.CreateAPIView):
         }, status=status.HTTP_201_CREATED)
 
 
+# Поиск пользователя плюс UPDATE пароля, когда check_password перехеширует
+# старый хеш (PBKDF2 -> Argon2, смена числа итераций)
+@method_decorator(query_budget(2), name='dispatch')
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle, LoginIdentifierThrottle]
     
     def post(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        try:
-            serializer.is_valid(raise_exception=True)
-        except serializers.ValidationError as e:
-            return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Get user for token generation
         username = request.data.get('username')
         password = request.data.get('password')
+        if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
+            return Response({'error': 'Username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
         
-        from django.contrib.auth import authenticate
-        user = authenticate(username=username, password=password)
-        
-        if not user:
-            # Try with email
-            try:
-                user_obj = User.objects.get(email=username)
-                user = authenticate(username=user_obj.username, password=password)
-            except User.DoesNotExist:
-                pass
-        
-        if not user:
-            # Try with phone
-            try:
-                user_obj = User.objects.get(phone_number=username)
-                user = authenticate(username=user_obj.username, password=password)
-            except User.DoesNotExist:
-                pass
-        
+        # Логин может быть username, email или телефоном: один запрос и одна проверка пароля
+        user = authenticate_credentials(username, password)
         if not user:
             return Response({'error': 'Unable to log in with provided credentials.'}, status=status.HTTP_400_BAD_REQUEST)
         
         # Generate tokens
-        from rest_framework_simplejwt.tokens import RefreshToken
-        refresh = RefreshToken.for_user(user)
+        refresh = UserRefreshToken.for_user(user)
         
         return Response({
             'refresh': str(refresh),
@@ -85,12 +113,13 @@ class CustomTokenObtainPairView(TokenObtainPairView):
         })
 
 
+@method_decorator(query_budget(get=1, put=4, patch=4), name='dispatch')
 class ManageUserView(generics.RetrieveUpdateAPIView):
     serializer_class = RegisterSerializer
     permission_classes = [IsAuthenticated]
 
     def get_object(self):
-        return self.request.user
+        return load_request_user(self.request)
 
 
 # SMS Login stubs
@@ -115,6 +144,8 @@ def social_login_view(request):
 
 
 # Habit Views
+@method_decorator(query_budget(3), name='dispatch')
+@method_decorator(conditional_get(habits_etag), name='get')
 class HabitListCreateView(generics.ListCreateAPIView):
     serializer_class = HabitSerializer
     permission_classes = [IsAuthenticated]
@@ -127,6 +158,7 @@ class HabitListCreateView(generics.ListCreateAPIView):
         return queryset
 
 
+@method_decorator(query_budget(5), name='dispatch')
 class HabitDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = HabitSerializer
     permission_classes = [IsAuthenticated]
@@ -135,6 +167,7 @@ class HabitDetailView(generics.RetrieveUpdateDestroyAPIView):
         return Habit.objects.filter(user=self.request.user)
 
 
+@method_decorator(query_budget(3), name='dispatch')
 class HabitResetView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -154,143 +187,163 @@ RegisterView = UserRegistrationView
 MeView = ManageUserView
 FlexibleTokenObtainPairView = CustomTokenObtainPairView
 
-# SMS stubs
+# SMS
+@method_decorator(query_budget(1), name='dispatch')
 class SmsRequestCodeView(generics.GenericAPIView):
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle, SmsSendPhoneThrottle]
     
     def post(self, request):
         phone_number = request.data.get('phone_number')
         if not phone_number:
             return Response({'error': 'Phone number is required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # ВРЕМЕННО: Закомментировано для тестирования
-        # # Отправляем SMS через P1SMS
-        # p1sms_service = P1SMSService()
-        # result = p1sms_service.send_verification_code(phone_number)
-        # 
-        # if result['success']:
-        #     return Response({
-        #         'message': result['message'],
-        #         'phone_number': phone_number,
-        #         # В debug режиме возвращаем код для тестирования
-        #         'debug_code': result.get('code') if settings.DEBUG else None
-        #     }, status=status.HTTP_200_OK)
-        # else:
-        #     return Response({
-        #         'error': result['message']
-        #     }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # ВРЕМЕННО: Возвращаем успех без отправки SMS
+        if settings.SMS_PROVIDER == 'stub':
+            # Возвращаем успех без отправки SMS
+            return Response({
+                'message': 'SMS код отправлен успешно (в разработке)',
+                'phone_number': phone_number,
+                'debug_code': '123456'  # Фиксированный код для тестирования
+            }, status=status.HTTP_200_OK)
+
+        # Код сохраняется сразу, а SMS уходит в фоне: ответ не ждет провайдера
+        code, text = get_p1sms_service().prepare_verification_code(phone_number)
+        message_id = get_sms_dispatcher().enqueue(phone_number, text, channel="telegram_auth")
+
         return Response({
-            'message': 'SMS код отправлен успешно (в разработке)',
+            'message': 'SMS код поставлен в очередь на отправку',
             'phone_number': phone_number,
-            'debug_code': '123456'  # Фиксированный код для тестирования
-        }, status=status.HTTP_200_OK)
+            'message_id': message_id,
+            # В debug режиме возвращаем код для тестирования
+            'debug_code': code if settings.DEBUG else None
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+@method_decorator(query_budget(1), name='dispatch')
+class SmsStatusView(APIView):
+    """Статус доставки SMS по message_id из SmsRequestCodeView"""
+    permission_classes = [AllowAny]
+
+    def get(self, request, message_id):
+        sms_status = SmsDispatcher.get_status(message_id)
+        if sms_status is None:
+            return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(sms_status)
 
+
+@method_decorator(query_budget(6), name='dispatch')
 class SmsVerifyCodeView(generics.GenericAPIView):
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle, PhoneThrottle]
     
     def post(self, request):
-        import logging
-        logger = logging.getLogger(__name__)
-        
         try:
             phone_number = request.data.get('phone_number')
             firebase_id_token = request.data.get('firebase_id_token')
             
-            logger.info(f"Firebase verification attempt for phone: {phone_number}")
+            logger.debug("Firebase verification attempt for phone: %s", phone_number)
 
             if not phone_number:
-                logger.warning(f"Missing phone_number: phone={phone_number}")
+                logger.warning("Missing phone_number: phone=%s", phone_number)
                 return Response({'error': 'Phone number is required'}, status=status.HTTP_400_BAD_REQUEST)
             
             if not firebase_id_token:
-                logger.warning(f"Missing firebase_id_token for phone: {phone_number}")
+                logger.warning("Missing firebase_id_token for phone: %s", phone_number)
                 return Response({'error': 'Firebase ID token is required'}, status=status.HTTP_400_BAD_REQUEST)
 
+            # Нормализуем номер из запроса в E.164 (8XXXXXXXXXX и 10 цифр -> +7...)
+            phone_e164 = normalize_phone(phone_number)
+            if not phone_e164:
+                return Response({'error': 'Invalid phone number'}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Повтор с уже проверенным токеном: без проверки подписи
+            replay = replay_verified_login(firebase_id_token, phone_e164)
+            if replay is not None:
+                cached_login, cached_user = replay
+                is_new = cached_login.get('is_new', False)
+                refresh = UserRefreshToken.for_user(cached_user)
+                return Response({
+                    'access': str(refresh.access_token),
+                    'refresh': str(refresh),
+                    'user': cached_login['user'],
+                    'isNewUser': is_new
+                }, status=status.HTTP_201_CREATED if is_new else status.HTTP_200_OK)
+
             # Проверяем Firebase ID token
             try:
-                from .firebase_auth_service import FirebaseAuthService
-                firebase_service = FirebaseAuthService()
-                decoded_token = firebase_service.verify_id_token(firebase_id_token)
+                decoded_token = firebase_auth_service.verify_id_token(firebase_id_token)
                 
-                logger.info(f"Firebase token verified successfully for phone: {phone_number}")
+                logger.debug("Firebase token verified successfully for phone: %s", phone_number)
                 
                 # Получаем номер телефона из Firebase token
                 firebase_phone = decoded_token.get('phone_number')
                 if not firebase_phone:
-                    logger.warning(f"Phone number not found in Firebase token for phone: {phone_number}")
+                    logger.warning("Phone number not found in Firebase token for phone: %s", phone_number)
                     return Response({'error': 'Phone number not found in Firebase token'}, status=status.HTTP_400_BAD_REQUEST)
                 
-                # Нормализуем номер из Firebase (формат +7XXXXXXXXXX)
-                firebase_phone_clean = firebase_phone.replace('+', '').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-                # Нормализуем номер из запроса
-                phone_number_clean = phone_number.replace('+', '').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-                
-                # Если номер из запроса начинается с 8, заменяем на 7
-                if phone_number_clean.startswith('8') and len(phone_number_clean) == 11:
-                    phone_number_clean = '7' + phone_number_clean[1:]
-                
-                # Если номер из запроса имеет 10 цифр, добавляем 7
-                if len(phone_number_clean) == 10:
-                    phone_number_clean = '7' + phone_number_clean
-                
                 # Проверяем что номера совпадают
-                if firebase_phone_clean != phone_number_clean:
-                    logger.warning(f"Phone number mismatch: Firebase={firebase_phone_clean}, Request={phone_number_clean}")
+                if normalize_phone(firebase_phone) != phone_e164:
+                    logger.warning("Phone number mismatch: Firebase=%s, Request=%s", firebase_phone, phone_e164)
                     return Response({'error': 'Phone number mismatch'}, status=status.HTTP_400_BAD_REQUEST)
                 
-                # Используем номер из Firebase для дальнейшей работы
-                phone_number = firebase_phone_clean
+                # Номер хранится цифрами без '+', как раньше
+                phone_number = phone_e164[1:]
             except Exception as e:
-                logger.error(f"Firebase verification error for {phone_number}: {str(e)}")
+                logger.error("Firebase verification error for %s: %s", phone_number, e)
                 return Response({'error': f'Firebase verification failed: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
             
-            logger.info(f"Using normalized phone number: {phone_number}")
+            logger.debug("Using normalized phone number: %s", phone_number)
 
             # Логика входа/регистрации
             try:
-                user = User.objects.get(phone_number=phone_number)
+                user = User.objects.get(phone_e164=phone_e164)
                 is_new = False
-                logger.info(f"Existing user found: {user.username}")
+                logger.debug("Existing user found: %s", user.username)
             except User.DoesNotExist:
-                username = f"user_{phone_number}"
-                # На случай коллизии username
-                base_username = username
-                suffix = 1
-                while User.objects.filter(username=username).exists():
-                    suffix += 1
-                    username = f"{base_username}_{suffix}"
-                user = User.objects.create_user(
-                    username=username,
-                    phone_number=phone_number,
-                    password='dummy_password_for_sms_user',  # безопасная заглушка
-                )
-                is_new = True
-                logger.info(f"New user created: {username}")
+                try:
+                    user = User.objects.create_user_with_unique_username(
+                        f"user_{phone_number}",
+                        phone_number=phone_number,
+                        password=None,  # вход только по SMS: пароль непригоден
+                    )
+                    is_new = True
+                    logger.info("New user created: %s", user.username)
+                except IntegrityError:
+                    # Параллельный запрос уже создал пользователя с этим номером
+                    user = User.objects.get(phone_e164=phone_e164)
+                    is_new = False
             except Exception as e:
-                logger.error(f"Database error during user lookup/creation: {str(e)}")
+                logger.error("Database error during user lookup/creation: %s", e)
                 return Response({'error': f'Database error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+            if not user.is_active:
+                return Response({'error': 'User account is disabled'}, status=status.HTTP_403_FORBIDDEN)
+
             try:
-                from rest_framework_simplejwt.tokens import RefreshToken
-                refresh = RefreshToken.for_user(user)
+                refresh = UserRefreshToken.for_user(user)
                 
-                logger.info(f"Tokens generated successfully for user: {user.username}")
+                logger.debug("Tokens generated successfully for user: %s", user.username)
+
+                user_data = {
+                    'id': user.id,
+                    'username': user.username,
+                    'phone_number': user.phone_number,
+                    'email': user.email,
+                }
+                verified_token_cache.remember(firebase_id_token, decoded_token, {
+                    'phone_e164': phone_e164,
+                    'user': user_data,
+                    'is_new': is_new,
+                })
 
                 return Response({
                     'access': str(refresh.access_token),
                     'refresh': str(refresh),
-                    'user': {
-                        'id': user.id,
-                        'username': user.username,
-                        'phone_number': user.phone_number,
-                        'email': user.email,
-                    },
+                    'user': user_data,
                     'isNewUser': is_new
                 }, status=status.HTTP_201_CREATED if is_new else status.HTTP_200_OK)
             except Exception as e:
-                logger.error(f"Token generation error for user {user.username}: {str(e)}")
+                logger.error("Token generation error for user %s: %s", user.username, e)
                 return Response({'error': f'Token generation error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
             # ЗАКОММЕНТИРОВАНО: Логика входа/регистрации временно отключена
@@ -344,66 +397,63 @@ class SmsVerifyCodeView(generics.GenericAPIView):
             #     return Response({'error': f'Token generation error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
                 
         except Exception as e:
-            logger.error(f"Unexpected error in SMS verification: {str(e)}")
+            logger.error("Unexpected error in SMS verification: %s", e)
             return Response({'error': f'Internal server error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@method_decorator(query_budget(6), name='dispatch')
 class EmailVerifyView(generics.GenericAPIView):
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle]
     
     def post(self, request):
-        import logging
-        logger = logging.getLogger(__name__)
-        
         try:
             email = request.data.get('email')
             firebase_id_token = request.data.get('firebase_id_token')
             first_name = request.data.get('first_name')
             last_name = request.data.get('last_name')
             
-            logger.info(f"Firebase email verification attempt for email: {email}")
+            logger.debug("Firebase email verification attempt for email: %s", email)
 
             if not email:
-                logger.warning(f"Missing email")
+                logger.warning("Missing email")
                 return Response({'error': 'Email is required'}, status=status.HTTP_400_BAD_REQUEST)
             
             if not firebase_id_token:
-                logger.warning(f"Missing firebase_id_token for email: {email}")
+                logger.warning("Missing firebase_id_token for email: %s", email)
                 return Response({'error': 'Firebase ID token is required'}, status=status.HTTP_400_BAD_REQUEST)
 
             # Проверяем Firebase ID token
             try:
-                from .firebase_auth_service import FirebaseAuthService
-                firebase_service = FirebaseAuthService()
-                decoded_token = firebase_service.verify_id_token(firebase_id_token)
+                decoded_token = firebase_auth_service.verify_id_token(firebase_id_token)
                 
-                logger.info(f"Firebase token verified successfully for email: {email}")
+                logger.debug("Firebase token verified successfully for email: %s", email)
                 
                 # Получаем email из Firebase token
                 firebase_email = decoded_token.get('email')
                 if not firebase_email:
-                    logger.warning(f"Email not found in Firebase token")
+                    logger.warning("Email not found in Firebase token")
                     return Response({'error': 'Email not found in Firebase token'}, status=status.HTTP_400_BAD_REQUEST)
                 
                 # Проверяем что email совпадает (case-insensitive)
                 if firebase_email.lower() != email.lower():
-                    logger.warning(f"Email mismatch: Firebase={firebase_email}, Request={email}")
+                    logger.warning("Email mismatch: Firebase=%s, Request=%s", firebase_email, email)
                     return Response({'error': 'Email mismatch'}, status=status.HTTP_400_BAD_REQUEST)
                 
                 # Используем email из Firebase для дальнейшей работы
                 email = firebase_email.lower()
             except Exception as e:
-                logger.error(f"Firebase verification error for {email}: {str(e)}")
+                logger.error("Firebase verification error for %s: %s", email, e)
                 return Response({'error': f'Firebase verification failed: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
             
-            logger.info(f"Using email: {email}")
+            logger.debug("Using email: %s", email)
 
             # Логика входа/регистрации
             try:
-                user = User.objects.filter(email__iexact=email).first()
+                user = User.objects.filter(email_normalized=normalize_email(email)).first()
                 is_new = False
                 if user:
-                    logger.info(f"Existing user found: {user.username}")
+                    logger.debug("Existing user found: %s", user.username)
                     # Обновляем имя и фамилию если они переданы
                     if first_name:
                         user.first_name = first_name
@@ -413,30 +463,30 @@ class EmailVerifyView(generics.GenericAPIView):
                         user.save()
                 else:
                     # Создаем нового пользователя
-                    username = f"user_{email.split('@')[0]}"
-                    base_username = username
-                    suffix = 1
-                    while User.objects.filter(username=username).exists():
-                        suffix += 1
-                        username = f"{base_username}_{suffix}"
-                    user = User.objects.create_user(
-                        username=username,
-                        email=email,
-                        password='dummy_password_for_email_user',  # безопасная заглушка
-                        first_name=first_name or '',
-                        last_name=last_name or '',
-                    )
-                    is_new = True
-                    logger.info(f"New user created: {username}")
+                    try:
+                        user = User.objects.create_user_with_unique_username(
+                            f"user_{email.split('@')[0]}",
+                            email=email,
+                            password=None,  # вход только по email: пароль непригоден
+                            first_name=first_name or '',
+                            last_name=last_name or '',
+                        )
+                        is_new = True
+                        logger.info("New user created: %s", user.username)
+                    except IntegrityError:
+                        # Параллельный запрос уже создал пользователя с этим email
+                        user = User.objects.get(email_normalized=normalize_email(email))
             except Exception as e:
-                logger.error(f"Database error during user lookup/creation: {str(e)}")
+                logger.error("Database error during user lookup/creation: %s", e)
                 return Response({'error': f'Database error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+            if not user.is_active:
+                return Response({'error': 'User account is disabled'}, status=status.HTTP_403_FORBIDDEN)
+
             try:
-                from rest_framework_simplejwt.tokens import RefreshToken
-                refresh = RefreshToken.for_user(user)
+                refresh = UserRefreshToken.for_user(user)
                 
-                logger.info(f"Tokens generated successfully for user: {user.username}")
+                logger.debug("Tokens generated successfully for user: %s", user.username)
 
                 return Response({
                     'access': str(refresh.access_token),
@@ -452,15 +502,16 @@ class EmailVerifyView(generics.GenericAPIView):
                     'isNewUser': is_new
                 }, status=status.HTTP_201_CREATED if is_new else status.HTTP_200_OK)
             except Exception as e:
-                logger.error(f"Token generation error for user {user.username}: {str(e)}")
+                logger.error("Token generation error for user %s: %s", user.username, e)
                 return Response({'error': f'Token generation error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
                 
         except Exception as e:
-            logger.error(f"Unexpected error in email verification: {str(e)}")
+            logger.error("Unexpected error in email verification: %s", e)
             return Response({'error': f'Internal server error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 # Delete account view
+@method_decorator(query_budget(30), name='dispatch')
 class DeleteAccountView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
     
@@ -468,7 +519,7 @@ class DeleteAccountView(generics.GenericAPIView):
         """Удалить аккаунт пользователя"""
         try:
             user = request.user
-            print(f"DEBUG: Deleting account for user {user.username} (phone: {user.phone_number})")
+            logger.info("Deleting account for user %s", user.pk)
             
             # Удаляем пользователя
             user.delete()
@@ -478,12 +529,13 @@ class DeleteAccountView(generics.GenericAPIView):
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
-            print(f"DEBUG: Error deleting account: {e}")
+            logger.exception("Error deleting account")
             return Response({
                 'error': 'Failed to delete account'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Test results view
+@method_decorator(query_budget(get=2, post=5), name='dispatch')
 class TestResultView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = UserTestResultSerializer
@@ -508,7 +560,7 @@ class TestResultView(generics.GenericAPIView):
             return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
             
         except Exception as e:
-            print(f"DEBUG: Error saving test result: {e}")
+            logger.exception("Error saving test result")
             return Response({
                 'error': 'Failed to save test result'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -528,8 +580,10 @@ class TestResultView(generics.GenericAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Social login stub
+@method_decorator(query_budget(6), name='dispatch')
 class SocialLoginStubView(generics.GenericAPIView):
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle]
     
     def post(self, request, provider=None):
         # Для Google авторизации
@@ -551,12 +605,15 @@ class SocialLoginStubView(generics.GenericAPIView):
         if not access_token or not id_token:
             return Response({'error': 'Google tokens are required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        if not normalize_email(email):
+            return Response({'error': 'Email is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
         # TODO: Валидация Google токенов
         # Пока что заглушка - создаем/находим пользователя по email
         
         try:
             # Ищем существующего пользователя по email
-            user = User.objects.get(email=email)
+            user = User.objects.get(email_normalized=normalize_email(email))
             
             # Обновляем данные пользователя
             if name:
@@ -564,8 +621,7 @@ class SocialLoginStubView(generics.GenericAPIView):
                 user.last_name = ' '.join(name.split()[1:]) if len(name.split()) > 1 else ''
             user.save()
             
-            from rest_framework_simplejwt.tokens import RefreshToken
-            refresh = RefreshToken.for_user(user)
+            refresh = UserRefreshToken.for_user(user)
             
             return Response({
                 'access': str(refresh.access_token),
@@ -581,18 +637,15 @@ class SocialLoginStubView(generics.GenericAPIView):
             
         except User.DoesNotExist:
             # Создаем нового пользователя
-            username = f"google_{email.split('@')[0]}"  # Генерируем username из email
-            
-            user = User.objects.create_user(
-                username=username,
+            user = User.objects.create_user_with_unique_username(
+                f"google_{email.split('@')[0]}",  # Генерируем username из email
                 email=email,
                 first_name=name.split()[0] if name else '',
                 last_name=' '.join(name.split()[1:]) if name and len(name.split()) > 1 else '',
-                password='',  # Без пароля для Google входа
+                password=None,  # Без пароля для Google входа
             )
             
-            from rest_framework_simplejwt.tokens import RefreshToken
-            refresh = RefreshToken.for_user(user)
+            refresh = UserRefreshToken.for_user(user)
             
             return Response({
                 'access': str(refresh.access_token),
@@ -607,9 +660,11 @@ class SocialLoginStubView(generics.GenericAPIView):
             }, status=status.HTTP_201_CREATED)
 
 
+@method_decorator(query_budget(6), name='dispatch')
 class FirebasePhoneLoginView(generics.GenericAPIView):
     """Аутентификация через Firebase Phone Auth"""
     permission_classes = [AllowAny]
+    throttle_classes = [AuthIPThrottle, PhoneThrottle]
 
     def post(self, request):
         phone_number = request.data.get('phone_number')
@@ -620,12 +675,20 @@ class FirebasePhoneLoginView(generics.GenericAPIView):
                 'error': 'phone_number and firebase_id_token are required'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        # Повтор с уже проверенным токеном: без проверки подписи
+        replay = replay_verified_login(firebase_id_token, normalize_phone(phone_number))
+        if replay is not None:
+            cached_login, cached_user = replay
+            refresh = UserRefreshToken.for_user(cached_user)
+            return Response({
+                'access': str(refresh.access_token),
+                'refresh': str(refresh),
+                'user': cached_login['user'],
+            })
+        
         try:
-            # Инициализируем Firebase сервис
-            firebase_service = FirebaseAuthService()
-            
             # Проверяем Firebase токен
-            firebase_user_data = firebase_service.verify_phone_number_token(firebase_id_token)
+            firebase_user_data = firebase_auth_service.verify_phone_number_token(firebase_id_token)
             
             # Проверяем, что номер телефона в токене совпадает с переданным
             if firebase_user_data['phone_number'] != phone_number:
@@ -638,7 +701,10 @@ class FirebasePhoneLoginView(generics.GenericAPIView):
             username = f"firebase_{firebase_uid}"
             
             try:
-                user = User.objects.get(username=username)
+                user = User.objects.filter(username=username).first()
+                if user is None:
+                    # Аккаунт с этим номером мог быть создан через SMS вход
+                    user = User.objects.get(phone_e164=normalize_phone(phone_number))
                 # Обновляем номер телефона если изменился
                 if user.phone_number != phone_number:
                     user.phone_number = phone_number
@@ -653,22 +719,30 @@ class FirebasePhoneLoginView(generics.GenericAPIView):
                     last_name=' '.join(firebase_user_data.get('name', '').split(' ')[1:]) if firebase_user_data.get('name') else '',
                 )
             
+            if not user.is_active:
+                return Response({'error': 'User account is disabled'}, status=status.HTTP_403_FORBIDDEN)
+            
             # Генерируем JWT токены
-            from rest_framework_simplejwt.tokens import RefreshToken
-            refresh = RefreshToken.for_user(user)
+            refresh = UserRefreshToken.for_user(user)
+            
+            user_data = {
+                'id': user.id,
+                'username': user.username,
+                'phone_number': user.phone_number,
+                'email': user.email,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'is_new_user': False,  # Всегда False для Firebase, так как пользователь уже верифицирован
+            }
+            verified_token_cache.remember(firebase_id_token, firebase_user_data, {
+                'phone_e164': normalize_phone(phone_number),
+                'user': user_data,
+            })
             
             return Response({
                 'access': str(refresh.access_token),
                 'refresh': str(refresh),
-                'user': {
-                    'id': user.id,
-                    'username': user.username,
-                    'phone_number': user.phone_number,
-                    'email': user.email,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'is_new_user': False,  # Всегда False для Firebase, так как пользователь уже верифицирован
-                }
+                'user': user_data,
             })
             
         except Exception as e:
@@ -678,6 +752,9 @@ class FirebasePhoneLoginView(generics.GenericAPIView):
 
 
 # Daily Notes Views
+# ETag читает заметки и приложения, app_usage - дневные записи и архив для старых дат
+@method_decorator(query_budget(6), name='dispatch')
+@method_decorator(conditional_get(daily_notes_etag), name='get')
 class DailyNoteListCreateView(generics.ListCreateAPIView):
     serializer_class = DailyNoteSerializer
     permission_classes = [IsAuthenticated]
@@ -685,31 +762,8 @@ class DailyNoteListCreateView(generics.ListCreateAPIView):
     def get_queryset(self):
         return DailyNote.objects.filter(user=self.request.user)
 
-    def create(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        daily_note = serializer.save()
-        
-        # Добавляем примеры использования приложений (заглушка)
-        app_usage_data = [
-            {'app_name': 'Telegram', 'app_category': 'useful', 'usage_time_seconds': 5124},
-            {'app_name': 'YouTube', 'app_category': 'harmful', 'usage_time_seconds': 1524},
-            {'app_name': 'TikTok', 'app_category': 'useless', 'usage_time_seconds': 24},
-        ]
-        
-        for app_data in app_usage_data:
-            app_data['user'] = request.user
-            app_data['date'] = daily_note.date
-            AppUsage.objects.get_or_create(
-                user=request.user,
-                date=daily_note.date,
-                app_name=app_data['app_name'],
-                defaults=app_data
-            )
-        
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
-
 
+@method_decorator(query_budget(7), name='dispatch')
 class DailyNoteDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = DailyNoteSerializer
     permission_classes = [IsAuthenticated]
@@ -718,6 +772,8 @@ class DailyNoteDetailView(generics.RetrieveUpdateDestroyAPIView):
         return DailyNote.objects.filter(user=self.request.user)
 
 
+# Заметка за дату старше горячего окна читает и архив использования
+@method_decorator(query_budget(4), name='dispatch')
 class DailyNoteByDateView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -731,29 +787,42 @@ class DailyNoteByDateView(APIView):
 
 
 # Chat Views
+@method_decorator(query_budget(4), name='dispatch')
 class ChatSessionListCreateView(generics.ListCreateAPIView):
     serializer_class = ChatSessionSerializer
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        return ChatSession.objects.filter(user=self.request.user, is_active=True)
+        return prefetch_chat_messages(ChatSession.objects.filter(user=self.request.user, is_active=True))
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
 
+@method_decorator(query_budget(8), name='dispatch')
 class ChatSessionDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ChatSessionSerializer
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        return ChatSession.objects.filter(user=self.request.user, is_active=True)
+        return prefetch_chat_messages(ChatSession.objects.filter(user=self.request.user, is_active=True))
+    
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(self.get_object(), data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        # UpdateModelMixin сбрасывает prefetch после сохранения, и сообщения
+        # с вложениями загружались бы по одному: перечитываем сессию с prefetch
+        session = self.get_queryset().get(pk=serializer.instance.pk)
+        return Response(self.get_serializer(session).data)
     
     def perform_destroy(self, instance):
         instance.is_active = False
         instance.save()
 
 
+@method_decorator(query_budget(4), name='dispatch')
 class MessageListCreateView(generics.ListCreateAPIView):
     serializer_class = ChatMessageSerializer
     permission_classes = [IsAuthenticated]
@@ -763,7 +832,7 @@ class MessageListCreateView(generics.ListCreateAPIView):
         return ChatMessage.objects.filter(
             session_id=session_id,
             session__user=self.request.user
-        ).order_by('created_at')
+        ).prefetch_related('attachments').order_by('created_at')
     
     def perform_create(self, serializer):
         session_id = self.kwargs['session_id']
@@ -771,6 +840,7 @@ class MessageListCreateView(generics.ListCreateAPIView):
         serializer.save(session=session)
 
 
+@method_decorator(query_budget(15), name='dispatch')
 class SendMessageView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -791,6 +861,7 @@ class SendMessageView(APIView):
             
             # Отправляем сообщение в ChatGPT
             response = chat_service.send_message(session_id, content, attachments)
+            achievement_engine.record_chat_message(request.user)
             
             return Response({
                 'message': 'Message sent successfully',
@@ -800,110 +871,7 @@ class SendMessageView(APIView):
             return Response({'error': str(e)}, status=500)
 
 
-class DailyTimelineView(APIView):
-    """API для работы с timeline данными"""
-    permission_classes = [IsAuthenticated]
-    
-    def get(self, request):
-        """Получить timeline данные за конкретную дату"""
-        date_str = request.query_params.get('date')
-        if not date_str:
-            return Response({'error': 'Date parameter is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
-    
-    def post(self, request):
-        """Сохранить или обновить timeline данные"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Обновляем данные сегментов
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', timeline.sessions_count)
-        timeline.update_totals()
-        timeline.save()
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data, status=201 if created else 200)
-    
-    def put(self, request):
-        """Обновить timeline данные (полная замена)"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Сбрасываем все сегменты
-        for i in range(15):
-            timeline.set_segment_data(i, 0, 0)
-        
-        # Заполняем новыми данными
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', 0)
-        timeline.update_totals()
-        timeline.save()
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
-
-
+@method_decorator(query_budget(2), name='dispatch')
 class FileUploadView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -923,113 +891,11 @@ class FileUploadView(APIView):
             return Response({'error': str(e)}, status=500)
 
 
-class DailyTimelineView(APIView):
-    """API для работы с timeline данными"""
-    permission_classes = [IsAuthenticated]
-    
-    def get(self, request):
-        """Получить timeline данные за конкретную дату"""
-        date_str = request.query_params.get('date')
-        if not date_str:
-            return Response({'error': 'Date parameter is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
-    
-    def post(self, request):
-        """Сохранить или обновить timeline данные"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Обновляем данные сегментов
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', timeline.sessions_count)
-        timeline.update_totals()
-        timeline.save()
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data, status=201 if created else 200)
-    
-    def put(self, request):
-        """Обновить timeline данные (полная замена)"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Сбрасываем все сегменты
-        for i in range(15):
-            timeline.set_segment_data(i, 0, 0)
-        
-        # Заполняем новыми данными
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', 0)
-        timeline.update_totals()
-        timeline.save()
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
-
-
+@method_decorator(query_budget(get=3, put=6), name='dispatch')
 class UserProfileView(APIView):
     permission_classes = [IsAuthenticated]
     
+    @method_decorator(conditional_get(user_profile_etag))
     def get(self, request):
         """Получить профиль текущего пользователя"""
         from .serializers import UserSerializer
@@ -1039,13 +905,15 @@ class UserProfileView(APIView):
     def put(self, request):
         """Обновить профиль пользователя"""
         from .serializers import UserSerializer
-        serializer = UserSerializer(request.user, data=request.data, partial=True, context={'request': request})
+        user = load_request_user(request)
+        serializer = UserSerializer(user, data=request.data, partial=True, context={'request': request})
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=400)
 
 
+@method_decorator(query_budget(4), name='dispatch')
 class UserSubscriptionView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -1056,7 +924,7 @@ class UserSubscriptionView(APIView):
         if subscription_type not in ['free', 'premium', 'pro']:
             return Response({'error': 'Invalid subscription type'}, status=400)
         
-        user = request.user
+        user = load_request_user(request)
         user.subscription_type = subscription_type
         user.has_subscription = subscription_type != 'free'
         
@@ -1075,13 +943,14 @@ class UserSubscriptionView(APIView):
         return Response(serializer.data)
 
 
+@method_decorator(query_budget(3), name='dispatch')
 class UserAvatarView(APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
         """Загрузить аватарку пользователя"""
         try:
-            user = request.user
+            user = load_request_user(request)
             import os
             from django.conf import settings
             
@@ -1131,9 +1000,9 @@ class UserAvatarView(APIView):
             if old_avatar_path and os.path.exists(old_avatar_path):
                 try:
                     os.remove(old_avatar_path)
-                    print(f"DEBUG: Удален старый файл аватарки: {old_avatar_path}")
+                    logger.debug("Удален старый файл аватарки: %s", old_avatar_path)
                 except Exception as e:
-                    print(f"DEBUG: Ошибка удаления старого файла: {e}")
+                    logger.warning("Ошибка удаления старого файла аватарки %s: %s", old_avatar_path, e)
             
             from .serializers import UserSerializer
             serializer = UserSerializer(user, context={'request': request})
@@ -1142,6 +1011,9 @@ class UserAvatarView(APIView):
             return Response({'error': str(e)}, status=500)
 
 
+# Запись за архивную дату добавляет 6 запросов на возврат строки из архива,
+# транзакция записи - SAVEPOINT и RELEASE внутри тестовой транзакции
+@method_decorator(query_budget(get=4, post=21, put=18), name='dispatch')
 class DailyTimelineView(APIView):
     """API для работы с timeline данными"""
     permission_classes = [IsAuthenticated]
@@ -1158,11 +1030,14 @@ class DailyTimelineView(APIView):
         except ValueError:
             return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
         
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
+        # Старые даты могут быть уже в архиве
+        timeline = get_archived(DailyTimeline, date, user=request.user)
+        if timeline is None:
+            timeline, created = DailyTimeline.objects.get_or_create(
+                user=request.user,
+                date=date,
+                defaults={}
+            )
         
         serializer = DailyTimelineSerializer(timeline, context={'request': request})
         return Response(serializer.data)
@@ -1179,27 +1054,34 @@ class DailyTimelineView(APIView):
         except ValueError:
             return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
         
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Обновляем данные сегментов
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
+        # Строка блокируется до конца транзакции: параллельная запись за тот же
+        # день ждет, и разница для итогов считается от актуальных значений
+        with transaction.atomic():
+            # Получаем или создаем timeline запись
+            restore_archived(DailyTimeline, date, user=request.user)
+            timeline, created = DailyTimeline.objects.select_for_update().get_or_create(
+                user=request.user,
+                date=date,
+                defaults={}
+            )
+            before = timeline_totals(timeline)
             
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', timeline.sessions_count)
-        timeline.update_totals()
-        timeline.save()
+            # Обновляем данные сегментов
+            segments_data = request.data.get('segments', [])
+            for segment_data in segments_data:
+                index = segment_data.get('index')
+                useful_seconds = segment_data.get('useful_seconds', 0)
+                harmful_seconds = segment_data.get('harmful_seconds', 0)
+                
+                if 0 <= index <= 14:
+                    timeline.set_segment_data(index, useful_seconds, harmful_seconds)
+            
+            # Обновляем общие счетчики
+            timeline.sessions_count = request.data.get('sessions_count', timeline.sessions_count)
+            timeline.update_totals()
+            timeline.save()
+            add_timeline_change(request.user.id, date, before, timeline_totals(timeline))
+        achievement_engine.record_activity(request.user, date)
         
         serializer = DailyTimelineSerializer(timeline, context={'request': request})
         return Response(serializer.data, status=201 if created else 200)
@@ -1216,150 +1098,57 @@ class DailyTimelineView(APIView):
         except ValueError:
             return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
         
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Сбрасываем все сегменты
-        for i in range(15):
-            timeline.set_segment_data(i, 0, 0)
-        
-        # Заполняем новыми данными
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
+        # Как в post: строка заблокирована, пока итоги не получат разницу
+        with transaction.atomic():
+            # Получаем или создаем timeline запись
+            restore_archived(DailyTimeline, date, user=request.user)
+            timeline, created = DailyTimeline.objects.select_for_update().get_or_create(
+                user=request.user,
+                date=date,
+                defaults={}
+            )
+            before = timeline_totals(timeline)
             
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', 0)
-        timeline.update_totals()
-        timeline.save()
+            # Сбрасываем все сегменты
+            for i in range(15):
+                timeline.set_segment_data(i, 0, 0)
+            
+            # Заполняем новыми данными
+            segments_data = request.data.get('segments', [])
+            for segment_data in segments_data:
+                index = segment_data.get('index')
+                useful_seconds = segment_data.get('useful_seconds', 0)
+                harmful_seconds = segment_data.get('harmful_seconds', 0)
+                
+                if 0 <= index <= 14:
+                    timeline.set_segment_data(index, useful_seconds, harmful_seconds)
+            
+            # Обновляем общие счетчики
+            timeline.sessions_count = request.data.get('sessions_count', 0)
+            timeline.update_totals()
+            timeline.save()
+            add_timeline_change(request.user.id, date, before, timeline_totals(timeline))
+        achievement_engine.record_activity(request.user, date)
         
         serializer = DailyTimelineSerializer(timeline, context={'request': request})
         return Response(serializer.data)
-    
-    def delete(self, request):
-        """Удалить аватарку пользователя"""
-        try:
-            user = request.user
-            if user.avatar:
-                user.avatar.delete()
-            user.avatar = None
-            user.save()
-            
-            from .serializers import UserSerializer
-            serializer = UserSerializer(user, context={'request': request})
-            return Response(serializer.data)
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
 
 
-class DailyTimelineView(APIView):
-    """API для работы с timeline данными"""
+@method_decorator(query_budget(3), name='dispatch')
+class TimelineStatsView(APIView):
+    """API итогов timeline за длинные периоды"""
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        """Получить timeline данные за конкретную дату"""
+        """Итоги за неделю, месяц и год, содержащие дату (по умолчанию сегодня), и за все время"""
         date_str = request.query_params.get('date')
-        if not date_str:
-            return Response({'error': 'Date parameter is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
-    
-    def post(self, request):
-        """Сохранить или обновить timeline данные"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Обновляем данные сегментов
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', timeline.sessions_count)
-        timeline.update_totals()
-        timeline.save()
-        
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data, status=201 if created else 200)
-    
-    def put(self, request):
-        """Обновить timeline данные (полная замена)"""
-        date_str = request.data.get('date')
-        if not date_str:
-            return Response({'error': 'Date is required'}, status=400)
-        
-        try:
-            from datetime import datetime
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
-        
-        # Получаем или создаем timeline запись
-        timeline, created = DailyTimeline.objects.get_or_create(
-            user=request.user,
-            date=date,
-            defaults={}
-        )
-        
-        # Сбрасываем все сегменты
-        for i in range(15):
-            timeline.set_segment_data(i, 0, 0)
-        
-        # Заполняем новыми данными
-        segments_data = request.data.get('segments', [])
-        for segment_data in segments_data:
-            index = segment_data.get('index')
-            useful_seconds = segment_data.get('useful_seconds', 0)
-            harmful_seconds = segment_data.get('harmful_seconds', 0)
-            
-            if 0 <= index <= 14:
-                timeline.set_segment_data(index, useful_seconds, harmful_seconds)
-        
-        # Обновляем общие счетчики
-        timeline.sessions_count = request.data.get('sessions_count', 0)
-        timeline.update_totals()
-        timeline.save()
+        if date_str:
+            try:
+                from datetime import datetime
+                date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            except ValueError:
+                return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
+        else:
+            date = timezone.now().date()
         
-        serializer = DailyTimelineSerializer(timeline, context={'request': request})
-        return Response(serializer.data)
\ No newline at end of file
+        return Response({'date': date, **timeline_stats(request.user.id, date)})
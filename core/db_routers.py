@@ -0,0 +1,110 @@
+"""
+Чтение с реплик БД.
+
+ReplicaRoutingMiddleware помечает безопасные запросы (GET, HEAD, OPTIONS),
+и ReplicaRouter отправляет их чтения на одну из REPLICA_DATABASES. Запись,
+чтения внутри транзакции и все запросы с изменениями идут в default.
+
+После изменяющего запроса пользователь на REPLICA_STICKY_SECONDS
+"прилипает" к default, чтобы сразу видеть свои изменения, даже если реплика
+отстает. Метка хранится в общем кеше, поэтому действует во всех воркерах.
+Для входа без токена (регистрация по SMS, Firebase, пароль) пользователь
+берется из выданного в ответе access токена: иначе первый GET нового
+пользователя мог бы не найти его на отстающей реплике.
+"""
+import random
+from contextvars import ContextVar
+
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_KEY_PREFIX = 'replica_sticky_'
+
+# Можно ли текущему запросу читать с реплики
+replica_reads = ContextVar('replica_reads', default=False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not replica_reads.get() or not settings.REPLICA_DATABASES:
+            return DEFAULT_DB_ALIAS
+        # Внутри транзакции читаем то, что она уже записала
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.REPLICA_DATABASES}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплики получают схему через репликацию
+        return db not in settings.REPLICA_DATABASES
+
+
+class ReplicaRoutingMiddleware:
+    """Разрешает чтение с реплик безопасным запросам пользователей без недавних изменений"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_DATABASES:
+            return self.get_response(request)
+
+        safe = request.method in SAFE_METHODS
+        token_user_id = self._token_user_id(request)
+        use_replica = safe and not (token_user_id and cache.get(f'{STICKY_KEY_PREFIX}{token_user_id}'))
+
+        context_token = replica_reads.set(use_replica)
+        try:
+            response = self.get_response(request)
+        finally:
+            replica_reads.reset(context_token)
+
+        if not safe:
+            user = getattr(request, 'user', None)
+            user_id = user.pk if user is not None and user.is_authenticated else token_user_id
+            if not user_id:
+                user_id = self._issued_token_user_id(response)
+            if user_id:
+                cache.set(f'{STICKY_KEY_PREFIX}{user_id}', 1, timeout=settings.REPLICA_STICKY_SECONDS)
+        return response
+
+    @classmethod
+    def _token_user_id(cls, request):
+        """id пользователя из access токена в заголовке Authorization"""
+        header = request.headers.get('Authorization', '')
+        scheme, _, raw_token = header.partition(' ')
+        if scheme not in jwt_settings.AUTH_HEADER_TYPES or not raw_token:
+            return None
+        return cls._claims_user_id(raw_token)
+
+    @classmethod
+    def _issued_token_user_id(cls, response):
+        """id пользователя из access токена, выданного в ответе эндпоинта входа"""
+        data = getattr(response, 'data', None)
+        if not isinstance(data, dict) or not isinstance(data.get('access'), str):
+            return None
+        return cls._claims_user_id(data['access'])
+
+    @staticmethod
+    def _claims_user_id(raw_token):
+        """
+        id пользователя из access токена без проверки подписи.
+
+        Используется только для выбора БД: подделанный токен может лишь
+        отправить чтения на default, аутентификацию проверяет DRF.
+        """
+        try:
+            claims = jwt.decode(raw_token, options={'verify_signature': False})
+        except jwt.PyJWTError:
+            return None
+        return claims.get(jwt_settings.USER_ID_CLAIM)
@@ -0,0 +1,175 @@
+"""
+Асинхронное структурированное логирование.
+
+Поток запроса только кладет запись в очередь (QueueLogHandler), а
+подстановку аргументов, форматирование в JSON и запись в файл/консоль
+выполняет отдельный поток QueueListener. Записи ниже WARNING можно прореживать по логгерам
+(SamplingFilter), чтобы частые сообщения не забивали очередь под нагрузкой.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import weakref
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from logging.handlers import QueueHandler, QueueListener
+from uuid import UUID
+
+# Стандартные атрибуты LogRecord: все остальное пришло через extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Аргументы этих типов не меняются после вызова логгера, их можно
+# подставить в сообщение позже, в потоке слушателя
+_IMMUTABLE_ARG_TYPES = (str, bytes, int, float, type(None), Decimal, UUID, date)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra= попадают в запись как есть"""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        elif record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей ниже WARNING для указанных логгеров.
+
+    rates - словарь {'accounts.views': 0.1}; правило логгера действует и на
+    дочерние логгеры, побеждает самое длинное совпадение. WARNING и выше
+    проходят всегда.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        if isinstance(rates, str):
+            rates = parse_sample_rates(rates)
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+
+def parse_sample_rates(value):
+    """'accounts.views=0.1,accounts.firebase_auth_service=0.5' -> словарь долей"""
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Кладет записи в очередь, из которой их пишет фоновый поток.
+
+    В LOGGING указываются целевые обработчики через cfg://handlers.<имя>,
+    имя этого обработчика должно идти после них по алфавиту: dictConfig
+    создает обработчики в алфавитном порядке.
+
+    Очередь ограничена: при переполнении запись отбрасывается, а не
+    блокирует поток запроса.
+    """
+
+    def __init__(self, handlers, maxsize=10000, respect_handler_level=True):
+        super().__init__(queue.Queue(maxsize))
+        self.target_handlers = [handlers[index] for index in range(len(handlers))]
+        self.respect_handler_level = respect_handler_level
+        self.dropped = 0
+        self.listener = None
+        self._start()
+        _running_handlers.add(self)
+
+    def _start(self):
+        self.listener = QueueListener(
+            self.queue, *self.target_handlers, respect_handler_level=self.respect_handler_level
+        )
+        self.listener.start()
+
+    def _restart_after_fork(self):
+        # После fork (gunicorn с --preload) потока слушателя в дочернем процессе
+        # нет, а блокировка очереди могла остаться захваченной
+        self.queue = queue.Queue(self.queue.maxsize)
+        self._start()
+
+    def stop(self):
+        _running_handlers.discard(self)
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def prepare(self, record):
+        # В потоке запроса запись только копируется: аргументы, traceback и
+        # JSON форматирует поток слушателя. Изменяемые аргументы (списки,
+        # модели) подставляются сразу, пока объект не изменился
+        record = logging.makeLogRecord(vars(record))
+        if record.args and not _immutable_args(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _immutable_args(args):
+    values = args.values() if isinstance(args, dict) else args
+    return all(isinstance(value, _IMMUTABLE_ARG_TYPES) for value in values)
+
+
+# Обработчики с работающим слушателем. Хуки fork и выхода регистрируются
+# один раз на процесс, а не на каждый экземпляр: после повторного
+# dictConfig старые обработчики не перезапускаются в дочерних процессах
+_running_handlers = weakref.WeakSet()
+
+
+def _restart_handlers_after_fork():
+    for handler in list(_running_handlers):
+        handler._restart_after_fork()
+
+
+def _stop_handlers():
+    for handler in list(_running_handlers):
+        handler.stop()
+
+
+atexit.register(_stop_handlers)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_handlers_after_fork)
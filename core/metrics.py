@@ -0,0 +1,93 @@
+"""
+Метрики запросов в формате Prometheus (prometheus_client).
+
+Gunicorn запускает несколько воркеров, и каждый scrape /metrics попадает
+в один из них. Поэтому под gunicorn (gunicorn.conf.py) включается
+multiprocess режим prometheus_client: воркеры пишут значения в mmap файлы
+каталога PROMETHEUS_MULTIPROC_DIR, а /metrics суммирует файлы всех воркеров,
+включая уже перезапущенные. Без этой переменной (runserver, тесты) метрики
+хранятся в памяти процесса.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, multiprocess
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Свой реестр вместо глобального: в нем только метрики приложения, без
+# метрик процесса, которые в multiprocess режиме не собираются
+REGISTRY = CollectorRegistry(auto_describe=True)
+
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Время обработки запроса',
+    ('view', 'method', 'status'), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Количество SQL запросов на HTTP запрос',
+    ('view', 'method'), buckets=QUERY_COUNT_BUCKETS, registry=REGISTRY,
+)
+REQUEST_DB_TIME = Histogram(
+    'http_request_db_duration_seconds', 'Суммарное время SQL запросов на HTTP запрос',
+    ('view', 'method'), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+REQUEST_EXTERNAL_TIME = Histogram(
+    'http_request_external_duration_seconds', 'Суммарное время внешних вызовов на HTTP запрос',
+    ('view', 'method'), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes', 'Размер тела ответа',
+    ('view', 'method'), buckets=SIZE_BUCKETS, registry=REGISTRY,
+)
+EXTERNAL_CALL_LATENCY = Histogram(
+    'external_call_duration_seconds', 'Время вызовов внешних сервисов (OpenAI, Firebase, SMS)',
+    ('service', 'outcome'), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+
+
+class RequestStats:
+    """Счетчики текущего запроса, которые заполняют обертки БД и внешних вызовов"""
+    __slots__ = ('db_queries', 'db_time', 'external_time')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.external_time = 0.0
+
+
+current_request_stats = ContextVar('current_request_stats', default=None)
+
+
+@contextmanager
+def external_call(service):
+    """
+    Засекает вызов внешнего сервиса.
+
+    Время попадает в external_call_duration_seconds и, если вызов идет внутри
+    измеряемого запроса, в его суммарное время внешних вызовов.
+    """
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = time.perf_counter() - started
+        EXTERNAL_CALL_LATENCY.labels(service=service, outcome=outcome).observe(elapsed)
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.external_time += elapsed
+
+
+def render_metrics():
+    """Метрики в текстовом формате: сумма по всем воркерам в multiprocess режиме"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
@@ -0,0 +1,70 @@
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import (
+    REQUEST_DB_QUERIES, REQUEST_DB_TIME, REQUEST_EXTERNAL_TIME, REQUEST_LATENCY,
+    RESPONSE_SIZE, RequestStats, current_request_stats,
+)
+
+
+class MetricsMiddleware:
+    """
+    Собирает метрики запросов: время ответа, количество и время SQL запросов,
+    время внешних вызовов и размер ответа по каждому view.
+
+    Измеряется доля запросов METRICS_SAMPLE_RATE (0 - выключено, 1 - все).
+    Неизмеряемый запрос стоит одного вызова random().
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = settings.METRICS_SAMPLE_RATE
+        if sample_rate <= 0 or (sample_rate < 1 and random.random() >= sample_rate):
+            return self.get_response(request)
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self._query_wrapper(stats)))
+                response = self.get_response(request)
+        finally:
+            current_request_stats.reset(token)
+        elapsed = time.perf_counter() - started
+
+        view = self._view_name(request)
+        method = request.method
+        REQUEST_LATENCY.labels(view=view, method=method, status=response.status_code).observe(elapsed)
+        REQUEST_DB_QUERIES.labels(view=view, method=method).observe(stats.db_queries)
+        REQUEST_DB_TIME.labels(view=view, method=method).observe(stats.db_time)
+        REQUEST_EXTERNAL_TIME.labels(view=view, method=method).observe(stats.external_time)
+        if not response.streaming:
+            RESPONSE_SIZE.labels(view=view, method=method).observe(len(response.content))
+        return response
+
+    @staticmethod
+    def _query_wrapper(stats):
+        def wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stats.db_queries += 1
+                stats.db_time += time.perf_counter() - started
+        return wrapper
+
+    @staticmethod
+    def _view_name(request):
+        # Шаблон маршрута вместо пути: id в URL не раздувают число серий
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unmatched'
+        return match.route or match.view_name
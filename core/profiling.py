@@ -0,0 +1,141 @@
+"""
+Профилирование отдельных запросов в продакшене.
+
+Запрос профилируется cProfile, если пришел заголовок X-Profile с токеном
+PROFILING_TOKEN или он попал в выборку PROFILING_SAMPLE_RATE. Результат
+сохраняется в PROFILING_DIR в формате pstats (открывается snakeviz или
+python -m pstats), каталог ограничен PROFILING_MAX_FILES файлами и
+PROFILING_MAX_BYTES байтами: старые профили удаляются.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SUFFIX = '.prof'
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+class ProfilingMiddleware:
+    """
+    Снимает cProfile с запроса по заголовку или выборке.
+
+    Без токена и с нулевой долей выборки стоит одной проверки настроек.
+    Профилированный ответ получает заголовок X-Profile-Id с именем файла.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self._should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError:
+            # В этом потоке уже работает другой профайлер
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        name = save_profile(profiler, request, elapsed)
+        response['X-Profile-Id'] = name
+        return response
+
+    @staticmethod
+    def _should_profile(request):
+        token = settings.PROFILING_TOKEN
+        header = request.headers.get(PROFILE_HEADER)
+        if token and header and hmac.compare_digest(header, token):
+            return True
+        sample_rate = settings.PROFILING_SAMPLE_RATE
+        return sample_rate > 0 and random.random() < sample_rate
+
+
+def _profile_dir():
+    directory = settings.PROFILING_DIR
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def save_profile(profiler, request, elapsed):
+    """Сохраняет профиль запроса и удаляет старые сверх лимитов каталога"""
+    match = getattr(request, 'resolver_match', None)
+    route = (match.route if match else '') or request.path
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    route_label = _UNSAFE_CHARS.sub('_', route).strip('_')[:80] or 'root'
+    name = f'{stamp}_{request.method}_{route_label}_{int(elapsed * 1000)}ms{PROFILE_SUFFIX}'
+
+    directory = _profile_dir()
+    # Файл появляется в каталоге целиком: список профилей не видит недописанный
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    profiler.dump_stats(temp_path)
+    os.replace(temp_path, os.path.join(directory, name))
+    prune_profiles(directory)
+    return name
+
+
+def prune_profiles(directory=None):
+    """Оставляет не больше PROFILING_MAX_FILES профилей и PROFILING_MAX_BYTES байт"""
+    profiles = list_profiles(directory)
+    total = 0
+    for index, profile in enumerate(profiles):
+        total += profile['size']
+        if index >= settings.PROFILING_MAX_FILES or total > settings.PROFILING_MAX_BYTES:
+            try:
+                os.remove(os.path.join(directory or settings.PROFILING_DIR, profile['name']))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory=None):
+    """Профили от новых к старым"""
+    directory = directory or settings.PROFILING_DIR
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for entry in entries:
+        if not entry.name.endswith(PROFILE_SUFFIX) or not entry.is_file():
+            continue
+        stat = entry.stat()
+        profiles.append({
+            'name': entry.name,
+            'size': stat.st_size,
+            'created_at': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+        })
+    profiles.sort(key=lambda profile: profile['name'], reverse=True)
+    return profiles
+
+
+def profile_path(name):
+    """Путь к профилю по имени из list_profiles или None"""
+    if os.path.basename(name) != name or not name.endswith(PROFILE_SUFFIX):
+        return None
+    path = os.path.join(settings.PROFILING_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def profile_summary(path, sort='cumulative', limit=50):
+    """Текстовая сводка pstats: самые тяжелые функции профиля"""
+    stream = io.StringIO()
+    stats = pstats.Stats(path, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
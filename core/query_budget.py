@@ -0,0 +1,79 @@
+"""
+Бюджет SQL запросов для view.
+
+Каждый эндпоинт объявляет, сколько запросов к БД ему разрешено, и это число
+не должно зависеть от объема данных пользователя. Превышение бюджета
+в тестах падает с QueryBudgetExceeded, в продакшене пишется в лог
+(settings.QUERY_BUDGET_ACTION: 'raise', 'log' или 'off').
+"""
+import logging
+from contextlib import ExitStack
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(default=None, **per_method):
+    """
+    Декоратор view с бюджетом запросов: общим и/или по HTTP методам.
+
+        @query_budget(3)
+        @api_view(['GET'])
+        def get_user_apps(request): ...
+
+        @method_decorator(query_budget(get=2, post=6), name='dispatch')
+        class ExperienceView(APIView): ...
+
+    Для function view декоратор ставится над @api_view, для классов - на
+    dispatch, чтобы в подсчет попали аутентификация и обработка ошибок DRF.
+    """
+    budgets = {method.upper(): limit for method, limit in per_method.items()}
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            action = settings.QUERY_BUDGET_ACTION
+            limit = budgets.get(request.method, default)
+            if action == 'off' or limit is None:
+                return view_func(request, *args, **kwargs)
+
+            queries = []
+
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_query))
+                response = view_func(request, *args, **kwargs)
+
+            if len(queries) > limit:
+                message = (
+                    f'{request.method} {request.path}: {len(queries)} SQL queries, '
+                    f'budget {limit}'
+                )
+                if action == 'raise':
+                    raise QueryBudgetExceeded(message + '\n' + '\n'.join(queries))
+                logger.warning(message)
+            return response
+
+        wrapper.query_budget = {'default': default, **budgets}
+        return wrapper
+    return decorator
+
+
+def get_query_budget(callback):
+    """Объявленный бюджет view из URL конфигурации или None"""
+    budget = getattr(callback, 'query_budget', None)
+    view_class = getattr(callback, 'view_class', None)
+    if budget is None and view_class is not None:
+        budget = getattr(view_class.dispatch, 'query_budget', None)
+    return budget
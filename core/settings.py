@@ -76,6 +76,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.profiling.ProfilingMiddleware',
+    'core.db_routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -119,6 +122,18 @@ DB_PASSWORD = os.getenv('DB_PASSWORD') or os.getenv('POSTGRES_PASSWORD')
 DB_HOST = os.getenv('DB_HOST') or os.getenv('POSTGRES_HOST', 'localhost')
 DB_PORT = os.getenv('DB_PORT') or os.getenv('POSTGRES_PORT', '5432')
 
+# Постоянные соединения: воркер держит соединение с БД между запросами
+# DB_CONN_MAX_AGE секунд (none - без ограничения, 0 - новое на каждый запрос)
+# и перед повторным использованием проверяет, что оно живо.
+# DB_PGBOUNCER=true - режим для pgbouncer с пулингом транзакций: серверные
+# курсоры отключаются, потому что не переживают смену серверного соединения.
+# Встроенный пул (OPTIONS['pool']) появился только в Django 5.1 с psycopg 3.
+DB_CONN_MAX_AGE = os.getenv('DB_CONN_MAX_AGE', '60')
+DB_CONN_MAX_AGE = None if DB_CONN_MAX_AGE.lower() == 'none' else int(DB_CONN_MAX_AGE)
+DB_CONN_HEALTH_CHECKS = os.getenv('DB_CONN_HEALTH_CHECKS', 'True').lower() == 'true'
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'False').lower() == 'true'
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+
 if DB_ENGINE == 'django.db.backends.postgresql' and DB_NAME and DB_USER and DB_PASSWORD:
     DATABASES = {
         'default': {
@@ -128,6 +143,12 @@ if DB_ENGINE == 'django.db.backends.postgresql' and DB_NAME and DB_USER and DB_P
             'PASSWORD': DB_PASSWORD,
             'HOST': DB_HOST,
             'PORT': DB_PORT,
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+            'DISABLE_SERVER_SIDE_CURSORS': DB_PGBOUNCER,
+            'OPTIONS': {
+                'connect_timeout': DB_CONNECT_TIMEOUT,
+            },
         }
     }
 else:
@@ -138,10 +159,44 @@ else:
         }
     }
 
+# Реплики для чтения (core.db_routers): через запятую, для PostgreSQL - host
+# или host:port, для SQLite - путь к файлу. Безопасные запросы читают с
+# реплик, пользователь после своего изменения REPLICA_STICKY_SECONDS читает
+# с default. В тестах реплики зеркалят тестовую default.
+DB_REPLICAS = [replica.strip() for replica in os.getenv('DB_REPLICAS', '').split(',') if replica.strip()]
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', '10'))
+REPLICA_DATABASES = []
+for index, replica in enumerate(DB_REPLICAS):
+    alias = f'replica_{index}'
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        location = {'NAME': replica}
+    else:
+        host, _, port = replica.partition(':')
+        location = {'HOST': host, 'PORT': port or DATABASES['default']['PORT']}
+    DATABASES[alias] = {**DATABASES['default'], **location, 'TEST': {'MIRROR': 'default'}}
+    REPLICA_DATABASES.append(alias)
+DATABASE_ROUTERS = ['core.db_routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
+# Хешеры паролей: первый используется для новых паролей, остальные только
+# для проверки старых хешей. При успешном входе пароль со старым хешем
+# автоматически перехешируется первым хешером. Argon2 включается, если
+# установлен argon2-cffi. Аккаунты, входящие только по SMS/email/Google,
+# создаются с непригодным паролем и не хешируют ничего.
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+try:
+    import argon2  # noqa: F401
+    PASSWORD_HASHERS.insert(0, 'django.contrib.auth.hashers.Argon2PasswordHasher')
+except ImportError:
+    pass
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -189,6 +244,66 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 # P1SMS Configuration
 P1SMS_API_KEY = os.getenv('P1SMS_API_KEY', '')
 
+# SMS.RU Configuration
+SMS_RU_API_KEY = os.getenv('SMS_RU_API_KEY', '')
+
+# Отправка SMS: stub - без отправки (фиксированный код), иначе список
+# провайдеров через запятую в порядке приоритета: p1sms, smsru, fake (локальный
+# провайдер для тестов). Например: SMS_PROVIDER=p1sms,smsru
+SMS_PROVIDER = os.getenv('SMS_PROVIDER', 'stub')
+# Сколько последних отправок учитывается в статистике провайдера
+SMS_ROUTER_WINDOW = int(os.getenv('SMS_ROUTER_WINDOW', '100'))
+SMS_CONNECT_TIMEOUT = float(os.getenv('SMS_CONNECT_TIMEOUT', '3'))
+SMS_READ_TIMEOUT = float(os.getenv('SMS_READ_TIMEOUT', '10'))
+SMS_RATE_LIMIT_PER_SECOND = float(os.getenv('SMS_RATE_LIMIT_PER_SECOND', '5'))
+SMS_MAX_ATTEMPTS = int(os.getenv('SMS_MAX_ATTEMPTS', '3'))
+SMS_RETRY_BACKOFF_SECONDS = float(os.getenv('SMS_RETRY_BACKOFF_SECONDS', '1'))
+SMS_STATUS_TTL = int(os.getenv('SMS_STATUS_TTL', '600'))
+
+# Метрики запросов (/metrics): доля измеряемых запросов от 0 до 1 и токен
+# для Prometheus (Authorization: Bearer <токен>). Без токена /metrics
+# доступен только при DEBUG. Под gunicorn метрики воркеров суммируются через
+# каталог PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py, core.metrics)
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '1.0'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Профилирование запросов (core.profiling): по заголовку X-Profile: <токен>
+# или доле запросов PROFILING_SAMPLE_RATE. Профили смотрит staff через
+# /admin-tools/profiles/
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_DIR = os.getenv('PROFILING_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', '200'))
+PROFILING_MAX_BYTES = int(os.getenv('PROFILING_MAX_BYTES', str(200 * 1024 * 1024)))
+
+# Бюджет SQL запросов на view (core.query_budget): 'raise' - исключение
+# (тесты), 'log' - предупреждение в лог, 'off' - без подсчета
+QUERY_BUDGET_ACTION = os.getenv('QUERY_BUDGET_ACTION', 'log')
+
+# Горячая история (accounts.archive): AppUsageRecord и DailyTimeline старше
+# стольких дней команда archive_history переносит в архивные таблицы целыми
+# месяцами. Не меньше 31 дня - окна usage_month
+HISTORY_HOT_DAYS = int(os.getenv('HISTORY_HOT_DAYS', '90'))
+
+# Сроки хранения (accounts.retention, команда apply_retention), дней; 0 - хранить
+# всегда. Дневные AppUsageRecord/DailyTimeline старше RETENTION_DAILY_DAYS
+# остаются только в итогах AppUsageRollup/TimelineRollup; rebuild_rollups
+# пересчитывает лишь более новые периоды, поэтому после запуска срок не
+# увеличивают и не выключают. Удаленные пользователем чаты стираются вместе с
+# сообщениями через RETENTION_DELETED_CHATS_DAYS. Надгробия синхронизации
+# хранятся RETENTION_DELETED_RECORDS_DAYS: клиент с более старым курсором
+# получает полную синхронизацию
+RETENTION_DAILY_DAYS = int(os.getenv('RETENTION_DAILY_DAYS', '730'))
+RETENTION_EXPERIENCE_DAYS = int(os.getenv('RETENTION_EXPERIENCE_DAYS', '730'))
+RETENTION_CHAT_MESSAGES_DAYS = int(os.getenv('RETENTION_CHAT_MESSAGES_DAYS', '0'))
+RETENTION_DELETED_CHATS_DAYS = int(os.getenv('RETENTION_DELETED_CHATS_DAYS', '30'))
+RETENTION_DELETED_RECORDS_DAYS = int(os.getenv('RETENTION_DELETED_RECORDS_DAYS', '90'))
+
+# Курсор дельта-синхронизации отстает от момента чтения на столько секунд:
+# транзакции, начатые до чтения и закоммиченные после, попадут в следующую
+# синхронизацию. Записи из перекрытия клиент получает повторно
+SYNC_CURSOR_OVERLAP_SECONDS = int(os.getenv('SYNC_CURSOR_OVERLAP_SECONDS', '30'))
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = '/app/media'
@@ -198,21 +313,59 @@ STATIC_URL = '/static/'
 STATIC_ROOT = '/app/staticfiles'
 
 # Django REST Framework
+# Аутентификация по claims access токена без запроса пользователя к БД
+STATELESS_JWT_AUTH = os.getenv('STATELESS_JWT_AUTH', 'False').lower() == 'true'
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'accounts.authentication.StatelessJWTAuthentication'
+        if STATELESS_JWT_AUTH else
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.AllowAny',
     ),
+    # Лимиты для эндпоинтов входа (accounts/throttling.py)
+    'DEFAULT_THROTTLE_RATES': {
+        'auth_ip': os.getenv('THROTTLE_AUTH_IP', '30/min'),
+        'auth_phone': os.getenv('THROTTLE_AUTH_PHONE', '10/min'),
+        'sms_send_phone': os.getenv('THROTTLE_SMS_SEND_PHONE', '5/hour'),
+        'auth_identifier': os.getenv('THROTTLE_AUTH_IDENTIFIER', '10/min'),
+        'achievement_event': os.getenv('THROTTLE_ACHIEVEMENT_EVENT', '30/hour'),
+    },
+    # Число доверенных прокси перед приложением. 0 - IP берется из REMOTE_ADDR,
+    # X-Forwarded-For игнорируется (иначе клиент подделывает его и обходит лимиты).
+    # За nginx в production задается NUM_PROXIES=1, при этом порт приложения
+    # должен быть доступен только nginx
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', '0')),
 }
 
+# Кеш: общий Redis, если задан REDIS_URL (счетчики лимитов, статусы SMS,
+# проверенные токены должны быть общими для всех процессов gunicorn),
+# иначе локальная память процесса для разработки
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # SimpleJWT basic settings (dev-friendly lifetimes)
 from datetime import timedelta
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
     'AUTH_HEADER_TYPES': ('Bearer',),
+    # Перечитывает claims подписки при обновлении access токена
+    'TOKEN_REFRESH_SERIALIZER': 'accounts.tokens.UserTokenRefreshSerializer',
 }
 
 # CORS (allow all in dev; tighten in prod)
@@ -220,6 +373,8 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 # Firebase Configuration
 FIREBASE_CREDENTIALS = os.path.join(BASE_DIR, 'firebase-service-account.json')
+# Project id для локальной проверки ID токенов; если пусто, берется из файла ключей
+FIREBASE_PROJECT_ID = os.getenv('FIREBASE_PROJECT_ID', '')
 
 # Проверяем, существует ли файл с ключами Firebase
 if not os.path.exists(FIREBASE_CREDENTIALS):
@@ -228,42 +383,68 @@ if not os.path.exists(FIREBASE_CREDENTIALS):
     print("   and place it in the server/ directory")
     FIREBASE_CREDENTIALS = None
 
-# Логирование
+# Логирование: обработчики вызываются из фонового потока (core.logging_utils),
+# файл в JSON. LOG_SAMPLE_RATES прореживает записи ниже WARNING:
+# "accounts.views=0.1,accounts.p1sms_service=0.5"
+# В файл пишут все воркеры gunicorn, поэтому приложение его не ротирует
+# (ротация из нескольких процессов теряет и перемешивает записи): ротацию
+# делает внешний logrotate без copytruncate, а WatchedFileHandler заново
+# открывает файл после переименования
+LOG_FILE = os.getenv('LOG_FILE', os.path.join(BASE_DIR, 'django.log'))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'verbose': {
-            'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
-            'style': '{',
+        'json': {
+            '()': 'core.logging_utils.JsonFormatter',
         },
         'simple': {
             'format': '{levelname} {message}',
             'style': '{',
         },
     },
+    'filters': {
+        'sampling': {
+            '()': 'core.logging_utils.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'django.log'),
-            'formatter': 'verbose',
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': LOG_FILE,
+            'encoding': 'utf-8',
+            'formatter': 'json',
         },
         'console': {
             'level': 'DEBUG' if DEBUG else 'INFO',
             'class': 'logging.StreamHandler',
-            'formatter': 'simple',
+            'formatter': 'simple' if DEBUG else 'json',
+        },
+        # Имя должно идти после file и console: dictConfig создает обработчики по алфавиту
+        'queue': {
+            '()': 'core.logging_utils.QueueLogHandler',
+            'handlers': ['cfg://handlers.file', 'cfg://handlers.console'],
+            'filters': ['sampling'],
         },
     },
     'loggers': {
         'django': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'accounts': {
-            'handlers': ['file', 'console'],
-            'level': 'DEBUG',
+            'handlers': ['queue'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'propagate': True,
+        },
+        'core': {
+            'handlers': ['queue'],
+            'level': 'INFO',
             'propagate': True,
         },
     },
@@ -19,9 +19,14 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .views import metrics_view, profile_detail_view, profiles_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('accounts.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path('admin-tools/profiles/', profiles_view, name='profiles'),
+    path('admin-tools/profiles/<str:name>', profile_detail_view, name='profile-detail'),
 ]
 
 # Serve media files during development
@@ -0,0 +1,47 @@
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .metrics import render_metrics
+from .profiling import list_profiles, profile_path, profile_summary
+
+
+def metrics_view(request):
+    """Метрики всех воркеров в текстовом формате Prometheus"""
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+@staff_member_required
+def profiles_view(request):
+    """Список сохраненных профилей запросов (только для staff)"""
+    return JsonResponse({'profiles': list_profiles()})
+
+
+@staff_member_required
+def profile_detail_view(request, name):
+    """
+    Профиль запроса: файл pstats для snakeviz, а с ?format=text - сводка
+    самых тяжелых функций (?sort=cumulative|tottime, ?limit=50)
+    """
+    path = profile_path(name)
+    if path is None:
+        raise Http404('Profile not found')
+    if request.GET.get('format') == 'text':
+        sort = request.GET.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            sort = 'cumulative'
+        try:
+            limit = max(1, min(int(request.GET.get('limit', 50)), 500))
+        except ValueError:
+            limit = 50
+        return HttpResponse(profile_summary(path, sort, limit), content_type='text/plain; charset=utf-8')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
@@ -0,0 +1,22 @@
+"""
+Конфигурация gunicorn, читается автоматически из рабочего каталога.
+
+Включает multiprocess режим метрик (core.metrics): воркеры пишут значения
+в общий каталог, и /metrics отдает сумму по всем воркерам.
+"""
+import os
+import shutil
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def on_starting(server):
+    # Файлы прошлого запуска мастера дали бы в сумме чужие значения
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)